@@ -0,0 +1,181 @@
+""" An asyncio (ASGI) entry point for the kvstore, served with something like
+
+        gunicorn --worker-class=uvicorn.workers.UvicornWorker server.asgi:app
+
+    Connections, request bodies and responses are handled on the event loop, so
+    a slow client doesn't tie up anything but a coroutine.  The views themselves
+    still run the Flask app, which keeps the routes, JSONP callbacks and the
+    headers added by global_response_handler identical to the WSGI mode, but
+    they run on a thread pool that is sized for hundreds of requests in flight
+    rather than the handful gthread gives us.  boto has no non-blocking client,
+    so a thread per in flight storage call is as asynchronous as it gets.
+
+    uvicorn's own WSGIMiddleware isn't used as it holds the whole request body
+    in memory, and queues up the whole response body as fast as the view
+    produces it, however slowly the client reads it.  Values streamed in and out
+    of storage can be far larger than we want in memory, so request bodies are
+    spooled to disk and each chunk of a response is only pulled from the view
+    once the one before it has been sent.
+"""
+import os
+import sys
+import asyncio
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from server.core import app as wsgi_app
+
+# how many requests can be running views at once in each process
+ASGI_THREADS = int(os.environ.get('KVSTORE_ASGI_THREADS', 256))
+# request bodies larger than this are spooled to disk rather than held in memory
+ASGI_SPOOL_SIZE = int(os.environ.get('KVSTORE_ASGI_SPOOL_SIZE', 1024 * 1024))
+
+# marks the end of a response body handed back from the thread pool
+END_OF_BODY = object()
+
+class AsgiAdapter(object):
+    """ Runs a WSGI application as an ASGI one, reading the request and writing
+        the response on the event loop and calling the application on a thread
+        pool.
+    """
+
+    def __init__(self, wsgi_app, threads=ASGI_THREADS, spool_size=ASGI_SPOOL_SIZE):
+        self.wsgi_app = wsgi_app
+        self.spool_size = spool_size
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self.handle_http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self.handle_lifespan(receive, send)
+        else:
+            raise Exception("Unsupported ASGI scope type: %s" % (scope['type']))
+
+    async def handle_lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def handle_http(self, scope, receive, send):
+        body = await self.read_body(receive)
+        if body is None:
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            environ = self.environ_for(scope, body)
+            status, headers, iterable, chunk = await loop.run_in_executor(
+                self.executor, self.start_response_for, environ)
+            try:
+                await send({
+                    'type': 'http.response.start',
+                    'status': int(status.split(' ', 1)[0]),
+                    'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                        for name, value in headers],
+                })
+                # the rest of the body is pulled from the thread pool a chunk at
+                # a time, as it may be streaming out of storage
+                while chunk is not END_OF_BODY:
+                    if chunk:
+                        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                    chunk = await loop.run_in_executor(self.executor, next, iterable, END_OF_BODY)
+                await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            finally:
+                if hasattr(iterable, 'close'):
+                    await loop.run_in_executor(self.executor, iterable.close)
+        finally:
+            body.close()
+
+    async def read_body(self, receive):
+        """ returns a file holding the body of the request, or None if the client
+            went away before sending all of it
+        """
+        body = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return None
+            body.write(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+        body.seek(0)
+        return body
+
+    def start_response_for(self, environ):
+        """ calls the application, returning the status and headers along with an
+            iterator over the body and its first chunk.  This runs on the thread
+            pool, and fetching the first chunk here saves small responses a second
+            trip to it
+        """
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = status
+            response['headers'] = headers
+            return written.append
+
+        written = []
+        iterable = self.wsgi_app(environ, start_response)
+        iterator = iter(iterable)
+        chunk = next(iterator, END_OF_BODY)
+        if written:
+            chunk = b''.join(written) + (b'' if chunk is END_OF_BODY else chunk)
+        if not hasattr(iterator, 'close') and hasattr(iterable, 'close'):
+            iterator = ClosingIterator(iterator, iterable.close)
+        return response['status'], response['headers'], iterator, chunk
+
+    def environ_for(self, scope, body):
+        server_name, server_port = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server_name,
+            'SERVER_PORT': str(server_port),
+            'SERVER_PROTOCOL': 'HTTP/%s' % (scope.get('http_version', '1.1')),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = scope['client'][0]
+            environ['REMOTE_PORT'] = str(scope['client'][1])
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[name] = value
+                continue
+            name = 'HTTP_%s' % (name)
+            if name in environ:
+                # repeated headers are combined the same way a WSGI server would
+                value = '%s,%s' % (environ[name], value)
+            environ[name] = value
+        return environ
+
+class ClosingIterator(object):
+    """ keeps the close of a WSGI iterable around once we only have its iterator """
+
+    def __init__(self, iterator, close):
+        self.iterator = iterator
+        self.close = close
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.iterator)
+
+app = AsgiAdapter(wsgi_app)
@@ -0,0 +1,492 @@
+import os
+import json
+import time
+import errno
+import sqlite3
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from server.storage import get_storage_path_for, StreamedBody, STREAM_CHUNK_SIZE
+
+# invalidations are counted for each of this many stripes of keys, so a write to
+# one key only stops reads of the few keys that share its stripe being cached
+GENERATION_STRIPES = 4096
+
+class LRUCache(object):
+    """ An in-process cache bounded by the total size of the values it holds,
+        evicting the least recently used entries once it goes over budget.  Each
+        entry expires after ttl_seconds, or the ttl provided when it was set.
+    """
+
+    def __init__(self, max_bytes, ttl_seconds):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.lock = threading.Lock()
+        # bumped on every invalidation of a key in the stripe, or of every key,
+        # so a read that started before a write can tell it shouldn't cache
+        # what it read
+        self.stripes = [0] * GENERATION_STRIPES
+        self.clears = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """ returns a tuple of (found, value) """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            value, size, expires_at = entry
+            if expires_at <= time.time():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, value
+
+    def generation(self, key):
+        """ changes whenever the key is invalidated, and only rarely otherwise """
+        with self.lock:
+            return self.clears, self.stripes[hash(key) % GENERATION_STRIPES]
+
+    def set(self, key, value, size, ttl_seconds=None, generation=None):
+        """ caches value under key, if a generation is provided the value is only
+            cached if the key hasn't been invalidated since that generation of it
+            was read
+        """
+        if ttl_seconds is None:
+            ttl_seconds = self.ttl_seconds
+        if size > self.max_bytes or ttl_seconds <= 0:
+            return
+        with self.lock:
+            if generation is not None and generation != (self.clears, self.stripes[hash(key) % GENERATION_STRIPES]):
+                return
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, size, time.time() + ttl_seconds)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                oldest_key = next(iter(self.entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            self.stripes[hash(key) % GENERATION_STRIPES] += 1
+            if key in self.entries:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.clears += 1
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def _remove(self, key):
+        value, size, expires_at = self.entries.pop(key)
+        self.current_bytes -= size
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                expirations=self.expirations,
+                entries=len(self.entries),
+                bytes=self.current_bytes,
+                max_bytes=self.max_bytes
+            )
+
+class ResponseCache(object):
+    """ The cache behind cache_my_response.  Responses are kept in an in-process
+        LRUCache and, if a shared_path is provided, in a DiskCache under that
+        path so that every worker on the host can use a response any one of
+        them built, up to shared_max_bytes of them.  Cached values are
+        (body, status, headers) tuples, and only those with a 200 status are
+        cached.
+    """
+
+    def __init__(self, max_bytes, shared_path=None, shared_max_bytes=64 * 1024 * 1024):
+        self.memory = LRUCache(max_bytes, 0)
+        self.shared = DiskCache(shared_path, shared_max_bytes) if shared_path else None
+        self.shared_hits = 0
+
+    def get_or_return_from_cache(self, cache_key, expiration_seconds, producer, force_refresh=False):
+        """ returns a tuple of (expires_at, value) where expires_at is seconds since
+            the epoch or None if the value was not cached
+        """
+        if not force_refresh:
+            found, entry = self.memory.get(cache_key)
+            if not found and self.shared:
+                entry = self._read_shared(cache_key)
+                if entry:
+                    self.shared_hits += 1
+                    self._remember(cache_key, entry)
+            if entry:
+                return entry
+        value = producer()
+        if value[1] != 200:
+            return None, value
+        entry = (time.time() + expiration_seconds, value)
+        self._remember(cache_key, entry)
+        if self.shared:
+            self._write_shared(cache_key, entry)
+        return entry
+
+    def _remember(self, cache_key, entry):
+        expires_at, value = entry
+        self.memory.set(cache_key, entry, len(cache_key) + len(value[0]), ttl_seconds=expires_at - time.time())
+
+    def _read_shared(self, cache_key):
+        header, cached_file = self.shared.open(cache_key, None)
+        if header is None:
+            return None
+        with cached_file:
+            if header['expires_at'] <= time.time():
+                self.shared.invalidate(cache_key)
+                return None
+            body = cached_file.read()
+        headers = [tuple(pair) for pair in header['headers']]
+        return header['expires_at'], (body, header['status'], headers)
+
+    def _write_shared(self, cache_key, entry):
+        expires_at, (body, status, headers) = entry
+        self.shared.put(cache_key, None, dict(expires_at=expires_at, status=status, headers=headers), body)
+
+    def stats(self):
+        stats = self.memory.stats()
+        stats['shared_hits'] = self.shared_hits
+        if self.shared:
+            stats['shared'] = self.shared.stats()
+        return stats
+
+class DiskCache(object):
+    """ Keeps values on local disk for every worker on the host to share, in
+        files under root_path laid out the same way as get_storage_path_for.
+        Each file is a line of JSON describing the value followed by its body,
+        written to a temp file that's renamed into place.  The size and last use
+        of each file is kept in a sqlite index, and once the files add up to
+        more than max_bytes the least recently used are removed.
+
+        Each value is cached along with a validator, and is only found by a
+        lookup with the same validator, so a value that has since changed is
+        never handed back.
+    """
+    INDEX_FILE_NAME = 'index.sqlite3'
+    # the last use of a file is only recorded if it hasn't been for this long,
+    # so that every hit doesn't write to the index
+    TOUCH_SECONDS = 10
+
+    def __init__(self, root_path, max_bytes, max_entry_bytes=None):
+        self.root_path = root_path
+        self.max_bytes = max_bytes
+        # a single value can't take more than this much of the budget
+        self.max_entry_bytes = max_entry_bytes if max_entry_bytes is not None else max_bytes // 4
+        self.index_path = os.path.join(root_path, self.INDEX_FILE_NAME)
+        # sqlite connections can't be shared between threads, or processes
+        self.index_connections = threading.local()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+    def index(self):
+        connection = getattr(self.index_connections, 'connection', None)
+        if connection is None or self.index_connections.pid != os.getpid():
+            os.makedirs(self.root_path, exist_ok=True)
+            connection = sqlite3.connect(self.index_path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS entries (path TEXT PRIMARY KEY, size INTEGER, used REAL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS entries_by_use ON entries (used)")
+            self.index_connections.connection = connection
+            self.index_connections.pid = os.getpid()
+        return connection
+
+    def count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def fits(self, size):
+        return size is not None and size <= self.max_entry_bytes
+
+    def open(self, key, validator):
+        """ returns a tuple of (header, file) for the value cached for key, with the
+            file positioned at the start of the body.  Returns (None, None) if
+            nothing is cached for key with the validator provided
+        """
+        path = get_storage_path_for(key)
+        try:
+            cached_file = open(os.path.join(self.root_path, path), 'rb')
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self.count('misses')
+            return None, None
+        try:
+            header = json.loads(cached_file.readline())
+        except ValueError:
+            header = {}
+        if header.get('key') != key or header.get('validator') != validator:
+            cached_file.close()
+            self.count('misses')
+            return None, None
+        self.count('hits')
+        now = time.time()
+        self.index().execute("UPDATE entries SET used = ? WHERE path = ? AND used < ?", (now, path, now - self.TOUCH_SECONDS))
+        return header, cached_file
+
+    def tee(self, key, validator, header, chunks, size):
+        """ yields the chunks, writing them to the cache as they go.  The value is
+            only cached once every chunk has been yielded, and only if the size
+            of it fits.  Failing to write to the cache doesn't stop the chunks
+            being yielded
+        """
+        if not self.fits(size):
+            for chunk in chunks:
+                yield chunk
+            return
+        path = get_storage_path_for(key)
+        file_path = os.path.join(self.root_path, path)
+        temp_path = None
+        temp_file = None
+        try:
+            try:
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), prefix='.tmp-')
+                temp_file = os.fdopen(fd, 'wb')
+                temp_file.write(json.dumps(dict(header, key=key, validator=validator)).encode('utf-8'))
+                temp_file.write(b'\n')
+            except (IOError, OSError):
+                logging.exception("unable to cache %s on disk", key)
+                temp_file = self.discard(temp_file, temp_path)
+            for chunk in chunks:
+                if temp_file is not None:
+                    try:
+                        temp_file.write(chunk)
+                    except (IOError, OSError):
+                        logging.exception("unable to cache %s on disk", key)
+                        temp_file = self.discard(temp_file, temp_path)
+                yield chunk
+            if temp_file is not None:
+                cached_size = temp_file.tell()
+                temp_file.close()
+                temp_file = None
+                os.replace(temp_path, file_path)
+                self.index().execute("INSERT OR REPLACE INTO entries (path, size, used) VALUES (?, ?, ?)",
+                    (path, cached_size, time.time()))
+                self.count('writes')
+                self.evict()
+        finally:
+            # anything left over wasn't read all the way through
+            self.discard(temp_file, temp_path)
+
+    def discard(self, temp_file, temp_path):
+        if temp_file is None:
+            return None
+        temp_file.close()
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        return None
+
+    def put(self, key, validator, header, data):
+        for chunk in self.tee(key, validator, header, [data], len(data)):
+            pass
+
+    def evict(self):
+        """ removes the least recently used files until they fit within max_bytes """
+        connection = self.index()
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        while total > self.max_bytes:
+            rows = connection.execute("SELECT path, size FROM entries ORDER BY used LIMIT 100").fetchall()
+            if not rows:
+                return
+            for path, size in rows:
+                self.remove(path)
+                total -= size
+                self.count('evictions')
+                if total <= self.max_bytes:
+                    return
+
+    def remove(self, path):
+        try:
+            os.unlink(os.path.join(self.root_path, path))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self.index().execute("DELETE FROM entries WHERE path = ?", (path,))
+
+    def invalidate(self, key):
+        if os.path.exists(self.index_path):
+            self.remove(get_storage_path_for(key))
+
+    def stats(self):
+        entries, size = 0, 0
+        # nothing's been cached if there's no index yet
+        if os.path.exists(self.index_path):
+            entries, size = self.index().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        with self.lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                writes=self.writes,
+                evictions=self.evictions,
+                entries=entries,
+                bytes=size,
+                max_bytes=self.max_bytes
+            )
+
+class Flight(object):
+    """ A fetch that's in progress, the result is set before done is """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.joiners = 0
+
+class SingleFlight(object):
+    """ Coalesces fetches of the same key that are in progress at the same time,
+        only the first is made and everything asking for the key in the
+        meantime waits for it and is handed the same result.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.led = 0
+        self.joined = 0
+
+    def do(self, key, fetch, share=None):
+        """ returns a tuple of (result, shared), shared is True if the result was
+            fetched for someone else
+        """
+        return self.do_many([key], lambda keys: {key: fetch()}, share)[key]
+
+    def do_many(self, keys, fetch_many, share=None):
+        """ fetches all of the keys, fetch_many is handed those that aren't already
+            being fetched and returns a dictionary of key -> result for them, any
+            it leaves out have a result of None.  Returns a dictionary of
+            key -> (result, shared).  A result that's handed to others as well is
+            passed through share(result, count) first, if it's provided, count
+            being how many it's handed to including whoever fetched it
+        """
+        led = {}
+        joined = {}
+        with self.lock:
+            for key in keys:
+                if key in led or key in joined:
+                    continue
+                flight = self.flights.get(key)
+                if flight is None:
+                    led[key] = self.flights[key] = Flight()
+                else:
+                    flight.joiners += 1
+                    joined[key] = flight
+            self.led += len(led)
+            self.joined += len(joined)
+
+        results = {}
+        if led:
+            # our own keys are fetched before waiting on anyone else's, so two
+            # overlapping sets of keys can't end up waiting on each other
+            try:
+                fetched = fetch_many(list(led))
+                # once the flights are gone no one else can join them, so it's
+                # known how many each result is handed to
+                self.land(led)
+                for key, flight in led.items():
+                    flight.result = fetched.get(key)
+                    if share is not None and flight.joiners:
+                        flight.result = share(flight.result, flight.joiners + 1)
+                    results[key] = (flight.result, False)
+            except BaseException as e:
+                for flight in led.values():
+                    flight.error = e
+                raise
+            finally:
+                self.land(led)
+                for flight in led.values():
+                    flight.done.set()
+        for key, flight in joined.items():
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            results[key] = (flight.result, True)
+        return results
+
+    def land(self, flights):
+        """ removes the dictionary of key -> flight from those in progress """
+        with self.lock:
+            for key, flight in flights.items():
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+
+    def stats(self):
+        with self.lock:
+            return dict(led=self.led, joined=self.joined, in_flight=len(self.flights))
+
+class SharedStream(object):
+    """ Hands a single StreamedBody to a known number of readers, each reading it
+        at its own pace.  Whichever reader is furthest along reads the next chunk
+        from the body and spools it to a temp file for the others, so the body is
+        only read once.  The body is closed once every reader has been closed.
+    """
+
+    def __init__(self, body, readers):
+        self.body = body
+        self.chunks = iter(body)
+        self.readers = readers
+        self.spool = tempfile.TemporaryFile()
+        self.spooled = 0
+        self.finished = False
+        self.error = None
+        self.lock = threading.Lock()
+
+    def reader(self):
+        """ a StreamedBody of its own for one of the readers """
+        return StreamedBody(self.read_chunks(), self.body.size, on_close=self.release)
+
+    def read_chunks(self):
+        position = 0
+        while True:
+            with self.lock:
+                if self.error is not None:
+                    raise self.error
+                if position < self.spooled:
+                    chunk = os.pread(self.spool.fileno(), min(STREAM_CHUNK_SIZE, self.spooled - position), position)
+                elif self.finished:
+                    return
+                else:
+                    try:
+                        chunk = next(self.chunks, None)
+                    except Exception as e:
+                        self.error = e
+                        raise
+                    if chunk is None:
+                        self.finished = True
+                        return
+                    os.pwrite(self.spool.fileno(), chunk, self.spooled)
+                    self.spooled += len(chunk)
+            position += len(chunk)
+            yield chunk
+
+    def release(self):
+        with self.lock:
+            self.readers -= 1
+            if self.readers > 0:
+                return
+        self.body.close()
+        self.spool.close()
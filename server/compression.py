@@ -0,0 +1,84 @@
+import zlib
+import logging
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP = 'gzip'
+BROTLI = 'br'
+
+# content types worth compressing, anything else is assumed to already be compact
+COMPRESSIBLE_CONTENT_TYPES = frozenset([
+    'application/json',
+    'application/javascript',
+    'application/xml',
+    'application/x-www-form-urlencoded',
+])
+
+def supported_encodings():
+    encodings = [GZIP]
+    if brotli:
+        encodings.append(BROTLI)
+    return encodings
+
+def is_compressible(content_type):
+    if not content_type:
+        return False
+    mimetype = content_type.split(';')[0].strip().lower()
+    return (mimetype.startswith('text/') or mimetype in COMPRESSIBLE_CONTENT_TYPES
+        or mimetype.endswith('+json') or mimetype.endswith('+xml'))
+
+def compress(data, encoding):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if encoding == GZIP:
+        # wbits of 31 gives us gzip framing, so the bytes can be sent as is to
+        # clients that accept gzip
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+    elif encoding == BROTLI:
+        return brotli.compress(data)
+    raise Exception("Unsupported content encoding: %s" % (encoding))
+
+def decompressor_for(encoding):
+    if encoding == GZIP:
+        return zlib.decompressobj(31)
+    elif encoding == BROTLI:
+        return brotli.Decompressor()
+    raise Exception("Unsupported content encoding: %s" % (encoding))
+
+def decompress(data, encoding):
+    if encoding == GZIP:
+        return zlib.decompress(data, 31)
+    elif encoding == BROTLI:
+        return brotli.decompress(data)
+    raise Exception("Unsupported content encoding: %s" % (encoding))
+
+def decompress_chunks(chunks, encoding):
+    """ yields the decompressed contents of an iterable of compressed chunks """
+    decompressor = decompressor_for(encoding)
+    for chunk in chunks:
+        if encoding == BROTLI:
+            data = decompressor.process(chunk)
+        else:
+            data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    if encoding == GZIP:
+        data = decompressor.flush()
+        if data:
+            yield data
+
+def maybe_compress(data, content_type, encoding, min_size):
+    """ returns the data compressed with the encoding, or None if it isn't worth
+        compressing
+    """
+    if not encoding or data is None or len(data) < min_size or not is_compressible(content_type):
+        return None
+    compressed = compress(data, encoding)
+    if len(compressed) >= len(data):
+        logging.debug("compressing didn't make the data any smaller, storing it as is")
+        return None
+    return compressed
@@ -1,8 +1,10 @@
 #! /usr/bin/env python
 
 import os
+import re
 import sys
 import json
+import time
 from uuid import uuid4
 import logging
 import socket
@@ -13,13 +15,18 @@ import datetime
 
 from flask import Flask, request, make_response
 from flask import render_template
-from flask import g
+from flask import g, has_app_context
 from jinja2 import ChoiceLoader, FileSystemLoader
 from werkzeug import secure_filename
+from werkzeug.exceptions import BadRequest
 from werkzeug.http import http_date
 from werkzeug.routing import Submount, Map
 
 from . import messages
+from . import serialization
+from .cache import ResponseCache
+from .metrics import metrics, REQUEST_DURATION, REQUESTS_IN_FLIGHT, REQUEST_SIZE, RESPONSE_SIZE
+from .metrics import OPERATION_DURATION
 
 
 STATIC_DIR = os.environ.get('STATIC_DIR', path.join(os.getcwd(), 'static'))
@@ -33,6 +40,16 @@ app.config['LOG_LEVEL'] = os.environ.get('LOG_LEVEL', 'INFO')
 app.config['USER_HEADER_NAME'] = os.environ.get('USER_HEADER_NAME', 'Uid')
 app.config['ROOT_STORAGE_PATH'] = os.environ.get("ROOT_STORAGE_PATH", "./storage")
 app.config['CACHE_ROOT'] = os.environ.get('CACHE_ROOT', '%s/cache' % (app.config['ROOT_STORAGE_PATH']))
+# set RESPONSE_CACHE_SHARED to True to have all the workers on a host share cached
+# responses, RESPONSE_CACHE_ROOT is best placed somewhere memory backed like /dev/shm.
+# The least recently used shared responses are removed once they add up to more
+# than RESPONSE_CACHE_SHARED_BYTES
+app.config['RESPONSE_CACHE_BYTES'] = int(os.environ.get('RESPONSE_CACHE_BYTES', 16 * 1024 * 1024))
+app.config['RESPONSE_CACHE_SHARED'] = os.environ.get('RESPONSE_CACHE_SHARED', 'False')
+app.config['RESPONSE_CACHE_ROOT'] = os.environ.get('RESPONSE_CACHE_ROOT', '%s/responses' % (app.config['CACHE_ROOT']))
+app.config['RESPONSE_CACHE_SHARED_BYTES'] = int(os.environ.get('RESPONSE_CACHE_SHARED_BYTES', 64 * 1024 * 1024))
+# form data nested deeper than this is rejected rather than converted
+app.config['MAX_CONVERSION_DEPTH'] = int(os.environ.get('MAX_CONVERSION_DEPTH', 32))
 app.config['USE_RELOADER'] = os.environ.get('USE_RELOADER', 'True')
 app.config['TEMPLATE_DIR'] = TEMPLATE_DIR
 app.config['SUBMOUNT_PATH'] = os.environ.get('SUBMOUNT_PATH', None)
@@ -51,11 +68,29 @@ logging.basicConfig(
     level=app.config['LOG_LEVEL']
 )
 
+app.config['_CACHE'] = ResponseCache(
+    app.config['RESPONSE_CACHE_BYTES'],
+    shared_path=app.config['RESPONSE_CACHE_ROOT'] if app.config['RESPONSE_CACHE_SHARED'] == 'True' else None,
+    shared_max_bytes=app.config['RESPONSE_CACHE_SHARED_BYTES']
+)
+
 process_start_time = datetime.datetime.now()
 
+# name -> callable returning a dictionary of stats to be reported by /diagnostic
+diagnostic_stats_providers = {}
+
+def register_diagnostic_stats(name, provider):
+    diagnostic_stats_providers[name] = provider
+
+register_diagnostic_stats('response_cache', app.config['_CACHE'].stats)
+
+register_diagnostic_stats('messages', messages.publisher.stats)
+
 def emit_local_message(source, message=None):
     if source in app.config['LOCAL_EVENT_SOURCES']:
-        wrapped = json.dumps(dict(source=source, message=message, user_token=g.user_token))
+        # messages can be emitted outside of a request, in which case there's no user
+        user_token = g.get('user_token') if has_app_context() else None
+        wrapped = json.dumps(dict(source=source, message=message, user_token=user_token))
         messages.send(wrapped, messages.LOCAL_PUBLISH)
 
 def get_storage_location(named):
@@ -76,32 +111,58 @@ def try_run(this):
     except:
         return None
 
+# anything int() or float() would accept from a string once it's been stripped,
+# integers are matched by the first group
+NUMBER_PATTERN = re.compile(
+    r'([+-]?\d+(?:_\d+)*)'
+    r'|[+-]?(?:\d+(?:_\d+)*(?:\.(?:\d+(?:_\d+)*)?)?|\.\d+(?:_\d+)*)(?:[eE][+-]?\d+(?:_\d+)*)?'
+    r'|[+-]?(?:inf|infinity|nan)', re.IGNORECASE)
+match_number = NUMBER_PATTERN.fullmatch
+
 def convert_into_number(value):
-    as_number = try_run(lambda: int(value)) or try_run(lambda: float(value))
-    if as_number or as_number == 0:
-        return as_number
-    else:
+    """ turns a string holding a number into that number, leaving anything else
+        as it is.  Zero has always come back as a float, so it still does
+    """
+    if type(value) != str:
+        as_number = try_run(lambda: int(value)) or try_run(lambda: float(value))
+        if as_number or as_number == 0:
+            return as_number
+        return value
+    stripped = value.strip()
+    match = match_number(stripped)
+    if match is None:
         return value
+    if match.lastindex:
+        return int(stripped) or float(stripped)
+    return float(stripped)
 
-def convert_types_in_dictionary(this_dictionary):
+def check_conversion_depth(depth):
+    if depth > app.config['MAX_CONVERSION_DEPTH']:
+        raise BadRequest("data is nested more than %s deep" % (app.config['MAX_CONVERSION_DEPTH']))
+
+def convert_types_in_dictionary(this_dictionary, depth=0):
+    check_conversion_depth(depth)
     into_this_dictionary = {}
-    for key, value in list(this_dictionary.items()):
-        if type(value) == dict:
-            value = convert_types_in_dictionary(value)
-        elif type(value) == list:
-            value = convert_types_in_list(value)
+    for key, value in this_dictionary.items():
+        value_type = type(value)
+        if value_type == dict:
+            value = convert_types_in_dictionary(value, depth + 1)
+        elif value_type == list:
+            value = convert_types_in_list(value, depth + 1)
         else:
             value = convert_into_number(value)
         into_this_dictionary[key] = value
     return into_this_dictionary
 
-def convert_types_in_list(this_list):
+def convert_types_in_list(this_list, depth=0):
+    check_conversion_depth(depth)
     into_this_list = []
     for item in this_list:
-        if type(item) == list:
-            new_value = convert_types_in_list(item)
-        elif type(item) == dict:
-            new_value = convert_types_in_dictionary(item)
+        item_type = type(item)
+        if item_type == list:
+            new_value = convert_types_in_list(item, depth + 1)
+        elif item_type == dict:
+            new_value = convert_types_in_dictionary(item, depth + 1)
         else:
             new_value = convert_into_number(item)
         into_this_list.append(new_value)
@@ -109,6 +170,12 @@ def convert_types_in_list(this_list):
 
 def cache_my_response(vary_by=None, expiration_seconds=900):
     def cache_wrapper_decorator(f):
+        def produce_response(*args, **kwargs):
+            # responses are cached as plain (body, status, headers) so they can be
+            # shared between workers
+            response = app.make_response(f(*args, **kwargs))
+            return response.get_data(), response.status_code, list(response.headers.items())
+
         @wraps(f)
         def cache_wrapper(*args, **kwargs):
             if not vary_by:
@@ -123,7 +190,7 @@ def cache_my_response(vary_by=None, expiration_seconds=900):
             cr = app.config['_CACHE'].get_or_return_from_cache(
                 cache_key,
                 expiration_seconds,
-                lambda: f(*args, **kwargs),
+                lambda: produce_response(*args, **kwargs),
                 force_refresh = request.values.get('_reload_cache', False)
             )
             resp = app.make_response(cr[1])
@@ -173,12 +240,13 @@ def json_response(*args, **kwargs):
     # handle the response being a list of items
     if args:
         if type(args[0]) == list:
-            response_string = json.dumps(args[0])
+            response_string = serialization.dumps(args[0])
         # if the return is a string assume it's valid json
         elif type(args[0]) == str:
-            response_string = json.dumps(args[0]) if callback else args[0]
+            response_string = serialization.dumps(args[0]) if callback else args[0]
     else:
-        response_string = json.dumps(kwargs)
+        with metrics.timer(OPERATION_DURATION, operation='json_encode'):
+            response_string = serialization.dumps(kwargs)
 
     if callback:
         response_string = "%s(%s);" % (callback, response_string)
@@ -207,12 +275,31 @@ def global_response_handler(response):
     response.headers['Access-Control-Allow-Credentials'] = 'true'
     response.headers['X-HOSTNAME'] = app.config['X-HOSTNAME']
     response.headers['X-APP-VERSION'] = app.config['VERSION']
+    if g.get('request_started') is not None:
+        route = route_for_metrics()
+        metrics.observe(REQUEST_DURATION, time.perf_counter() - g.request_started,
+            route=route, method=request.method, status=response.status_code)
+        if request.content_length:
+            metrics.observe(REQUEST_SIZE, request.content_length, route=route, method=request.method)
+        if not response.is_streamed:
+            metrics.observe(RESPONSE_SIZE, response.calculate_content_length() or 0, route=route, method=request.method)
     return response
 
 def global_request_handler():
+    g.request_started = time.perf_counter()
+    metrics.add(REQUESTS_IN_FLIGHT, 1)
     # this needs to be safe for use by the app
     g.user_token = secure_filename(request.headers.get(app.config['USER_HEADER_NAME'], 'DEFAULT'))
 
+def route_for_metrics():
+    """ the rule the request matched, so the keys don't each get their own metrics """
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+@app.teardown_request
+def global_teardown_handler(exception=None):
+    if g.pop('request_started', None) is not None:
+        metrics.add(REQUESTS_IN_FLIGHT, -1)
+
 app.process_response = global_response_handler
 app.preprocess_request = global_request_handler
 
@@ -235,11 +322,26 @@ def pyserver_core_diagnostic_view():
     diag_info['process_start_time'] = process_start_time.isoformat()
     diag_info['process_uptime_secs'] = (datetime.datetime.now() - process_start_time).seconds
     diag_info['server_port'] = os.environ.get('PORT', None)
+    for name, provider in list(diagnostic_stats_providers.items()):
+        diag_info[name] = provider()
 
     response = make_response(json.dumps(diag_info, sort_keys=True))
     response.headers['X-Robots-Tag'] = 'noindex'
     return response
 
+@app.route("/metrics", methods=["GET"])
+def pyserver_core_metrics_view():
+    """
+        Latency histograms, payload sizes and in flight requests in the Prometheus
+        text format, added up across all of the workers on the host.
+
+        :statuscode 200: always returns the metrics
+    """
+    response = make_response(metrics.render())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    response.headers['X-Robots-Tag'] = 'noindex'
+    return response
+
 @app.route("/diagnostic/echo", methods=["GET"])
 @make_my_response_json
 def pyserver_core_diagnostic_echo_view():
@@ -270,7 +372,8 @@ def pyserver_core_publish_message():
         msg = json.dumps(request.json)
     else:
         data = request.values.to_dict(flat=False)
-        msg = convert_types_in_dictionary(remove_single_element_lists(data))
+        with metrics.timer(OPERATION_DURATION, operation='convert_types'):
+            msg = convert_types_in_dictionary(remove_single_element_lists(data))
         msg = json.dumps(msg)
     messages.send(msg, messages.LOCAL_PUBLISH)
     return dict(message="ok")
@@ -292,5 +395,5 @@ def general_error_handler(error):
     else:
         return render_template("500.html", **context), 500
 
-from .core_handlers import keyvalue_handlers, echo
+from .core_handlers import keyvalue_handlers, cluster_handlers, echo
 
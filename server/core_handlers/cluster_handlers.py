@@ -0,0 +1,259 @@
+""" The routes the nodes of a cluster use to talk to each other, see
+    storage/cluster.py.  Values are the values a node is asked to store as the
+    node responsible for them, copies are what it holds of them.  None of these
+    are of any use unless the cluster storage engine is being used, and every
+    one of them refuses a request that doesn't have the secret the nodes share.
+"""
+import json
+from functools import wraps
+from flask import request, abort
+from werkzeug.exceptions import BadRequest
+from server.core import app, make_my_response_json
+from server.core_handlers.keyvalue_handlers import get_storage, invalidate_cached, stream_threshold
+from server.storage import StreamedBody, read_chunks
+from server.storage.cluster import ClusterBackend, NodeUnavailable
+from server.storage.cluster import METADATA_HEADER, EXPECTED_HEADER, ENCODING_HEADER, DELETED_VERSION_HEADER
+from server.storage.cluster import SECRET_HEADER
+
+# set on the nodes being sent a change to the nodes, so they don't send it on
+FORWARDED_HEADER = 'X-Kvstore-Forwarded'
+
+def get_cluster():
+    storage = get_storage()
+    if not isinstance(storage, ClusterBackend):
+        abort(404)
+    return storage
+
+def from_nodes(f):
+    """ refuses the request unless it was made by one of the nodes, before the
+        view is run, so it's refused however the view handles its errors
+    """
+    @wraps(f)
+    def view_wrapper(*args, **kwargs):
+        if not get_cluster().is_node(request.headers.get(SECRET_HEADER)):
+            abort(403)
+        return f(*args, **kwargs)
+    return view_wrapper
+
+def metadata_from_request():
+    try:
+        return json.loads(request.headers.get(METADATA_HEADER, '{}'))
+    except ValueError:
+        raise BadRequest("%s isn't JSON" % (METADATA_HEADER))
+
+def expected_from_request():
+    """ (conditional, expected), expected being None if nothing is expected to be
+        stored
+    """
+    if EXPECTED_HEADER not in request.headers:
+        return False, None
+    try:
+        return True, json.loads(request.headers[EXPECTED_HEADER])
+    except ValueError:
+        raise BadRequest("%s isn't JSON" % (EXPECTED_HEADER))
+
+@app.route("/__cluster__/values/<path:key>", methods=["PUT"])
+@from_nodes
+def pyserver_core_cluster_handlers_store_value(key):
+    """
+        Stores the value here, and copies it to the key's other nodes.
+
+        :reqheader X-Kvstore-Metadata: JSON of the metadata to store with the value
+        :reqheader X-Kvstore-Expected: JSON of the metadata the stored value must have
+        :statuscode 204: the value was stored
+        :statuscode 412: the stored value didn't have the expected metadata
+    """
+    cluster = get_cluster()
+    metadata = metadata_from_request()
+    conditional, expected = expected_from_request()
+    content_length = request.content_length or 0
+    if conditional or content_length <= stream_threshold:
+        data = request.get_data()
+        if request.headers.get(ENCODING_HEADER):
+            data = data.decode(request.headers[ENCODING_HEADER])
+        if conditional:
+            if not cluster.store_if_here(key, data, request.content_type, metadata=metadata, expected=expected):
+                return ("", 412, {})
+        else:
+            cluster.store_here(key, data, request.content_type, metadata=metadata)
+    else:
+        cluster.store_stream_here(key, request.stream, request.content_type, content_length, metadata=metadata)
+    invalidate_cached(key)
+    return ("", 204, {})
+
+@app.route("/__cluster__/values/<path:key>", methods=["DELETE"])
+@from_nodes
+def pyserver_core_cluster_handlers_delete_value(key):
+    """
+        Deletes the value here, and from the key's other nodes.
+
+        :reqheader X-Kvstore-Expected: JSON of the metadata the stored value must have
+        :statuscode 204: the value was deleted
+        :statuscode 412: the stored value didn't have the expected metadata
+    """
+    cluster = get_cluster()
+    conditional, expected = expected_from_request()
+    if conditional:
+        if not cluster.delete_if_here(key, expected):
+            return ("", 412, {})
+    else:
+        cluster.delete_here(key)
+    invalidate_cached(key)
+    return ("", 204, {})
+
+@app.route("/__cluster__/copies/<path:key>", methods=["GET", "HEAD"])
+@from_nodes
+def pyserver_core_cluster_handlers_read_copy(key):
+    """
+        Returns the copy of the value held here, with its metadata.
+
+        :statuscode 200: the copy held here
+        :statuscode 404: there's no copy held here
+    """
+    cluster = get_cluster()
+    if request.method == 'HEAD':
+        content_type, metadata = cluster.local.read_metadata(key)
+        if metadata is None:
+            return ("", 404, {})
+        return ("", 200, {'Content-Type': content_type, METADATA_HEADER: json.dumps(metadata)})
+    content_type, body, found_key, metadata = cluster.local.read(key, stream=True)
+    if body is None:
+        return ("", 404, {})
+    headers = {METADATA_HEADER: json.dumps(metadata)}
+    if isinstance(body, str):
+        headers[ENCODING_HEADER] = 'utf-8'
+        body = body.encode('utf-8')
+    if isinstance(body, StreamedBody):
+        headers['Content-Length'] = str(body.size)
+        response = app.response_class(body, 200, headers, direct_passthrough=True)
+        response.call_on_close(body.close)
+        # the content type is given to the response directly as flask would add
+        # a charset to it
+        response.headers['Content-Type'] = content_type
+        return response
+    response = app.response_class(body, 200, headers)
+    response.headers['Content-Type'] = content_type
+    return response
+
+@app.route("/__cluster__/copies/<path:key>", methods=["PUT"])
+@from_nodes
+def pyserver_core_cluster_handlers_store_copy(key):
+    """
+        Stores a copy of a value, as it is, unless a later version is held here.
+
+        :reqheader X-Kvstore-Metadata: JSON of the metadata of the value
+        :statuscode 204: the copy was stored, or a later version is already held
+    """
+    cluster = get_cluster()
+    metadata = metadata_from_request()
+    if cluster.local.store_copy(key, read_chunks(request.stream), request.content_type, metadata,
+            encoding=request.headers.get(ENCODING_HEADER)):
+        invalidate_cached(key)
+    return ("", 204, {})
+
+@app.route("/__cluster__/copies/<path:key>", methods=["DELETE"])
+@from_nodes
+def pyserver_core_cluster_handlers_delete_copy(key):
+    """
+        Deletes the copy of the value held here, unless it's later than the
+        version that was deleted.
+
+        :reqheader X-Kvstore-Deleted-Version: the version that was deleted, any
+            copy is deleted without it
+        :statuscode 204: there's no longer a copy held here, or it's a later version
+    """
+    cluster = get_cluster()
+    if request.headers.get(DELETED_VERSION_HEADER):
+        try:
+            version = int(request.headers[DELETED_VERSION_HEADER])
+        except ValueError:
+            raise BadRequest("%s must be a number" % (DELETED_VERSION_HEADER))
+        cluster.local.delete_copy(key, version)
+    else:
+        cluster.local.delete(key)
+    invalidate_cached(key)
+    return ("", 204, {})
+
+@app.route("/__cluster__/keys", methods=["GET"])
+@from_nodes
+@make_my_response_json
+def pyserver_core_cluster_handlers_list_keys():
+    """
+        Lists the keys held here, in order.
+
+        :param prefix: only keys that start with this are listed
+        :param start_after: keys are listed from the first one after this
+        :param limit: the most keys to list
+    """
+    try:
+        limit = int(request.values.get('limit', 100))
+    except ValueError:
+        raise BadRequest("limit must be a number")
+    keys = get_cluster().local.list_keys(request.values.get('prefix', ''),
+        start_after=request.values.get('start_after', None), limit=limit)
+    return dict(keys=keys)
+
+@app.route("/__cluster__/unexpired", methods=["POST"])
+@from_nodes
+@make_my_response_json
+def pyserver_core_cluster_handlers_unexpired_keys():
+    """
+        Returns those of the keys, in order, that haven't expired as far as the
+        index of the keys held here can tell.
+
+        :<json keys: the keys to look up
+        :<json now: the time to look up their expiry at, it's now if it's null
+    """
+    body = request.get_json(silent=True) or {}
+    keys = body.get('keys')
+    if not isinstance(keys, list) or not all(isinstance(key, str) for key in keys):
+        raise BadRequest("keys must be a list of keys")
+    return dict(keys=get_cluster().local.unexpired_keys(keys, body.get('now')))
+
+@app.route("/__cluster__/nodes", methods=["GET"])
+@from_nodes
+@make_my_response_json
+def pyserver_core_cluster_handlers_nodes():
+    """
+        Describes the nodes of the cluster, whether keys are still being moved
+        after they last changed, and whether this node has moved its own.
+    """
+    cluster = get_cluster()
+    ring, previous_ring = cluster.current_rings()
+    return dict(nodes=ring.nodes, self=cluster.self_node, replicas=cluster.replicas,
+        rebalancing=previous_ring is not None, swept=previous_ring is not None and cluster.swept)
+
+@app.route("/__cluster__/nodes", methods=["PUT"])
+@from_nodes
+@make_my_response_json
+def pyserver_core_cluster_handlers_set_nodes():
+    """
+        Changes the nodes of the cluster.  The change is sent on to every node,
+        old and new, and each moves the keys it holds to the nodes now responsible
+        for them.
+
+        :<json nodes: the base URL of each of the nodes
+        :statuscode 200: the nodes were changed, keys are moved in the background
+        :statuscode 502: some of the nodes couldn't be sent the change
+    """
+    cluster = get_cluster()
+    body = request.get_json(silent=True) or {}
+    nodes = body.get('nodes')
+    if not isinstance(nodes, list) or not nodes or not all(isinstance(node, str) for node in nodes):
+        raise BadRequest("nodes must be a list of the URLs of the nodes")
+    unreachable = []
+    if not request.headers.get(FORWARDED_HEADER):
+        for node in sorted(set(nodes) | set(cluster.current_rings()[0].nodes)):
+            if node == cluster.self_node:
+                continue
+            try:
+                response, data = cluster.client.request(node, 'PUT', '/__cluster__/nodes', json.dumps(dict(nodes=nodes)).encode('utf-8'),
+                    {'Content-Type': 'application/json', FORWARDED_HEADER: 'true'})
+                if response.status != 200:
+                    unreachable.append(node)
+            except NodeUnavailable:
+                unreachable.append(node)
+    cluster.set_nodes(nodes)
+    if unreachable:
+        return dict(message="unable to change the nodes of %s" % (", ".join(unreachable)), status_code=502)
+    return dict(message="ok")
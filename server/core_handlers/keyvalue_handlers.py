@@ -1,79 +1,592 @@
 import os
 import json
-import uuid
-import errno
-import hashlib
+import math
+import random
+import base64
+import binascii
+import time
+import calendar
 import logging
-import boto
+import threading
 from functools import wraps
 from flask import request, make_response
-from boto.s3.key import Key as S3Key
-from boto.exception import S3ResponseError
-from boto.dynamodb2.table import Table
-from boto.dynamodb2.exceptions import ItemNotFound, ValidationException
-from boto.s3.connection import OrdinaryCallingFormat
+from werkzeug.http import http_date, parse_options_header
+from werkzeug.wsgi import wrap_file
+from werkzeug.exceptions import BadRequest
+from server import serialization
 from server.core import app, get_storage_location, make_my_response_json
 from server.core import convert_types_in_dictionary, remove_single_element_lists
-from server.core import json_response, return_cors_response
+from server.core import json_response, return_cors_response, register_diagnostic_stats
+from server.core import emit_local_message
+from server.cache import LRUCache, SingleFlight, SharedStream, DiskCache
+from server.metrics import metrics, CACHE_LOOKUPS, OPERATION_DURATION, COALESCED_READS
+from server.compression import maybe_compress, decompress, decompress_chunks, supported_encodings
+from server.storage import create_backend, get_storage_path_for, is_expired, StreamedBody, StorageMisconfigured
+from server.storage import STREAM_CHUNK_SIZE
 
+storage_engine = os.environ.get('KVSTORE_STORAGE_ENGINE', 'dynamodb')
 ddb_table_name = os.environ.get('KVSTORE_DYNAMO_TABLE', 'kvstore')
+# keys are listed from this table, its hash key is segment and its range key is key
+ddb_index_table_name = os.environ.get('KVSTORE_DYNAMO_INDEX_TABLE', '%s-keys' % (ddb_table_name))
+# the cluster storage engine spreads the keys over the nodes listed, by the base
+# URL each is reached at, keeping each key on replicas of them.  self is the URL
+# of this node
+cluster_nodes = [node for node in os.environ.get('KVSTORE_CLUSTER_NODES', '').split(',') if node]
+cluster_self = os.environ.get('KVSTORE_CLUSTER_SELF', None)
+# the secret every node of the cluster is given, the /__cluster__ routes the
+# nodes talk to each other through refuse any request without it
+cluster_secret = os.environ.get('KVSTORE_CLUSTER_SECRET', None)
+cluster_replicas = int(os.environ.get('KVSTORE_CLUSTER_REPLICAS', 2))
+cluster_vnodes = int(os.environ.get('KVSTORE_CLUSTER_VNODES', 64))
+cluster_timeout = float(os.environ.get('KVSTORE_CLUSTER_TIMEOUT', 5))
+# how often, in seconds, the changes that couldn't be made to a node are tried again
+cluster_handoff_interval = float(os.environ.get('KVSTORE_CLUSTER_HANDOFF_INTERVAL', 5))
 s3_bucket_name = os.environ.get('KVSTORE_S3_BUCKET', 'kvstore-large')
-logging.info("Using DDB table: %s" % (ddb_table_name))
-logging.info("Using S3 bucket %s for large objects" %(s3_bucket_name))
-
-ddb_kvstore = Table(ddb_table_name)
-
-if "." in s3_bucket_name:
-    logging.debug("Using ordinary calling format for s3 connection")
-    s3_conn = boto.connect_s3(calling_format=OrdinaryCallingFormat())
-else:
-    logging.debug("Using standard s3 connection")
-    s3_conn = boto.connect_s3()
-
-s3_bucket = s3_conn.get_bucket(s3_bucket_name)
-
-def get_storage_path_for(key):
-    hash_o = hashlib.sha256()
-    hash_o.update(key.encode())
-    storage_key = hash_o.hexdigest()
-    return os.path.join(
-        storage_key[:2],
-        storage_key[2:4],
-        storage_key
-    )
-
-def store_it(key, data, content_type):
-    try:
-        ddb_kvstore.put_item(data={'key': key, 'path':get_storage_path_for(key), 'body':data,'content-type':content_type}, overwrite=True)
-    except ValidationException as e:
-        # if we get an "it's too big" exception we'll put it in our s3
-        # kvstore 'big stuff' bucket
-        newS3Key = S3Key(s3_bucket)
-        newS3Key.key = get_storage_path_for(key)
-        newS3Key.set_metadata('content-type', content_type)
-        newS3Key.set_metadata('key', key)
-        newS3Key.set_contents_from_string(data)
-
-def read_it(key):
+s3_fetch_threads = int(os.environ.get('KVSTORE_S3_FETCH_THREADS', 8))
+# the most idle HTTP connections kept alive to each of DynamoDB and S3 by each
+# worker, how long, in whole seconds, a call waits on a socket before giving up and how
+# many times boto retries a call.  An unset timeout or retries leaves boto's default
+boto_pool_size = int(os.environ.get('KVSTORE_BOTO_POOL_SIZE', 10))
+boto_timeout = os.environ.get('KVSTORE_BOTO_TIMEOUT', None)
+boto_retries = os.environ.get('KVSTORE_BOTO_RETRIES', None)
+boto_idle_seconds = os.environ.get('KVSTORE_BOTO_IDLE_SECONDS', None)
+# connect to storage as each worker starts, rather than on its first request
+warm_up_storage = os.environ.get('KVSTORE_WARM_UP', 'True')
+# once everything large in s3 has a pointer record in DynamoDB set this to False,
+# so missing keys are no longer looked for in s3
+s3_legacy_fallback = os.environ.get('KVSTORE_S3_LEGACY_FALLBACK', 'True')
+# large values are stored in s3 by their content, so identical values stored
+# under different keys share a single copy.  Blobs that nothing has pointed to
+# for the grace period are collected every gc interval seconds.  It scans the
+# whole table, so every worker tries but only the one holding the lease on it,
+# for twice the interval, collects.  An interval of 0 turns collection off
+deduplicate_blobs = os.environ.get('KVSTORE_DEDUPLICATE_BLOBS', 'True')
+blob_grace_seconds = int(os.environ.get('KVSTORE_BLOB_GRACE_SECONDS', 24 * 60 * 60))
+blob_gc_interval = float(os.environ.get('KVSTORE_BLOB_GC_INTERVAL', 60 * 60))
+# request bodies larger than this, that aren't JSON or form data, are streamed
+# into storage rather than being read into memory first
+stream_threshold = int(os.environ.get('KVSTORE_STREAM_THRESHOLD', 400 * 1024))
+
+# the Cache-Control header sent with values stored without one of their own
+default_cache_control = os.environ.get('KVSTORE_DEFAULT_CACHE_CONTROL', None)
+
+# values of a compressible content type can be compressed as they're stored, set
+# this to gzip, or br if brotli is installed, to do so
+compression = os.environ.get('KVSTORE_COMPRESSION', None)
+compression_min_size = int(os.environ.get('KVSTORE_COMPRESSION_MIN_SIZE', 1024))
+if compression and compression not in supported_encodings():
+    logging.warning("Unsupported compression %s, values will be stored uncompressed" % (compression))
+    compression = None
+
+# the sources of the events emitted as values change, include them in
+# LOCAL_EVENT_SOURCES to have the events published
+STORE_EVENT_SOURCE = 'kvstore.store'
+DELETE_EVENT_SOURCE = 'kvstore.delete'
+
+# the most keys /__keys__ will return at once
+max_list_limit = int(os.environ.get('KVSTORE_MAX_LIST_LIMIT', 1000))
+
+# /__export__ reads this many keys from storage at a time
+export_page_size = int(os.environ.get('KVSTORE_EXPORT_PAGE_SIZE', 100))
+# /__import__ stores what it reads in batches of up to this many items, or bytes,
+# and won't take an item whose line is longer than max line bytes, so it holds
+# no more than a batch and a line in memory however much it's sent
+import_batch_size = int(os.environ.get('KVSTORE_IMPORT_BATCH_SIZE', 100))
+import_batch_bytes = int(os.environ.get('KVSTORE_IMPORT_BATCH_BYTES', 8 * 1024 * 1024))
+import_max_line_bytes = int(os.environ.get('KVSTORE_IMPORT_MAX_LINE_BYTES', 64 * 1024 * 1024))
+# the metadata an imported value keeps, the rest is that of being stored again
+IMPORTED_METADATA = ('cache-control', 'content-encoding', 'expires')
+# the most of the items that couldn't be imported that are described in the response
+MAX_IMPORT_FAILURES = 100
+
+# expired values are deleted by a background thread of each worker, every
+# interval seconds batch_size at a time, an interval of 0 leaves it to something else
+reaper_interval = float(os.environ.get('KVSTORE_REAPER_INTERVAL', 60))
+reaper_batch_size = int(os.environ.get('KVSTORE_REAPER_BATCH_SIZE', 100))
+
+# how many times a PATCH or increment is tried before giving up, when the value
+# keeps being changed by others between it being read and written.  Between
+# tries it waits a random time up to the retry delay, which doubles with each
+# try up to the max, so those changing the same value drift apart
+update_retries = int(os.environ.get('KVSTORE_UPDATE_RETRIES', 10))
+update_retry_delay = float(os.environ.get('KVSTORE_UPDATE_RETRY_DELAY', 0.01))
+update_retry_max_delay = float(os.environ.get('KVSTORE_UPDATE_RETRY_MAX_DELAY', 0.5))
+# the metadata a value keeps when it's updated in place
+UPDATE_KEPT_METADATA = ('cache-control', 'expires')
+
+FORM_CONTENT_TYPES = frozenset(['application/x-www-form-urlencoded', 'multipart/form-data'])
+
+# per worker cache of read results, off unless a ttl is set.  A worker only
+# knows about the writes it handles itself, so with it on, a read after a write
+# handled by another worker, or host, can be answered with what was stored
+# before that write for up to the ttl.  Only turn it on if reads can be that stale
+read_cache_bytes = int(os.environ.get('KVSTORE_READ_CACHE_BYTES', 32 * 1024 * 1024))
+read_cache_ttl = float(os.environ.get('KVSTORE_READ_CACHE_TTL', 0))
+# keys with no data are cached too, so repeated misses don't go all the way to
+# storage, though a key stored elsewhere in the meantime is missing for as long
+read_cache_negative_ttl = float(os.environ.get('KVSTORE_READ_CACHE_NEGATIVE_TTL', min(1, read_cache_ttl)))
+
+read_cache = LRUCache(read_cache_bytes, read_cache_ttl)
+register_diagnostic_stats('read_cache', read_cache.stats)
+# large values read from s3 are kept on local disk, shared by every worker on
+# the host, until they add up to this many bytes.  0 turns it off
+disk_cache_bytes = int(os.environ.get('KVSTORE_DISK_CACHE_BYTES', 1024 * 1024 * 1024))
+disk_cache = DiskCache(os.path.join(app.config['CACHE_ROOT'], 'values'), disk_cache_bytes) if disk_cache_bytes else None
+if disk_cache:
+    register_diagnostic_stats('disk_cache', disk_cache.stats)
+
+# reads of a key that's already being read from storage wait for that read and
+# share its result, rather than making a read of their own
+coalesce_reads = os.environ.get('KVSTORE_COALESCE_READS', 'True')
+read_flights = SingleFlight()
+register_diagnostic_stats('read_coalescing', read_flights.stats)
+# only report on the storage once something has used it
+register_diagnostic_stats('storage', lambda: storage.stats() if storage else {})
+
+storage = None
+storage_lock = threading.Lock()
+reaper = None
+blob_collector = None
+
+def get_storage():
+    """ The storage backend is created on first use, which keeps importing this
+        module from connecting to anything.
+    """
+    global storage
+    if storage is None:
+        with storage_lock:
+            if storage is None:
+                if storage_engine == 'local':
+                    storage = create_backend(storage_engine, root_path=get_storage_location('kv'))
+                elif storage_engine == 'cluster':
+                    storage = create_backend(
+                        storage_engine,
+                        root_path=get_storage_location('kv'),
+                        nodes=cluster_nodes,
+                        self_node=cluster_self,
+                        secret=cluster_secret,
+                        replicas=cluster_replicas,
+                        vnodes=cluster_vnodes,
+                        timeout=cluster_timeout,
+                        handoff_interval=cluster_handoff_interval
+                    )
+                else:
+                    storage = create_backend(
+                        storage_engine,
+                        table_name=ddb_table_name,
+                        index_table_name=ddb_index_table_name,
+                        bucket_name=s3_bucket_name,
+                        s3_fetch_threads=s3_fetch_threads,
+                        legacy_s3_fallback=(s3_legacy_fallback == 'True'),
+                        pool_size=boto_pool_size,
+                        timeout=int(boto_timeout) if boto_timeout else None,
+                        retries=int(boto_retries) if boto_retries else None,
+                        idle_seconds=float(boto_idle_seconds) if boto_idle_seconds else None,
+                        disk_cache=disk_cache,
+                        deduplicate_blobs=(deduplicate_blobs == 'True'),
+                        blob_grace_seconds=blob_grace_seconds
+                    )
+                start_reaper()
+                start_blob_collector()
+    return storage
+
+def warm_up():
+    """ connects to storage ahead of the first request, see gunicorn_config.py.
+        Storage that can't be reached is logged rather than stopping the worker
+        from starting, requests will try again as they need it.  Storage that's
+        misconfigured stops it, as no request would succeed
+    """
+    if warm_up_storage != 'True':
+        return
     try:
-        item = ddb_kvstore.get_item(path=get_storage_path_for(key))
-        return item['content-type'], item['body'], key
-    except ItemNotFound as e:
-        # could be because it's super big, so we'll try our s3 bucket before
-        # giving up for good
+        get_storage().warm_up()
+    except StorageMisconfigured:
+        raise
+    except Exception:
+        logging.exception("unable to warm up the connections to storage")
+
+def start_reaper():
+    global reaper
+    if reaper_interval > 0 and reaper is None:
+        reaper = threading.Thread(target=run_reaper, name='expired-value-reaper')
+        reaper.daemon = True
+        reaper.start()
+
+def run_reaper():
+    while True:
+        time.sleep(reaper_interval)
+        try:
+            # keep going while there's a full batch to delete
+            while len(reap_expired()) >= reaper_batch_size:
+                pass
+        except Exception:
+            logging.exception("unable to delete expired values")
+
+def reap_expired(now=None):
+    """ deletes a batch of the values that have expired, returning their keys """
+    reaped = get_storage().reap_expired(now, limit=reaper_batch_size)
+    for key in reaped:
+        invalidate_cached(key)
+    return reaped
+
+def start_blob_collector():
+    global blob_collector
+    if blob_gc_interval > 0 and blob_collector is None:
+        blob_collector = threading.Thread(target=run_blob_collector, name='blob-collector')
+        blob_collector.daemon = True
+        blob_collector.start()
+
+def run_blob_collector():
+    while True:
+        time.sleep(blob_gc_interval)
         try:
-            s3Key = S3Key(s3_bucket)
-            s3Key.key = get_storage_path_for(key)
-            body = s3Key.get_contents_as_string()
-            content_type = s3Key.get_metadata('content-type')
-            return content_type, body, key
-        except S3ResponseError as e:
-            logging.debug("unable to find item for key %s anywhere\n%s", key, e)
+            collected = get_storage().collect_blobs(lease_seconds=2 * blob_gc_interval)
+            if collected:
+                logging.info("collected %s unused blobs", len(collected))
+        except Exception:
+            logging.exception("unable to collect unused blobs")
+
+def ttl_from_request():
+    """ the number of seconds the value being stored is to be kept for, from the
+        X-TTL header or the ttl parameter, None if it's to be kept until deleted
+    """
+    ttl = request.headers.get('X-TTL') or request.args.get('ttl')
+    if not ttl:
+        return None
+    try:
+        ttl = int(ttl)
+    except ValueError:
+        raise BadRequest("ttl must be a whole number of seconds")
+    if ttl <= 0:
+        raise BadRequest("ttl must be greater than 0")
+    return ttl
+
+def cache_ttl_for(metadata):
+    """ how long a value can be cached for, which is never past when it expires """
+    if not metadata or metadata.get('expires') is None:
+        return read_cache_ttl
+    return min(read_cache_ttl, int(metadata['expires']) - time.time())
+
+def unexpired(value):
+    """ returns the (content_type, body, key, metadata) tuple, or the tuple for a
+        missing value if it's expired
+    """
+    if is_expired(value[3]):
+        if isinstance(value[1], StreamedBody):
+            value[1].close()
+        return (None, None, None, None)
+    return value
+
+def invalidate_cached(key):
+    """ forgets what's cached for the key, as it has changed.  What's cached on
+        disk is left to be evicted, it's only found with the validator of the
+        pointer it was cached for so it's never handed back once that changes
+    """
+    read_cache.invalidate(key)
+
+def compressed_for_storage(data, content_type, metadata=None):
+    """ returns the data and metadata to be stored, compressing the data if it's
+        worth doing so
+    """
+    compressed = maybe_compress(data, content_type, compression, compression_min_size)
+    if compressed is None:
+        return data, metadata
+    metadata = dict(metadata or {})
+    metadata['content-encoding'] = compression
+    return compressed, metadata
+
+def decompressed(body, metadata):
+    """ returns the body as it was originally provided, if it was stored compressed """
+    encoding = metadata.get('content-encoding') if metadata else None
+    if not encoding:
+        return body
+    if isinstance(body, StreamedBody):
+        return StreamedBody(decompress_chunks(body, encoding), on_close=body.close)
+    return decompress(body, encoding)
+
+def accepts_stored_encoding(metadata):
+    """ True if the client can be sent the body as it's stored """
+    encoding = metadata.get('content-encoding')
+    return not encoding or request.accept_encodings[encoding] > 0
+
+def store_it(key, data, content_type, metadata=None):
+    data, metadata = compressed_for_storage(data, content_type, metadata)
+    get_storage().store(key, data, content_type, metadata=metadata)
+    invalidate_cached(key)
+    emit_local_message(STORE_EVENT_SOURCE, dict(key=key, content_type=content_type))
+
+def store_many_it(items, metadata=None):
+    """ stores a list of (key, data, content_type) returning a dictionary of
+        key -> None or the reason it wasn't stored, the metadata is stored with
+        each of them
+    """
+    return store_items_it([(key, data, content_type, metadata) for key, data, content_type in items])
+
+def store_items_it(items):
+    """ stores a list of (key, data, content_type, metadata) returning a
+        dictionary of key -> None or the reason it wasn't stored.  Data that's
+        already compressed is stored as it is
+    """
+    to_store = []
+    for key, data, content_type, metadata in items:
+        if not (metadata or {}).get('content-encoding'):
+            data, metadata = compressed_for_storage(data, content_type, metadata)
+        to_store.append((key, data, content_type, metadata))
+    results = get_storage().store_many(to_store)
+    content_types = dict((key, content_type) for key, data, content_type, metadata in to_store)
+    for key, error in results.items():
+        invalidate_cached(key)
+        if not error:
+            emit_local_message(STORE_EVENT_SOURCE, dict(key=key, content_type=content_types[key]))
+    return results
+
+def store_stream_it(key, stream, content_type, content_length, metadata=None):
+    get_storage().store_stream(key, stream, content_type, content_length, metadata=metadata)
+    invalidate_cached(key)
+    emit_local_message(STORE_EVENT_SOURCE, dict(key=key, content_type=content_type))
+
+def store_if_it(key, data, content_type, metadata=None, expected=None):
+    """ stores the value only if what's stored has the expected metadata, or if
+        expected is None only if nothing is, returning False if that isn't so
+    """
+    data, metadata = compressed_for_storage(data, content_type, metadata)
+    stored = get_storage().store_if(key, data, content_type, metadata=metadata, expected=expected)
+    if stored:
+        invalidate_cached(key)
+        emit_local_message(STORE_EVENT_SOURCE, dict(key=key, content_type=content_type))
+    return stored
+
+def update_it(key, change):
+    """ reads the value, hands its content type and body to change, and stores
+        the (data, content_type) change returns if the value hasn't been changed
+        since it was read.  If it has been it waits a while and starts over,
+        returning False if it still hasn't stored anything after update_retries
+        tries
+    """
+    delay = update_retry_delay
+    for attempt in range(update_retries):
+        if attempt:
+            time.sleep(random.uniform(0, delay))
+            delay = min(delay * 2, update_retry_max_delay)
+        # straight from storage, a cached value may already have been replaced
+        content_type, body, file_path, metadata = get_storage().read(key)
+        kept = None
+        if is_expired(metadata):
+            content_type = body = None
+        elif body is not None:
+            body = decompressed(body, metadata)
+            kept = dict((name, value) for name, value in metadata.items() if name in UPDATE_KEPT_METADATA)
+        data, content_type = change(content_type, body)
+        if store_if_it(key, data, content_type, kept, expected=metadata):
+            return True
+    return False
+
+def stored_json(content_type, body):
+    """ the value of the stored JSON, or None if nothing is stored """
+    if body is None:
+        return None
+    # it may have been stored with a charset, or any other parameter
+    if parse_options_header(content_type)[0] != 'application/json':
+        raise BadRequest("the value stored isn't JSON")
+    return serialization.loads(body)
+
+def merge_patch(target, patch):
+    """ returns the target with the JSON merge patch (RFC 7386) applied to it """
+    if not isinstance(patch, dict):
+        return patch
+    patched = dict(target) if isinstance(target, dict) else {}
+    for name, value in patch.items():
+        if value is None:
+            patched.pop(name, None)
+        else:
+            patched[name] = merge_patch(patched.get(name), value)
+    return patched
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def increment_from_request():
+    """ the amount to increment by, from the by parameter """
+    by = request.values.get('by', '1')
+    try:
+        return int(by)
+    except ValueError:
+        pass
+    try:
+        by = float(by)
+    except ValueError:
+        raise BadRequest("by must be a number")
+    if not math.isfinite(by):
+        raise BadRequest("by must be a finite number")
+    return by
+
+def read_it(key, stream=False):
+    """ returns a tuple of (content_type, body, key, metadata), if stream is True
+        the body of a large value may be a StreamedBody
+    """
+    found, cached = read_cache.get(key)
+    metrics.inc(CACHE_LOOKUPS, cache='read', result='hit' if found else 'miss')
+    if found:
+        return unexpired(cached)
+    generation = read_cache.generation(key)
+    content_type, body, file_path, metadata = unexpired(read_from_storage(key, stream, generation))
+    if isinstance(body, StreamedBody):
+        # too big to be worth caching
+        pass
+    elif body is None:
+        read_cache.set(key, (None, None, None, None), len(key), ttl_seconds=read_cache_negative_ttl, generation=generation)
+    else:
+        read_cache.set(key, (content_type, body, file_path, metadata), len(key) + len(body),
+            ttl_seconds=cache_ttl_for(metadata), generation=generation)
+    return content_type, body, file_path, metadata
+
+def read_from_storage(key, stream, generation):
+    """ reads the key from storage, or waits for a read of it that's already in
+        progress.  Only reads that started at the same generation of the key in
+        the read cache are shared, so a read never sees a value from before a
+        write made by this worker that it comes after
+    """
+    if coalesce_reads != 'True':
+        return get_storage().read(key, stream=stream)
+    result, shared = read_flights.do((key, stream, generation), lambda: get_storage().read(key, stream=stream),
+        share=shared_stream)
+    metrics.inc(COALESCED_READS, result='joined' if shared else 'led')
+    if isinstance(result[1], SharedStream):
+        # a stream can only be sent to one client, so each has a reader of its own
+        result = (result[0], result[1].reader()) + tuple(result[2:])
+    return result
+
+def shared_stream(result, readers):
+    """ the result of a read handed to more than one request, a streamed body is
+        read from storage once and spooled for each of them
+    """
+    if isinstance(result[1], StreamedBody):
+        return (result[0], SharedStream(result[1], readers)) + tuple(result[2:])
+    return result
+
+def read_many_from_storage(keys, generations):
+    """ reads the keys from storage all at once, other than those that are
+        already being read which are waited for instead, see read_from_storage.
+        generations is a dictionary of key -> its generation in the read cache.
+        Returns a dictionary of key -> (content_type, body, key, metadata) for the
+        keys that have data
+    """
+    if coalesce_reads != 'True':
+        return get_storage().read_many(keys)
+
+    def fetch_many(flight_keys):
+        fetched = get_storage().read_many([flight_key[0] for flight_key in flight_keys])
+        return dict((flight_key, fetched.get(flight_key[0], (None, None, None, None))) for flight_key in flight_keys)
+
+    results = read_flights.do_many([(key, False, generations[key]) for key in keys], fetch_many)
+    joined = len([shared for result, shared in results.values() if shared])
+    metrics.inc(COALESCED_READS, len(results) - joined, result='led')
+    metrics.inc(COALESCED_READS, joined, result='joined')
+    return dict((flight_key[0], result) for flight_key, (result, shared) in results.items() if result[1] is not None)
+
+def read_metadata_it(key):
+    """ returns a tuple of (content_type, metadata) for the key, reading the body
+        from storage only if it's already cached
+    """
+    found, cached = read_cache.get(key)
+    metrics.inc(CACHE_LOOKUPS, cache='read', result='hit' if found else 'miss')
+    if found and not is_expired(cached[3]):
+        return cached[0], cached[3]
+    content_type, metadata = get_storage().read_metadata(key)
+    if is_expired(metadata):
+        return None, None
+    return content_type, metadata
+
+def read_many_it(keys):
+    """ returns a dictionary of key -> (content_type, body, key, metadata) for all
+        of the keys that have data, fetching everything not in the read cache at once
+    """
+    found = {}
+    misses = []
+    for key in keys:
+        cached_found, cached = read_cache.get(key)
+        if not cached_found:
+            misses.append(key)
+        elif cached[1] is not None and not is_expired(cached[3]):
+            found[key] = cached
+    metrics.inc(CACHE_LOOKUPS, len(keys) - len(misses), cache='read', result='hit')
+    metrics.inc(CACHE_LOOKUPS, len(misses), cache='read', result='miss')
+    if misses:
+        generations = dict((key, read_cache.generation(key)) for key in misses)
+        fetched = read_many_from_storage(misses, generations)
+        for key in misses:
+            if key in fetched and not is_expired(fetched[key][3]):
+                content_type, body, file_path, metadata = fetched[key]
+                read_cache.set(key, fetched[key], len(key) + len(body), ttl_seconds=cache_ttl_for(metadata),
+                    generation=generations[key])
+                found[key] = fetched[key]
+            else:
+                read_cache.set(key, (None, None, None, None), len(key), ttl_seconds=read_cache_negative_ttl,
+                    generation=generations[key])
+    return found
+
+def is_not_modified(metadata):
+    """ checks the conditional headers of the request against the metadata of the
+        stored value
+    """
+    if request.if_none_match:
+        # when If-None-Match is provided If-Modified-Since is to be ignored
+        etag = metadata.get('etag')
+        return bool(etag) and request.if_none_match.contains_weak(etag)
+    last_modified = metadata.get('last-modified')
+    if request.if_modified_since and last_modified is not None:
+        return int(last_modified) <= calendar.timegm(request.if_modified_since.utctimetuple())
+    return False
 
-        return None, None, None
+def cache_headers_for(metadata, validators=True):
+    headers = {}
+    if validators and metadata.get('etag'):
+        # the etag is of the body as stored, so it's only a weak match for a
+        # body we've had to decompress
+        etag = '"%s"' % (metadata['etag'])
+        headers['ETag'] = etag if accepts_stored_encoding(metadata) else 'W/%s' % (etag)
+    if validators and metadata.get('last-modified') is not None:
+        headers['Last-Modified'] = http_date(int(metadata['last-modified']))
+    cache_control = metadata.get('cache-control') or default_cache_control
+    if cache_control:
+        headers['Cache-Control'] = cache_control
+    if metadata.get('content-encoding'):
+        headers['Vary'] = 'Accept-Encoding'
+    return headers
 
 def delete_it(key):
-    ddb_kvstore.delete_item(path=get_storage_path_for(key))
+    get_storage().delete(key)
+    invalidate_cached(key)
+    emit_local_message(DELETE_EVENT_SOURCE, dict(key=key))
+
+def delete_if_it(key, expected):
+    """ deletes the value only if it has the expected metadata, returning False
+        if it doesn't
+    """
+    if not get_storage().delete_if(key, expected):
+        return False
+    invalidate_cached(key)
+    emit_local_message(DELETE_EVENT_SOURCE, dict(key=key))
+    return True
+
+def is_conditional():
+    return bool(request.if_match or request.if_none_match)
+
+def check_preconditions(key):
+    """ checks the If-Match and If-None-Match headers of the request against what's
+        stored by the key.  Returns whether they're met, along with the metadata
+        of what's stored for the change to be made conditional on, so it's only
+        made if nothing has changed since they were checked
+    """
+    # straight from storage, a cached value may already have been replaced
+    content_type, metadata = get_storage().read_metadata(key)
+    current = None if is_expired(metadata) else metadata
+    etag = current.get('etag') if current else None
+    if request.if_match and not (current and (request.if_match.star_tag or request.if_match.contains(etag))):
+        return False, metadata
+    if request.if_none_match and current and (request.if_none_match.star_tag or request.if_none_match.contains_weak(etag)):
+        return False, metadata
+    return True, metadata
 
 @app.route("/<path:key>", methods=["OPTIONS"])
 def pyserver_core_keyvalue_handlers_options_handler(key=None):
@@ -87,12 +600,40 @@ def pyserver_core_keyvalue_handlers_store_data(key=None):
         specified key.  The data stored includes the content type information of the request
         so on fetch the content type will be set as it was when the data was stored.
 
+        :reqheader X-Cache-Control: the Cache-Control header to send when the data is fetched
+        :reqheader X-TTL: the number of seconds to keep the data for, it can also be
+            provided as the ttl parameter
+        :reqheader If-Match: only store the data if the ETag of the stored data is one of these
+        :reqheader If-None-Match: only store the data if the ETag of the stored data isn't
+            one of these, * to only store it if nothing is stored
         :statuscode 200: provided data has been successfully stored by the given key
+        :statuscode 400: the ttl provided isn't a positive whole number
+        :statuscode 412: the stored data doesn't meet If-Match or If-None-Match
     """
     store_this_content_type = request.content_type
     store_this = None
+    metadata = {}
+    if request.headers.get('X-Cache-Control'):
+        # sent back as the Cache-Control header whenever the value is fetched
+        metadata['cache-control'] = request.headers['X-Cache-Control']
+    ttl = ttl_from_request()
+    if ttl:
+        metadata['expires'] = int(time.time()) + ttl
+    conditional = is_conditional()
+    if conditional:
+        met, expected = check_preconditions(key)
+        if not met:
+            return dict(message="precondition failed", status_code=412)
+
+    # conditional writes need the whole of the value to hand
+    if (not conditional and request.content_length and request.content_length > stream_threshold
+            and not request.is_json and request.mimetype not in FORM_CONTENT_TYPES):
+        store_stream_it(key, request.stream, store_this_content_type, request.content_length, metadata=metadata)
+        return {"message": "ok"}
+
     if request.json:
-        store_this = json.dumps(request.json)
+        with metrics.timer(OPERATION_DURATION, operation='json_encode'):
+            store_this = serialization.dumps(request.json)
     elif request.data:
         store_this = request.data
 
@@ -100,26 +641,117 @@ def pyserver_core_keyvalue_handlers_store_data(key=None):
         # for form data we're going to conveniently store it as a json
         # blob, so it can be easily parsed when retrieved
         data = request.values.to_dict(flat=False)
-        store_this = convert_types_in_dictionary(remove_single_element_lists(data))
-        store_this = json.dumps(store_this)
+        with metrics.timer(OPERATION_DURATION, operation='convert_types'):
+            store_this = convert_types_in_dictionary(remove_single_element_lists(data))
+        store_this = serialization.dumps(store_this)
         store_this_content_type = 'application/json'
 
-    store_it(key, store_this, content_type=store_this_content_type)
+    if conditional:
+        if not store_if_it(key, store_this, store_this_content_type, metadata, expected=expected):
+            return dict(message="precondition failed", status_code=412)
+    else:
+        store_it(key, store_this, content_type=store_this_content_type, metadata=metadata)
 
     return {"message": "ok"}
 
+@app.route("/<path:key>", methods=["PATCH"])
+@make_my_response_json
+def pyserver_core_keyvalue_handlers_patch_data_for(key=None):
+    """
+        Applies the JSON merge patch (RFC 7386) in the body of the request to the JSON
+        stored by the key, without the rest of the value being sent either way.  If
+        nothing is stored the patch is applied to an empty object.  The patch is only
+        stored if the value hasn't been changed by someone else in the meantime, so
+        concurrent patches don't lose each other's changes.  If the value keeps
+        being changed the patch is given up on with a 409, and it's up to the
+        client to send it again.
+
+        :statuscode 200: the patch has been applied
+        :statuscode 400: the patch, or the value stored, isn't JSON
+        :statuscode 409: the value kept being changed by others, so the patch wasn't applied
+    """
+    if not request.is_json:
+        raise BadRequest("the patch must be JSON")
+    patch = request.json
+
+    def patched(content_type, body):
+        with metrics.timer(OPERATION_DURATION, operation='json_encode'):
+            return serialization.dumps(merge_patch(stored_json(content_type, body), patch)), 'application/json'
+
+    if not update_it(key, patched):
+        return dict(message="the value kept changing, unable to patch it", status_code=409)
+    return dict(message="ok")
+
+@app.route("/__increment__/<path:key>", methods=["POST"])
+@make_my_response_json
+def pyserver_core_keyvalue_handlers_increment(key=None):
+    """
+        Adds to the number stored by the key, or to the named field of the JSON object
+        stored by the key.  Anything missing starts from 0.  An increment is only
+        stored if the value hasn't been changed in the meantime, so it never
+        overwrites another.  If the value keeps being changed the increment is
+        given up on with a 409, without being counted, and it's up to the client
+        to send it again.
+
+        :param by: the amount to add, 1 unless provided
+        :param field: the field of the stored JSON object to add to
+        :statuscode 200: the number has been incremented, the response includes its new value
+        :statuscode 400: by isn't a number, or what's stored isn't one
+        :statuscode 409: the value kept being changed by others, so it wasn't incremented
+    """
+    by = increment_from_request()
+    field = request.values.get('field', None)
+    result = {}
+
+    def incremented(content_type, body):
+        value = stored_json(content_type, body)
+        if field is not None:
+            value = value if value is not None else {}
+            if not isinstance(value, dict):
+                raise BadRequest("the value stored isn't a JSON object")
+            current = value.get(field, 0)
+        else:
+            current = value if value is not None else 0
+        if not is_number(current):
+            raise BadRequest("the value stored isn't a number")
+        result['value'] = current + by
+        if field is not None:
+            value = dict(value)
+            value[field] = result['value']
+        else:
+            value = result['value']
+        return serialization.dumps(value), 'application/json'
+
+    if not update_it(key, incremented):
+        return dict(message="the value kept changing, unable to increment it", status_code=409)
+    return dict(message="ok", value=result['value'])
+
 @app.route("/<path:key>", methods=["GET"])
 def pyserver_core_keyvalue_handlers_get_data_for(key=None):
     """
-        For a given key return the data stored, if any.
+        For a given key return the data stored, if any.  Responses include an ETag
+        and Last-Modified so clients can make conditional requests.
 
         :statuscode 200: data found, and returned
+        :statuscode 304: data has not changed since the If-None-Match or If-Modified-Since provided
         :statuscode 404: no stored data found for provided key
     """
 
     return404 = request.values.get("return404", None)
-    content_type, value, file_path = read_it(key)
     callback = request.values.get("callback", None)
+    if not callback and (request.if_none_match or request.if_modified_since):
+        # we can answer a conditional request from the metadata alone
+        content_type, metadata = read_metadata_it(key)
+        if metadata and is_not_modified(metadata):
+            return ("", 304, cache_headers_for(metadata))
+
+    content_type, value, file_path, metadata = read_it(key, stream=True)
+    # compressed values are sent as they're stored to anyone that accepts them
+    pass_through = value and not callback and metadata and accepts_stored_encoding(metadata)
+    if value and not pass_through:
+        value = decompressed(value, metadata)
+    if isinstance(value, bytes) and callback:
+        value = value.decode('utf-8')
     if not value:
         if callback:
             # this is specifically to handle the (most common) use case of JSONP blowing
@@ -130,15 +762,46 @@ def pyserver_core_keyvalue_handlers_get_data_for(key=None):
             response = json_response(**dict(message="no data for key"))
         else:
             response = json_response(**dict(message="no data for key", status_code=404))
+    elif isinstance(value, StreamedBody):
+        response = streamed_response(value, content_type, callback)
     else:
         if callback:
             response = ("%s(%s);" % (callback, value), 200, {"Content-Type": "application/javascript"})
         else:
             response = (value, 200, {"Content-Type": content_type })
 
+    if value:
+        response[2].update(cache_headers_for(metadata, validators=not callback))
+        if pass_through and metadata.get('content-encoding'):
+            response[2]['Content-Encoding'] = metadata['content-encoding']
     response[2]['X-File-Path'] = file_path
     return response
 
+def streamed_response(body, content_type, callback=None):
+    """ creates a response that sends the body a chunk at a time as it's read from
+        storage, wrapping it in the callback if provided
+    """
+    headers = {}
+    if callback:
+        def wrap_in_callback():
+            yield ("%s(" % (callback)).encode('utf-8')
+            for chunk in body:
+                yield chunk
+            yield b");"
+        chunks = StreamedBody(wrap_in_callback(), on_close=body.close)
+        content_type = "application/javascript"
+    else:
+        chunks = body
+        if body.file is not None:
+            # the server can send it from the file without it being read in here
+            chunks = wrap_file(request.environ, body.file, STREAM_CHUNK_SIZE)
+        if body.size is not None:
+            headers['Content-Length'] = str(body.size)
+    # the content type is given to the response directly as flask would add the
+    # headers alongside the default content type rather than replacing it
+    response = app.response_class(chunks, content_type=content_type, direct_passthrough=True)
+    return (response, 200, headers)
+
 
 @app.route("/__multikey__/<path:keys>", methods=["GET"])
 def pyserver_core_keyvalue_handlers_get_data_for_multi(keys=None):
@@ -150,19 +813,32 @@ def pyserver_core_keyvalue_handlers_get_data_for_multi(keys=None):
     """
     keys = keys.split('/')
 
+    found = read_many_it(keys)
+    found = [(key,) + found[key] for key in dict.fromkeys(keys) if key in found and found[key][1]]
+    # the response takes the content type of the last value found
+    first_content_type = found[-1][1] if found else None
+
     values = {}
-    first_content_type = None
-    for key in keys:
-        content_type, value, file_path = read_it(key)
-        if value:
+    if first_content_type and first_content_type == 'application/json':
+        # JSON values are spliced into the response as they're stored, everything
+        # else is encoded as a JSON string
+        spliced = []
+        for key, content_type, value, file_path, metadata in found:
+            value = decompressed(value, metadata)
+            if isinstance(value, bytes):
+                value = value.decode('utf-8')
+            if content_type != 'application/json':
+                value = serialization.dumps(value)
+            spliced.append((key, value))
+        with metrics.timer(OPERATION_DURATION, operation='json_encode'):
+            values = serialization.splice_object(spliced)
+    else:
+        for key, content_type, value, file_path, metadata in found:
+            value = decompressed(value, metadata)
             if content_type == 'application/json':
-                value = json.loads(value)
-            first_content_type = content_type
+                value = serialization.loads(value)
             values[key] = value
 
-    if first_content_type and first_content_type == 'application/json':
-        values = json.dumps(values)
-
     return404 = request.values.get("return404", None)
     callback = request.values.get("callback", None)
     if not values:
@@ -187,26 +863,252 @@ def pyserver_core_keyvalue_handlers_get_data_for_multi(keys=None):
 @make_my_response_json
 def pyserver_core_keyvalue_handlers_store_data_multi():
     """
-        Only stores JSON.
+        Only stores JSON.  The response includes a result for each key stored.
 
+        :reqheader X-TTL: the number of seconds to keep the data for, it can also be
+            provided as the ttl parameter
         :statuscode 200: provided data has been successfully stored by the given key
+        :statuscode 400: the ttl provided isn't a positive whole number
+        :statuscode 500: some of the keys could not be stored, see the results
     """
+    metadata = None
+    ttl = ttl_from_request()
+    if ttl:
+        metadata = dict(expires=int(time.time()) + ttl)
 
     if request.content_type == 'application/json':
-        for key in request.json:
-            store_this = json.dumps(request.json[key])
-            store_it(key, store_this, content_type='application/json')
+        items = [(key, serialization.dumps(value), 'application/json') for key, value in request.json.items()]
     else:
-        for key in request.values:
-            store_it(key, request.values[key], content_type=request.content_type)
+        items = [(key, request.values[key], request.content_type) for key in request.values]
 
-    return dict(message="ok")
+    results = store_many_it(items, metadata)
+    failed = [key for key, error in results.items() if error]
+    results = dict((key, error or "ok") for key, error in results.items())
+    if failed:
+        return dict(message="unable to store %s of %s keys" % (len(failed), len(results)), results=results, status_code=500)
+    return dict(message="ok", results=results)
+
+@app.route("/__keys__", methods=["GET"])
+@make_my_response_json
+def pyserver_core_keyvalue_handlers_list_keys():
+    """
+        Lists the stored keys that start with a prefix in order, a page at a time.
+        Responses include next when there are more keys, pass it as after to get
+        the next page.
+
+        :param prefix: only keys that start with this are listed
+        :param after: keys are listed from the first one after this
+        :param limit: the most keys to list, 100 unless provided
+        :statuscode 200: the keys found
+        :statuscode 400: the limit provided isn't a number
+    """
+    prefix = request.values.get('prefix', '')
+    after = request.values.get('after', None)
+    try:
+        limit = min(max(int(request.values.get('limit', 100)), 1), max_list_limit)
+    except ValueError:
+        raise BadRequest("limit must be a number")
+    # one more than asked for tells us if there's another page.  Values that have
+    # expired are left out, though the reaper may not have deleted them yet
+    keys = []
+    while len(keys) <= limit:
+        wanted = limit + 1 - len(keys)
+        listed = get_storage().list_keys(prefix, start_after=after, limit=wanted)
+        keys.extend(get_storage().unexpired_keys(listed))
+        if len(listed) < wanted:
+            break
+        after = listed[-1]
+    next_key = keys[limit - 1] if len(keys) > limit else None
+    return dict(keys=keys[:limit], next=next_key)
+
+def export_line(key, content_type, body, metadata):
+    """ the NDJSON line describing the stored value, a body that isn't a string
+        is base64 encoded.  Bodies are exported as they're stored, so compressed
+        ones stay compressed
+    """
+    item = dict(key=key, content_type=content_type, metadata=metadata)
+    if isinstance(body, str):
+        item['body'] = body
+    else:
+        item['body'] = base64.b64encode(body).decode('ascii')
+        item['encoding'] = 'base64'
+    return ('%s\n' % (serialization.dumps(item))).encode('utf-8')
+
+def exported_lines(prefix, after, limit):
+    """ yields a line for each unexpired value, a page of keys at a time, ending
+        with a line giving the key to export from next or null once there are
+        no more
+    """
+    listed = 0
+    while limit is None or listed < limit:
+        page_size = export_page_size if limit is None else min(export_page_size, limit - listed)
+        keys = get_storage().list_keys(prefix, start_after=after, limit=page_size)
+        if not keys:
+            yield ('%s\n' % (serialization.dumps(dict(next=None)))).encode('utf-8')
+            return
+        # straight from storage, so the export doesn't push everything else out
+        # of the read cache
+        found = get_storage().read_many(keys)
+        for key in keys:
+            if key in found and not is_expired(found[key][3]):
+                content_type, body, file_path, metadata = found[key]
+                yield export_line(key, content_type, body, metadata)
+        listed += len(keys)
+        after = keys[-1]
+    yield ('%s\n' % (serialization.dumps(dict(next=after)))).encode('utf-8')
+
+@app.route("/__export__", methods=["GET"])
+def pyserver_core_keyvalue_handlers_export():
+    """
+        Streams every stored value as NDJSON, in key order, a line of key,
+        content_type, body and metadata for each.  Bodies that aren't text are
+        base64 encoded, and have an encoding of base64.  The last line gives
+        next, the key to pass as after to carry on from, which is null once
+        everything has been exported.  An export that's cut short can be carried
+        on from the key of the last line received.
+
+        :param prefix: only keys that start with this are exported
+        :param after: keys are exported from the first one after this
+        :param limit: the most keys to export, everything unless provided
+        :statuscode 200: the values, as NDJSON
+        :statuscode 400: the limit provided isn't a number
+    """
+    prefix = request.values.get('prefix', '')
+    after = request.values.get('after', None)
+    limit = request.values.get('limit', None)
+    try:
+        limit = max(int(limit), 1) if limit is not None else None
+    except ValueError:
+        return json_response(**dict(message="limit must be a number", status_code=400))
+    response = app.response_class(exported_lines(prefix, after, limit), 200, {"Cache-Control": "no-cache"})
+    response.headers['Content-Type'] = 'application/x-ndjson'
+    return response
+
+class ImportLineTooLong(Exception):
+    pass
+
+def import_lines(stream):
+    """ yields the number and content of each line of the stream that isn't
+        blank, reading a line at a time
+    """
+    number = 0
+    while True:
+        line = stream.readline(import_max_line_bytes + 1)
+        if not line:
+            return
+        number += 1
+        if len(line) > import_max_line_bytes and not line.endswith(b'\n'):
+            raise ImportLineTooLong("line %s is longer than %s bytes" % (number, import_max_line_bytes))
+        line = line.strip()
+        if line:
+            yield number, line
+
+def imported_item(item, now):
+    """ the (key, data, content_type, metadata) to store for an item read from
+        a line of an export, or None if the value has expired since
+    """
+    key, body = item['key'], item['body']
+    if not isinstance(key, str) or not key or not isinstance(body, str):
+        raise ValueError("key and body must be strings")
+    if item.get('encoding') == 'base64':
+        body = base64.b64decode(body, validate=True)
+    elif item.get('encoding') is not None:
+        raise ValueError("unsupported encoding %s" % (item['encoding']))
+    metadata = dict((name, value) for name, value in (item.get('metadata') or {}).items()
+        if name in IMPORTED_METADATA and value is not None)
+    encoding = metadata.get('content-encoding')
+    if encoding:
+        # stored as it is, so it has to be something that can be decompressed
+        if encoding not in supported_encodings():
+            raise ValueError("unsupported content-encoding %s" % (encoding))
+        if not isinstance(body, bytes):
+            raise ValueError("a body with a content-encoding must be base64 encoded")
+    if is_expired(metadata, now):
+        return None
+    return key, body, item.get('content_type') or 'application/octet-stream', metadata or None
+
+@app.route("/__import__", methods=["POST"])
+@make_my_response_json
+def pyserver_core_keyvalue_handlers_import():
+    """
+        Stores the values of an NDJSON stream, as written by /__export__, in
+        batches as the stream is read.  Values keep their content type, and
+        their cache-control, content-encoding and expiry, anything that has
+        expired since it was exported is skipped.  A compressed body is stored
+        as it is, so it must be base64 encoded and compressed with an encoding
+        this server supports.
+
+        :statuscode 200: everything was imported, or skipped as it had expired
+        :statuscode 400: some lines weren't values that could be imported, or a
+            line was too long, in which case nothing after it was read
+        :statuscode 500: some of the values couldn't be stored
+    """
+    now = time.time()
+    counts = dict(imported=0, skipped=0, invalid=0, failed=0)
+    failures = {}
+    batch = []
+    batch_bytes = [0]
+
+    def store_batch():
+        for key, error in store_items_it(batch).items():
+            if error:
+                counts['failed'] += 1
+                if len(failures) < MAX_IMPORT_FAILURES:
+                    failures[key] = error
+            else:
+                counts['imported'] += 1
+        del batch[:]
+        batch_bytes[0] = 0
+
+    too_long = None
+    try:
+        for number, line in import_lines(request.stream):
+            try:
+                item = serialization.loads(line)
+                if isinstance(item, dict) and 'next' in item and 'key' not in item:
+                    # where the export ended, rather than a value
+                    continue
+                item = imported_item(item, now)
+            except (ValueError, KeyError, TypeError, binascii.Error) as e:
+                counts['invalid'] += 1
+                if len(failures) < MAX_IMPORT_FAILURES:
+                    failures['line %s' % (number)] = str(e)
+                continue
+            if item is None:
+                counts['skipped'] += 1
+                continue
+            batch.append(item)
+            batch_bytes[0] += len(item[1])
+            if len(batch) >= import_batch_size or batch_bytes[0] >= import_batch_bytes:
+                store_batch()
+    except ImportLineTooLong as e:
+        too_long = str(e)
+    if batch:
+        store_batch()
+
+    response = dict(counts, failures=failures, message="ok")
+    if counts['failed']:
+        response.update(message="unable to store %s values" % (counts['failed']), status_code=500)
+    elif too_long:
+        response.update(message=too_long, status_code=400)
+    elif counts['invalid']:
+        response.update(message="unable to import %s lines" % (counts['invalid']), status_code=400)
+    return response
 
 @app.route("/<path:key>", methods=["DELETE"])
 @make_my_response_json
 def pyserver_core_keyvalue_handlers_delete_data_for(key):
     """
         Removes all stored data for a given key.
+
+        :reqheader If-Match: only remove the data if its ETag is one of these
+        :statuscode 200: the data has been removed
+        :statuscode 412: the stored data doesn't meet If-Match or If-None-Match
     """
+    if is_conditional():
+        met, expected = check_preconditions(key)
+        if not met or not delete_if_it(key, expected):
+            return dict(message="precondition failed", status_code=412)
+        return dict(message="ok")
     delete_it(key)
     return dict(message="ok")
@@ -0,0 +1,9 @@
+""" gunicorn server hooks, loaded by the start script with
+    --config python:server.gunicorn_config
+"""
+
+def post_worker_init(worker):
+    # the connections to storage are made by each worker, once it's been forked,
+    # before it takes its first request
+    from server.core_handlers import keyvalue_handlers
+    keyvalue_handlers.warm_up()
@@ -1,12 +1,154 @@
+import os
 import sys
+import atexit
+import logging
+import threading
+from collections import deque
 
 LOCAL_PUBLISH=1
 
+# what to do with a message when the queue is full: block until there's room for
+# it, drop_oldest to make room by dropping the oldest queued message, or
+# drop_new to drop the message being sent
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+DROP_NEW = 'drop_new'
+OVERFLOW_POLICIES = (BLOCK, DROP_OLDEST, DROP_NEW)
+
+queue_size = int(os.environ.get('MESSAGES_QUEUE_SIZE', 10000))
+batch_size = int(os.environ.get('MESSAGES_BATCH_SIZE', 100))
+overflow_policy = os.environ.get('MESSAGES_OVERFLOW', BLOCK)
+if overflow_policy not in OVERFLOW_POLICIES:
+    logging.warning("Unsupported overflow policy %s, sending messages will block when the queue is full" % (overflow_policy))
+    overflow_policy = BLOCK
+# how long a worker that's exiting waits for queued messages to be written, a
+# stream that isn't being read would otherwise keep it from ever exiting
+shutdown_seconds = float(os.environ.get('MESSAGES_SHUTDOWN_SECONDS', 5))
+
+class Publisher(object):
+    """ Writes messages to a stream from a background thread, so a slow reader of
+        the stream doesn't slow down the requests sending them.  Messages are
+        queued, up to max_queued of them, and written batch_size at a time with
+        a single flush per batch.
+    """
+
+    def __init__(self, stream=None, max_queued=10000, batch_size=100, overflow=BLOCK):
+        if overflow not in OVERFLOW_POLICIES:
+            raise Exception("Unsupported overflow policy: %s" % (overflow))
+        # stdout is looked up as each batch is written, unless a stream is provided
+        self.stream = stream
+        self.max_queued = max_queued
+        self.batch_size = batch_size
+        self.overflow = overflow
+        self.queue = deque()
+        self.condition = threading.Condition()
+        # messages taken from the queue that are still being written
+        self.writing = 0
+        self.closed = False
+        self.thread = None
+        self.pid = None
+        self.published = 0
+        self.dropped = 0
+        self.batches = 0
+        self.errors = 0
+
+    def publish(self, message):
+        """ queues the message to be written, returning False if it was dropped """
+        with self.condition:
+            if self.closed:
+                raise Exception("Unable to publish to a closed publisher")
+            self.start()
+            while len(self.queue) >= self.max_queued:
+                if self.overflow == DROP_NEW:
+                    self.dropped += 1
+                    return False
+                elif self.overflow == DROP_OLDEST:
+                    self.queue.popleft()
+                    self.dropped += 1
+                else:
+                    self.condition.wait()
+                    if self.closed:
+                        raise Exception("Unable to publish to a closed publisher")
+            self.queue.append(message)
+            self.condition.notify_all()
+            return True
+
+    def start(self):
+        # a forked worker doesn't inherit the thread of its parent
+        if self.thread is None or self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.run, name='message-publisher')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+                self.writing = len(batch)
+                # there's room in the queue for anyone that was blocked
+                self.condition.notify_all()
+            written = False
+            try:
+                self.write(batch)
+                written = True
+            except Exception:
+                logging.exception("unable to write %s messages", len(batch))
+            with self.condition:
+                self.writing = 0
+                if written:
+                    self.published += len(batch)
+                    self.batches += 1
+                else:
+                    self.errors += 1
+                self.condition.notify_all()
+
+    def write(self, batch):
+        stream = self.stream or sys.stdout
+        stream.write("".join("%s\n" % (message) for message in batch))
+        stream.flush()
+
+    def flush(self, timeout=None):
+        """ waits for everything queued to be written, returning False if it
+            wasn't within the timeout
+        """
+        with self.condition:
+            if self.thread is None:
+                return True
+            return self.condition.wait_for(lambda: not self.queue and not self.writing, timeout)
+
+    def close(self, timeout=None):
+        """ writes whatever is still queued and stops the publisher, returning
+            False if that wasn't done within the timeout
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+            thread = self.thread if self.pid == os.getpid() else None
+        if thread:
+            thread.join(timeout)
+            if thread.is_alive():
+                with self.condition:
+                    logging.warning("gave up writing %s messages after %ss", len(self.queue) + self.writing, timeout)
+                return False
+        return True
+
+    def stats(self):
+        with self.condition:
+            return dict(queued=len(self.queue), published=self.published, dropped=self.dropped,
+                batches=self.batches, errors=self.errors)
+
+publisher = Publisher(max_queued=queue_size, batch_size=batch_size, overflow=overflow_policy)
+atexit.register(lambda: publisher.close(timeout=shutdown_seconds))
+
 def send(message, message_type=LOCAL_PUBLISH):
     if not message_type == LOCAL_PUBLISH:
         raise Exception("Unsupported message type")
     # messages go to stdout, the assumption is that normal messages
-    # as opposed to error, logging, etc. go to stdout and the 
+    # as opposed to error, logging, etc. go to stdout and the
     # rest end up on stderr
-    sys.stdout.write("%s\n" % message)
-    sys.stdout.flush()
+    publisher.publish(message)
@@ -0,0 +1,308 @@
+""" Counters, gauges and histograms describing where the time goes in serving a
+    request, exposed in the Prometheus text format by /metrics.
+
+    Each worker keeps its metrics in memory.  If KVSTORE_METRICS_DIR is set, at
+    most every KVSTORE_METRICS_FLUSH_SECONDS it writes a snapshot of them to a
+    file of its own there, and /metrics adds up the snapshots of every worker on
+    the host so it doesn't matter which worker answers.  The counters of workers
+    that have gone away are folded into a single file, so the directory doesn't
+    grow as workers are replaced.  The directory is best kept somewhere memory
+    backed like /dev/shm, and cleared before the workers start, see start.
+    Without it /metrics only reports the worker that answers.
+"""
+import os
+import json
+import time
+import fcntl
+import atexit
+import errno
+import logging
+import tempfile
+import threading
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1024, 10 * 1024, 100 * 1024, 400 * 1024, 1024 * 1024, 10 * 1024 * 1024, 100 * 1024 * 1024)
+
+# the file, in the metrics directory, the counters and histograms of processes
+# that have gone away are added up in, and the lock on folding them into it
+RETIRED_FILE_NAME = 'retired.json'
+RETIRING_LOCK_NAME = '.retiring.lock'
+
+metrics_dir = os.environ.get('KVSTORE_METRICS_DIR', None)
+metrics_flush_seconds = float(os.environ.get('KVSTORE_METRICS_FLUSH_SECONDS', 1))
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+def format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % (','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels))
+
+def add_up(totals, snapshot, definitions, include_gauges=True):
+    """ adds the values of the snapshot to the totals, (name, labels) -> value """
+    for name, labels, value in snapshot:
+        if name not in definitions:
+            continue
+        kind = definitions[name][0]
+        if kind == GAUGE and not include_gauges:
+            continue
+        key = (name, tuple(tuple(label) for label in labels))
+        if kind == HISTOGRAM:
+            total = totals.setdefault(key, [0] * len(value))
+            for index, amount in enumerate(value):
+                total[index] += amount
+        else:
+            totals[key] = totals.get(key, 0) + value
+
+class Timer(object):
+    """ observes how long the with block it's used in took """
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.started, **self.labels)
+
+class Metrics(object):
+    """ A registry of metrics, each is defined once and then updated with the
+        labels that apply
+    """
+
+    def __init__(self, directory=None, flush_seconds=1):
+        self.directory = directory
+        self.flush_seconds = flush_seconds
+        self.definitions = {}
+        # (name, labels) -> a number, or for histograms a list of the count of
+        # each bucket followed by the sum and count of everything observed
+        self.values = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.last_flush = 0
+        self.pid = None
+
+    def define(self, name, kind, description, buckets=None):
+        self.definitions[name] = (kind, description, buckets)
+
+    def inc(self, name, amount=1, **labels):
+        self.update(name, amount, labels)
+
+    def add(self, name, amount, **labels):
+        """ moves a gauge up or down by amount """
+        self.update(name, amount, labels)
+
+    def observe(self, name, value, **labels):
+        self.update(name, value, labels)
+
+    def timer(self, name, **labels):
+        return Timer(self, name, labels)
+
+    def update(self, name, amount, labels):
+        kind, description, buckets = self.definitions[name]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if kind == HISTOGRAM:
+                value = self.values.get(key)
+                if value is None:
+                    value = self.values[key] = [0] * (len(buckets) + 2)
+                for index, bucket in enumerate(buckets):
+                    if amount <= bucket:
+                        value[index] += 1
+                        break
+                value[-2] += amount
+                value[-1] += 1
+            else:
+                self.values[key] = self.values.get(key, 0) + amount
+        if self.directory and time.time() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def snapshot(self):
+        with self.lock:
+            return [[name, list(labels), value if not isinstance(value, list) else list(value)]
+                for (name, labels), value in self.values.items()]
+
+    def file_path(self):
+        return os.path.join(self.directory, '%s.json' % (os.getpid()))
+
+    def flush(self):
+        """ writes a snapshot of this process's metrics for /metrics to find, only
+            one thread flushes at a time and the others carry on without waiting
+        """
+        if not self.flush_lock.acquire(False):
+            return
+        try:
+            self.last_flush = time.time()
+            if self.pid != os.getpid():
+                # a forked worker starts out with the metrics of its parent
+                if self.pid is not None:
+                    with self.lock:
+                        self.values = {}
+                self.pid = os.getpid()
+            os.makedirs(self.directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+            try:
+                with os.fdopen(fd, 'w') as temp_file:
+                    json.dump(self.snapshot(), temp_file)
+                os.replace(temp_path, self.file_path())
+            except:
+                os.unlink(temp_path)
+                raise
+        except (IOError, OSError):
+            logging.exception("unable to write metrics to %s", self.directory)
+        finally:
+            self.flush_lock.release()
+
+    def snapshot_pids(self):
+        """ the pids of the processes with a snapshot in the directory """
+        try:
+            file_names = os.listdir(self.directory)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+        return [int(file_name[:-len('.json')]) for file_name in file_names
+            if file_name.endswith('.json') and file_name[:-len('.json')].isdigit()]
+
+    def read_json(self, file_name, default=None):
+        try:
+            with open(os.path.join(self.directory, file_name)) as json_file:
+                return json.load(json_file)
+        except (IOError, OSError, ValueError):
+            logging.debug("unable to read metrics from %s", file_name)
+            return default
+
+    def snapshots(self):
+        """ yields the pid and snapshot of each process, including this one, and
+            None with what's been kept of those that have gone away
+        """
+        if not self.directory:
+            yield os.getpid(), self.snapshot()
+            return
+        self.flush()
+        self.retire()
+        for pid in self.snapshot_pids():
+            snapshot = self.read_json('%s.json' % (pid))
+            if snapshot is not None:
+                yield pid, snapshot
+        retired = self.read_json(RETIRED_FILE_NAME)
+        if retired is not None:
+            yield None, retired['values']
+
+    def retire(self):
+        """ folds the counters and histograms of processes that have gone away
+            into the retired file, and removes their snapshots.  Their gauges are
+            dropped, as they no longer count
+        """
+        dead = [pid for pid in self.snapshot_pids() if pid != os.getpid() and not is_running(pid)]
+        if not dead:
+            return
+        try:
+            with open(os.path.join(self.directory, RETIRING_LOCK_NAME), 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                retired = self.read_json(RETIRED_FILE_NAME, dict(folded=[], values=[]))
+                # the snapshots folded by a process that went away before it
+                # removed them are only removed, they're told apart from those of
+                # a process given the same pid since by when they were written
+                leftover = set(tuple(snapshot) for snapshot in retired['folded'])
+                totals = dict(((name, tuple(tuple(label) for label in labels)), value)
+                    for name, labels, value in retired['values'])
+                folded = []
+                for pid in self.snapshot_pids():
+                    if pid == os.getpid() or is_running(pid):
+                        continue
+                    path = os.path.join(self.directory, '%s.json' % (pid))
+                    written = os.stat(path).st_mtime_ns
+                    snapshot = self.read_json('%s.json' % (pid)) if (pid, written) not in leftover else []
+                    if snapshot is None:
+                        continue
+                    add_up(totals, snapshot, self.definitions, include_gauges=False)
+                    folded.append((pid, written))
+                fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+                with os.fdopen(fd, 'w') as temp_file:
+                    json.dump(dict(folded=folded, values=[[name, list(labels), value]
+                        for (name, labels), value in totals.items()]), temp_file)
+                os.replace(temp_path, os.path.join(self.directory, RETIRED_FILE_NAME))
+                for pid, written in folded:
+                    os.unlink(os.path.join(self.directory, '%s.json' % (pid)))
+        except (IOError, OSError):
+            logging.exception("unable to fold the metrics of processes that have gone away")
+
+    def collect(self):
+        """ returns (name, labels) -> value across all the processes, counters and
+            histograms of processes that have gone away are kept but their gauges
+            aren't
+        """
+        collected = {}
+        for pid, snapshot in self.snapshots():
+            running = pid is not None and (pid == os.getpid() or is_running(pid))
+            add_up(collected, snapshot, self.definitions, include_gauges=running)
+        return collected
+
+    def render(self):
+        """ all of the metrics in the Prometheus text format """
+        collected = self.collect()
+        lines = []
+        for name in sorted(self.definitions):
+            kind, description, buckets = self.definitions[name]
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for (metric_name, labels), value in sorted(collected.items()):
+                if metric_name != name:
+                    continue
+                if kind != HISTOGRAM:
+                    lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+                    continue
+                cumulative = 0
+                for bucket, count in zip(buckets, value):
+                    cumulative += count
+                    lines.append('%s_bucket%s %s' % (name, format_labels(labels + (('le', format_value(bucket)),)), cumulative))
+                lines.append('%s_bucket%s %s' % (name, format_labels(labels + (('le', '+Inf'),)), value[-1]))
+                lines.append('%s_sum%s %s' % (name, format_labels(labels), format_value(value[-2])))
+                lines.append('%s_count%s %s' % (name, format_labels(labels), format_value(value[-1])))
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics(metrics_dir, metrics_flush_seconds)
+if metrics_dir:
+    atexit.register(metrics.flush)
+
+REQUEST_DURATION = 'kvstore_http_request_duration_seconds'
+REQUESTS_IN_FLIGHT = 'kvstore_http_requests_in_flight'
+REQUEST_SIZE = 'kvstore_http_request_size_bytes'
+RESPONSE_SIZE = 'kvstore_http_response_size_bytes'
+STORAGE_DURATION = 'kvstore_storage_operation_duration_seconds'
+CACHE_LOOKUPS = 'kvstore_cache_lookups_total'
+OPERATION_DURATION = 'kvstore_operation_duration_seconds'
+COALESCED_READS = 'kvstore_coalesced_reads_total'
+BLOB_WRITES = 'kvstore_blob_writes_total'
+BLOB_BYTES = 'kvstore_blob_bytes_total'
+
+metrics.define(REQUEST_DURATION, HISTOGRAM, "Time taken to handle a request, by route", LATENCY_BUCKETS)
+metrics.define(REQUESTS_IN_FLIGHT, GAUGE, "Requests currently being handled")
+metrics.define(REQUEST_SIZE, HISTOGRAM, "Size of request bodies, by route", SIZE_BUCKETS)
+metrics.define(RESPONSE_SIZE, HISTOGRAM, "Size of response bodies that aren't streamed, by route", SIZE_BUCKETS)
+metrics.define(STORAGE_DURATION, HISTOGRAM, "Time taken by calls to storage, by service and operation", LATENCY_BUCKETS)
+metrics.define(CACHE_LOOKUPS, COUNTER, "Lookups in the in-process caches, by cache and whether they hit")
+metrics.define(OPERATION_DURATION, HISTOGRAM, "Time taken converting form values and encoding JSON", LATENCY_BUCKETS)
+metrics.define(COALESCED_READS, COUNTER, "Reads from storage by whether they were made (led) or were waited for and shared (joined)")
+metrics.define(BLOB_WRITES, COUNTER, "Large values written to s3 by whether they were uploaded or deduplicated against a stored blob")
+metrics.define(BLOB_BYTES, COUNTER, "Bytes of large values by whether they were uploaded or deduplicated against a stored blob")
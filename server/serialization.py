@@ -0,0 +1,92 @@
+""" The JSON encoder and decoder used for responses and stored values.  orjson is
+    used when it's installed, as it's several times faster than the stdlib, set
+    JSON_SERIALIZER to json to use the stdlib regardless.
+
+    orjson writes compact JSON, so the stored and returned JSON differs in its
+    whitespace depending on the serializer, but not in anything else.  orjson
+    would write NaN and Infinity as null, and won't read them back, so values
+    holding them, and anything else orjson can't encode or decode, are handed to
+    the stdlib, which writes and reads them as NaN and Infinity as it always has.
+"""
+import os
+import re
+import json
+import math
+import logging
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_SERIALIZER = os.environ.get('JSON_SERIALIZER', 'auto')
+
+# a run of digits that may be an integer too large for 64 bits
+LONG_DIGITS = re.compile(r'[0-9]{20}')
+LONG_DIGIT_BYTES = re.compile(rb'[0-9]{20}')
+
+def stdlib_dumps(value):
+    return json.dumps(value)
+
+def orjson_dumps(value):
+    try:
+        encoded = orjson.dumps(value)
+    except TypeError:
+        # non string keys, integers too large for 64 bits and the like
+        return json.dumps(value)
+    if b'null' in encoded and has_non_finite(value):
+        # orjson wrote NaN or Infinity as null
+        return json.dumps(value)
+    return encoded.decode('utf-8')
+
+def orjson_loads(text):
+    if (LONG_DIGIT_BYTES if isinstance(text, bytes) else LONG_DIGITS).search(text):
+        # orjson reads integers too large for 64 bits as floats, losing digits
+        return json.loads(text)
+    try:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        # NaN and Infinity, lone surrogates and the like, which the stdlib reads.
+        # If it's not JSON at all the stdlib says so too
+        return json.loads(text)
+
+def has_non_finite(value):
+    """ True if the value is, or holds, a float that's NaN or infinite """
+    if isinstance(value, float):
+        return not math.isfinite(value)
+    if isinstance(value, dict):
+        return any(has_non_finite(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return any(has_non_finite(item) for item in value)
+    return False
+
+SERIALIZERS = {
+    # name -> (dumps, loads, item separator, key separator)
+    'json': (stdlib_dumps, json.loads, ', ', ': '),
+    'orjson': (orjson_dumps, orjson_loads, ',', ':'),
+}
+
+dumps = loads = item_separator = key_separator = None
+serializer = None
+
+def use(name):
+    """ switches to the named serializer, auto picks the fastest one installed """
+    global dumps, loads, item_separator, key_separator, serializer
+    if name == 'auto':
+        name = 'orjson' if orjson else 'json'
+    if name not in SERIALIZERS:
+        raise Exception("Unsupported JSON serializer: %s" % (name))
+    if name == 'orjson' and not orjson:
+        logging.warning("orjson isn't installed, using the stdlib JSON serializer")
+        name = 'json'
+    dumps, loads, item_separator, key_separator = SERIALIZERS[name]
+    serializer = name
+
+def splice_object(items):
+    """ returns the JSON text of an object made of (key, JSON text) pairs, the
+        values are spliced in as they are rather than being parsed and encoded
+        again
+    """
+    return '{%s}' % (item_separator.join('%s%s%s' % (dumps(key), key_separator, value) for key, value in items))
+
+use(JSON_SERIALIZER)
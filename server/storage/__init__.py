@@ -0,0 +1,309 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import Counter
+from importlib import import_module
+from server.metrics import metrics, STORAGE_DURATION
+
+# maps the value of KVSTORE_STORAGE_ENGINE to the module and class implementing it
+ENGINES = {
+    'dynamodb': ('server.storage.dynamo', 'DynamoBackend'),
+    'local': ('server.storage.local', 'LocalBackend'),
+    'cluster': ('server.storage.cluster', 'ClusterBackend'),
+}
+
+# the size of the chunks bodies are streamed in
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# the metadata that may be stored with a value
+METADATA_ATTRIBUTES = ['etag', 'last-modified', 'version', 'cache-control', 'content-encoding', 'expires']
+# the metadata a conditional write checks is as expected
+CONDITION_ATTRIBUTES = ('version', 'etag', 'last-modified')
+
+class StorageMisconfigured(Exception):
+    """ raised when storage can't be used as it's configured, which unlike storage
+        that can't be reached won't come right by trying again
+    """
+    pass
+
+def get_storage_path_for(key):
+    hash_o = hashlib.sha256()
+    hash_o.update(key.encode())
+    storage_key = hash_o.hexdigest()
+    return os.path.join(
+        storage_key[:2],
+        storage_key[2:4],
+        storage_key
+    )
+
+def etag_for(data):
+    """ the content hash stored with each value, used as its ETag """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.md5(data or b'').hexdigest()
+
+def version_after(version=None):
+    """ the version of a newly stored value.  It's the time in microseconds, so
+        versions go up with each write without the previous one being read,
+        unless there's a version it has to follow that's later still
+    """
+    return max(int(time.time() * 1000000), (version or 0) + 1)
+
+def metadata_for(etag, metadata=None):
+    """ the metadata stored with each value, any metadata provided by the client
+        along with the value's content hash, the time it was stored and its
+        version.  If the metadata has a version the new version follows it
+    """
+    stored_metadata = dict(metadata or {})
+    stored_metadata['etag'] = etag
+    stored_metadata['last-modified'] = int(time.time())
+    stored_metadata['version'] = version_after(stored_metadata.get('version'))
+    return stored_metadata
+
+def prefix_end(prefix):
+    """ the smallest string that sorts after every string starting with prefix, or
+        None if there isn't one
+    """
+    prefix = prefix.rstrip(chr(0x10ffff))
+    if not prefix:
+        return None
+    next_character = ord(prefix[-1]) + 1
+    if 0xd800 <= next_character <= 0xdfff:
+        # surrogates can't be encoded, and nothing sorts between them anyway
+        next_character = 0xe000
+    return prefix[:-1] + chr(next_character)
+
+def is_expired(metadata, now=None):
+    """ True if the value the metadata is for has an expiry that has passed """
+    expires = metadata.get('expires') if metadata else None
+    return expires is not None and int(expires) <= (now if now is not None else time.time())
+
+def is_expected(metadata, expected):
+    """ True if the metadata is that of the expected value, or if None was
+        expected and nothing is stored
+    """
+    if expected is None or metadata is None:
+        return expected is None and metadata is None
+    return all(metadata.get(name) == expected.get(name) for name in CONDITION_ATTRIBUTES)
+
+def following(metadata, expected):
+    """ the metadata to store a value with so its version follows the expected one """
+    if not expected or expected.get('version') is None:
+        return metadata
+    return dict(metadata or {}, version=expected['version'])
+
+def read_chunks(stream, chunk_size=STREAM_CHUNK_SIZE):
+    """ yields the contents of a file like object chunk_size bytes at a time """
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+def read_exactly(stream, size):
+    """ reads size bytes from the stream, or as many as there are left, even if
+        the stream hands them over a few at a time
+    """
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+class StreamedBody(object):
+    """ A body that is streamed out of storage a chunk at a time rather than being
+        read into memory all at once.  Iterating over it yields the chunks, and it
+        must be closed if it isn't iterated to the end.  If the chunks are read
+        from a file, positioned at the start of the body, the file is provided so
+        the body can be sent straight from it.
+    """
+
+    def __init__(self, chunks, size=None, on_close=None, file=None):
+        self.chunks = chunks
+        self.size = size
+        self.on_close = on_close
+        self.file = file
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def read(self):
+        try:
+            return b''.join(self.chunks)
+        finally:
+            self.close()
+
+    def close(self):
+        if hasattr(self.chunks, 'close'):
+            self.chunks.close()
+        if self.on_close:
+            self.on_close()
+
+class StorageBackend(object):
+    """ The interface that store_it, read_it and delete_it go through, anything
+        that can store a body and its content type by key can be used as the
+        storage for the kvstore.
+    """
+
+    def __init__(self):
+        self.counters = Counter()
+        self.counters_lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        with self.counters_lock:
+            self.counters[name] += amount
+
+    def timed(self, service, operation):
+        """ times the with block as a call to storage, for /metrics """
+        return metrics.timer(STORAGE_DURATION, service=service, operation=operation)
+
+    def stats(self):
+        """ returns a dictionary of the counters kept by the backend """
+        with self.counters_lock:
+            return dict(self.counters)
+
+    def warm_up(self):
+        """ makes whatever connections the backend needs ahead of the first request
+            that needs them
+        """
+        pass
+
+    def store(self, key, data, content_type, metadata=None):
+        """ stores data by key, along with metadata_for the data and any metadata
+            provided.  Metadata is a dictionary of simple values
+        """
+        raise NotImplementedError()
+
+    def store_stream(self, key, stream, content_type, content_length, metadata=None):
+        """ stores content_length bytes read from the file like stream, backends
+            that can store a value without holding all of it in memory should
+            override this
+        """
+        self.store(key, read_exactly(stream, content_length), content_type, metadata=metadata)
+
+    def store_if(self, key, data, content_type, metadata=None, expected=None):
+        """ stores data by key as store does, but only if the value stored has the
+            expected metadata, or if expected is None only if nothing is stored.
+            Returns False, without storing anything, if that isn't the case
+        """
+        raise NotImplementedError()
+
+    def read(self, key, stream=False):
+        """ returns a tuple of (content_type, body, key, metadata), or
+            (None, None, None, None) if nothing is stored for the given key.  If
+            stream is True a large body may be returned as a StreamedBody
+        """
+        raise NotImplementedError()
+
+    def read_metadata(self, key):
+        """ returns a tuple of (content_type, metadata) without reading the body,
+            or (None, None) if nothing is stored for the given key
+        """
+        content_type, body, key, metadata = self.read(key, stream=True)
+        if isinstance(body, StreamedBody):
+            body.close()
+        return content_type, metadata
+
+    def read_many(self, keys):
+        """ returns a dictionary of key -> (content_type, body, key, metadata) for
+            each of the keys that has something stored, backends that can fetch
+            many keys at once should override this
+        """
+        found = {}
+        for key in keys:
+            result = self.read(key)
+            if result[1] is not None:
+                found[key] = result
+        return found
+
+    def store_many(self, items):
+        """ stores each of the (key, data, content_type, metadata) tuples provided,
+            returning a dictionary of key -> None if it was stored, or a message
+            describing why it wasn't
+        """
+        results = {}
+        for key, data, content_type, metadata in items:
+            try:
+                self.store(key, data, content_type, metadata=metadata)
+                results[key] = None
+            except Exception as e:
+                logging.exception("unable to store %s", key)
+                results[key] = str(e)
+        return results
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+    def delete_if(self, key, expected):
+        """ deletes the value stored by key only if it has the expected metadata,
+            returning False if it doesn't
+        """
+        raise NotImplementedError()
+
+    def list_keys(self, prefix='', start_after=None, limit=100):
+        """ returns up to limit of the stored keys that start with prefix, in order,
+            starting with the first key after start_after if it's provided
+        """
+        raise NotImplementedError()
+
+    def unexpired_keys(self, keys, now=None):
+        """ returns those of the keys, in order, whose values haven't expired.
+            Backends that can tell without reading the metadata of each value
+            should override this
+        """
+        return [key for key in keys if not is_expired(self.read_metadata(key)[1], now)]
+
+    def expired_entries(self, now, limit=100):
+        """ returns up to limit (expires, key) tuples for values that were stored
+            to expire by now, though they may have been stored again since.
+            Backends that keep track of expiring values should override this
+        """
+        return []
+
+    def remove_expired_entries(self, entries):
+        """ forgets the (expires, key) tuples returned by expired_entries """
+        pass
+
+    def reap_expired(self, now=None, limit=100):
+        """ deletes up to limit values that have expired, returning their keys """
+        now = int(now if now is not None else time.time())
+        entries = self.expired_entries(now, limit)
+        reaped = []
+        for expires, key in entries:
+            content_type, metadata = self.read_metadata(key)
+            if metadata is not None and not is_expired(metadata, now):
+                # stored again since, without expiring or expiring later
+                continue
+            # only what was found to have expired is deleted, so a value stored
+            # again in the meantime is kept.  A value that's already gone may
+            # have left something behind, which is cleared up if it's still gone
+            if self.delete_if(key, metadata) and metadata is not None:
+                reaped.append(key)
+        self.remove_expired_entries(entries)
+        self.count('expired_deletes', len(reaped))
+        return reaped
+
+    def collect_blobs(self, now=None, lease_seconds=None):
+        """ deletes the stored blobs no value has pointed to for some time,
+            returning their digests.  Only backends that share blobs between
+            values have anything to collect.  Given lease_seconds, it only
+            collects if it can hold the lease on collecting for that long, so
+            one process collects at a time
+        """
+        return []
+
+def create_backend(engine, **kwargs):
+    """ Creates the storage backend for the named engine, any kwargs are handed to
+        the constructor of the backend.
+    """
+    if engine not in ENGINES:
+        raise Exception("Unsupported storage engine: %s" % (engine))
+    module_name, class_name = ENGINES[engine]
+    logging.info("Using %s storage engine" % (engine))
+    return getattr(import_module(module_name), class_name)(**kwargs)
@@ -0,0 +1,665 @@
+""" Spreads the keys over a cluster of kvstore nodes, each storing its share on
+    local disk with a LocalBackend.  Keys are placed on a ring by the same sha256
+    digest as get_storage_path_for, and each is kept by the first replicas nodes
+    found going round the ring from it.
+
+    Writes are made by the first of the key's nodes that can be reached, which
+    stores the value and then copies it, metadata and all, to the key's other
+    nodes.  Reads are answered by the first of them that has it.  The nodes talk
+    to each other through the /__cluster__ routes in cluster_handlers.py.
+
+    A node that can't be reached when a value is copied or deleted is handed the
+    change later.  The node that made it keeps a hint of the key and the node,
+    and goes through its hints every handoff interval, copying the value as it
+    now is or deleting the copy if it's since been deleted.
+
+    The nodes share a secret, sent with each request they make to each other,
+    and the /__cluster__ routes refuse any request that doesn't have it.
+
+    Changing the nodes, through PUT /__cluster__/nodes, has every node copy the
+    keys it holds to the nodes that have become responsible for them, and drop
+    those it's no longer responsible for itself.  Until every node has done so,
+    keys are also looked for on the nodes that were responsible for them before.
+"""
+import os
+import json
+import time
+import bisect
+import hmac
+import socket
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import threading
+import http.client
+from urllib.parse import quote, urlencode, urlsplit
+from server.storage import StorageBackend, StreamedBody, get_storage_path_for, read_chunks, version_after
+from server.storage.local import LocalBackend
+
+# the file, under the root path, the nodes are kept in once they've been changed
+# from those the backend was created with
+NODES_FILE_NAME = 'cluster.json'
+# how often each process looks for the nodes having been changed by another
+NODES_CHECK_SECONDS = 1
+# how often a node that's moved its keys after the nodes changed asks the others
+# whether they've moved theirs
+REBALANCE_CHECK_SECONDS = 1
+# the headers values are copied between nodes with
+METADATA_HEADER = 'X-Kvstore-Metadata'
+EXPECTED_HEADER = 'X-Kvstore-Expected'
+# the secret the nodes share, sent with every request they make to each other
+SECRET_HEADER = 'X-Kvstore-Cluster-Secret'
+# sent with a body that was handed over as a string, so it's handed back as one
+ENCODING_HEADER = 'X-Kvstore-Encoding'
+# sent with the deletion of a copy, which only deletes versions up to this one so
+# a delete that arrives late doesn't remove a value stored after it
+DELETED_VERSION_HEADER = 'X-Kvstore-Deleted-Version'
+# the sqlite database, under the root path, that keeps the changes yet to be
+# handed to nodes that couldn't be reached
+HINTS_FILE_NAME = 'hints.sqlite3'
+# the most hints handed off at a time
+HANDOFF_BATCH_SIZE = 100
+
+def position_of(digest):
+    """ the place on the ring of a sha256 hex digest """
+    return int(digest[:16], 16)
+
+def key_position(key):
+    return position_of(os.path.basename(get_storage_path_for(key)))
+
+class HashRing(object):
+    """ Places each node at vnodes points round a ring, the more points a node
+        has the more evenly the keys are spread and the less moves when the nodes
+        change
+    """
+
+    def __init__(self, nodes, vnodes=64):
+        self.nodes = sorted(set(nodes))
+        points = sorted((position_of(hashlib.sha256(('%s#%s' % (node, point)).encode('utf-8')).hexdigest()), node)
+            for node in self.nodes for point in range(vnodes))
+        self.positions = [position for position, node in points]
+        self.owners = [node for position, node in points]
+
+    def nodes_for(self, key, count=1):
+        """ the count distinct nodes responsible for the key, in the order they're
+            found going round the ring
+        """
+        count = min(count, len(self.nodes))
+        found = []
+        start = bisect.bisect(self.positions, key_position(key))
+        for offset in range(len(self.owners)):
+            node = self.owners[(start + offset) % len(self.owners)]
+            if node not in found:
+                found.append(node)
+                if len(found) == count:
+                    break
+        return found
+
+class NodeUnavailable(Exception):
+    pass
+
+class NodeClient(object):
+    """ Makes requests to the other nodes, with the secret they share, each
+        thread keeps its connection to each node alive between requests
+    """
+
+    def __init__(self, secret, timeout=5):
+        self.secret = secret
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connection_for(self, node):
+        connections = getattr(self.local, 'connections', None)
+        if connections is None:
+            connections = self.local.connections = {}
+        connection = connections.pop(node, None)
+        if connection is not None:
+            return connection, False
+        url = urlsplit(node)
+        return http.client.HTTPConnection(url.hostname, url.port, timeout=self.timeout), True
+
+    def open(self, node, method, path, body=None, headers=None):
+        """ makes the request, returning the response with its body yet to be read
+            and the connection it came on, which is the caller's to close.  Raises
+            NodeUnavailable if the node can't be reached
+        """
+        headers = dict(headers or {})
+        headers[SECRET_HEADER] = self.secret
+        while True:
+            connection, fresh = self.connection_for(node)
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                return connection.getresponse(), connection
+            except (socket.error, http.client.HTTPException) as e:
+                connection.close()
+                # the node may have closed a connection that had been idle, which
+                # is tried again on a new one so long as the body can be sent again
+                if fresh or not (body is None or isinstance(body, bytes)):
+                    raise NodeUnavailable("unable to reach %s: %s" % (node, e))
+
+    def request(self, node, method, path, body=None, headers=None):
+        """ makes the request, returning the response and its body """
+        response, connection = self.open(node, method, path, body, headers)
+        try:
+            data = response.read()
+        except (socket.error, http.client.HTTPException) as e:
+            connection.close()
+            raise NodeUnavailable("unable to reach %s: %s" % (node, e))
+        if response.will_close:
+            connection.close()
+        else:
+            self.local.connections[node] = connection
+        return response, data
+
+def values_path(key):
+    return '/__cluster__/values/%s' % (quote(key, safe='/'))
+
+def copies_path(key):
+    return '/__cluster__/copies/%s' % (quote(key, safe='/'))
+
+def body_size(data):
+    return len(data.encode('utf-8') if isinstance(data, str) else data or b'')
+
+class ClusterBackend(StorageBackend):
+    """ Stores each key on replicas of the nodes, this one included.  nodes and
+        self_node are the base URLs the nodes are reached at, and secret is what
+        they share to tell each other's requests from anyone else's
+    """
+
+    def __init__(self, root_path, nodes, self_node, secret, replicas=2, vnodes=64, timeout=5, handoff_interval=5):
+        super(ClusterBackend, self).__init__()
+        if not secret:
+            raise Exception("the nodes of a cluster must be given a secret to share")
+        logging.info("Using cluster storage as %s of %s", self_node, ", ".join(nodes))
+        self.secret = secret
+        self.local = LocalBackend(root_path)
+        self.hints_path = os.path.join(root_path, HINTS_FILE_NAME)
+        # sqlite connections can't be shared between threads
+        self.hints_connections = threading.local()
+        self.handoff_interval = handoff_interval
+        self.handoff = None
+        self.self_node = self_node
+        self.replicas = replicas
+        self.vnodes = vnodes
+        self.client = NodeClient(secret, timeout)
+        self.nodes_path = os.path.join(root_path, NODES_FILE_NAME)
+        self.nodes_lock = threading.Lock()
+        self.ring = HashRing(nodes, vnodes)
+        # while keys are being moved after the nodes change they may still only
+        # be found on the nodes that were responsible for them before.  That's
+        # until every node has moved its keys, swept is whether this one has
+        self.previous_ring = None
+        self.swept = False
+        self.nodes_checked = 0
+        self.nodes_modified = None
+        self.rebalancer = None
+        # hints left by an earlier process are handed off as well
+        self.start_handoff()
+
+    def warm_up(self):
+        self.local.warm_up()
+        self.hints()
+
+    def stats(self):
+        stats = super(ClusterBackend, self).stats()
+        stats.update(('local_%s' % (name), value) for name, value in self.local.stats().items())
+        with self.timed('cluster', 'hints_read'):
+            stats['pending_hints'] = self.hints().execute("SELECT COUNT(*) FROM hints").fetchone()[0]
+        return stats
+
+    def is_node(self, secret):
+        """ True if the secret sent with a request is the one the nodes share """
+        return bool(secret) and hmac.compare_digest(secret.encode('utf-8'), self.secret.encode('utf-8'))
+
+    def current_rings(self):
+        """ the ring, and the previous ring while keys are being moved, picking up
+            changes to the nodes made by other processes
+        """
+        if time.time() - self.nodes_checked >= NODES_CHECK_SECONDS:
+            self.nodes_checked = time.time()
+            try:
+                modified = os.stat(self.nodes_path).st_mtime
+            except OSError:
+                modified = None
+            if modified is not None and modified != self.nodes_modified:
+                with self.nodes_lock:
+                    try:
+                        with open(self.nodes_path) as nodes_file:
+                            nodes = json.load(nodes_file)
+                    except (IOError, OSError, ValueError):
+                        logging.exception("unable to read the nodes from %s", self.nodes_path)
+                    else:
+                        self.nodes_modified = modified
+                        self.ring = HashRing(nodes['nodes'], self.vnodes)
+                        previous = nodes.get('previous')
+                        self.previous_ring = HashRing(previous, self.vnodes) if previous else None
+                        self.swept = nodes.get('swept', False)
+        return self.ring, self.previous_ring
+
+    def nodes_for(self, key):
+        """ the nodes responsible for the key, this node first if it's one of them """
+        nodes = self.current_rings()[0].nodes_for(key, self.replicas)
+        if self.self_node in nodes:
+            nodes.remove(self.self_node)
+            nodes.insert(0, self.self_node)
+        return nodes
+
+    def coordinate(self, key, here, there, retry=True):
+        """ calls here if this node is responsible for the key, or there with each
+            of the nodes that are until one of them can be reached.  Without retry
+            only the first of them is tried, for a body that can't be sent twice
+        """
+        unavailable = None
+        for node in self.nodes_for(key):
+            if node == self.self_node:
+                return here()
+            try:
+                self.count('forwarded_requests')
+                return there(node)
+            except NodeUnavailable as e:
+                logging.warning("%s, trying the next node for %s", e, key)
+                self.count('unavailable_nodes')
+                if not retry:
+                    raise
+                unavailable = e
+        raise unavailable or NodeUnavailable("there are no nodes to store %s on" % (key))
+
+    def forward(self, node, method, key, body=None, metadata=None, content_type=None, expected=None,
+            conditional=False, content_length=None):
+        headers = {METADATA_HEADER: json.dumps(metadata or {})}
+        if content_type is not None:
+            headers['Content-Type'] = content_type
+        if conditional:
+            headers[EXPECTED_HEADER] = json.dumps(expected)
+        if body is not None:
+            headers['Content-Length'] = str(content_length if content_length is not None else body_size(body))
+            if isinstance(body, str):
+                headers[ENCODING_HEADER] = 'utf-8'
+                body = body.encode('utf-8')
+        with self.timed('cluster', method.lower()):
+            response, data = self.client.request(node, method, values_path(key), body, headers)
+        if response.status == 412:
+            return False
+        if response.status >= 300:
+            raise Exception("unable to %s %s on %s: %s %s" % (method, key, node, response.status, data[:200]))
+        return True
+
+    def store(self, key, data, content_type, metadata=None):
+        self.coordinate(key, lambda: self.store_here(key, data, content_type, metadata),
+            lambda node: self.forward(node, 'PUT', key, data, metadata, content_type))
+
+    def store_stream(self, key, stream, content_type, content_length, metadata=None):
+        self.coordinate(key, lambda: self.store_stream_here(key, stream, content_type, content_length, metadata),
+            lambda node: self.forward(node, 'PUT', key, stream, metadata, content_type, content_length=content_length),
+            retry=False)
+
+    def store_if(self, key, data, content_type, metadata=None, expected=None):
+        return self.coordinate(key, lambda: self.store_if_here(key, data, content_type, metadata, expected),
+            lambda node: self.forward(node, 'PUT', key, data, metadata, content_type, expected, conditional=True))
+
+    def delete(self, key):
+        self.coordinate(key, lambda: self.delete_here(key), lambda node: self.forward(node, 'DELETE', key))
+
+    def delete_if(self, key, expected):
+        return self.coordinate(key, lambda: self.delete_if_here(key, expected),
+            lambda node: self.forward(node, 'DELETE', key, expected=expected, conditional=True))
+
+    def store_here(self, key, data, content_type, metadata=None):
+        self.local.store(key, data, content_type, metadata=metadata)
+        self.replicate(key)
+
+    def store_stream_here(self, key, stream, content_type, content_length, metadata=None):
+        self.local.store_stream(key, stream, content_type, content_length, metadata=metadata)
+        self.replicate(key)
+
+    def store_if_here(self, key, data, content_type, metadata=None, expected=None):
+        if not self.local.store_if(key, data, content_type, metadata=metadata, expected=expected):
+            return False
+        self.replicate(key)
+        return True
+
+    def delete_here(self, key):
+        content_type, metadata = self.local.read_metadata(key)
+        self.local.delete(key)
+        self.replicate_delete(key, version_after((metadata or {}).get('version')))
+
+    def delete_if_here(self, key, expected):
+        if not self.local.delete_if(key, expected):
+            return False
+        # only copies of what was expected, or earlier, are deleted
+        self.replicate_delete(key, expected.get('version', 0) if expected else 0)
+        return True
+
+    def replicate(self, key, nodes=None):
+        """ copies the value stored here to the key's other nodes, or those given.
+            A node that can't be reached is hinted, to be handed the value once
+            it can be, returns the nodes it was copied to
+        """
+        nodes = [node for node in (self.nodes_for(key) if nodes is None else nodes) if node != self.self_node]
+        copied = []
+        for node in nodes:
+            content_type, body, found_key, metadata = self.local.read(key, stream=True)
+            if body is None:
+                break
+            headers = {'Content-Type': content_type, METADATA_HEADER: json.dumps(metadata)}
+            if isinstance(body, str):
+                headers[ENCODING_HEADER] = 'utf-8'
+            if not isinstance(body, StreamedBody):
+                body = StreamedBody(iter([body.encode('utf-8') if isinstance(body, str) else body]), body_size(body))
+            headers['Content-Length'] = str(body.size)
+            try:
+                with self.timed('cluster', 'copy'):
+                    response, data = self.client.request(node, 'PUT', copies_path(key), iter(body), headers)
+                if response.status >= 300:
+                    raise NodeUnavailable("%s refused a copy of %s: %s" % (node, key, response.status))
+                copied.append(node)
+                self.count('copies_sent')
+            except NodeUnavailable as e:
+                logging.warning("unable to copy %s: %s", key, e)
+                self.count('replication_failures')
+                self.hint(node, key)
+            finally:
+                body.close()
+        return copied
+
+    def replicate_delete(self, key, version, nodes=None):
+        """ deletes the copies of the key's other nodes, or those given, that are
+            no later than version.  A node that can't be reached is hinted, to
+            have its copy deleted once it can be
+        """
+        nodes = [node for node in (self.nodes_for(key) if nodes is None else nodes) if node != self.self_node]
+        deleted = []
+        for node in nodes:
+            try:
+                with self.timed('cluster', 'delete_copy'):
+                    response, data = self.client.request(node, 'DELETE', copies_path(key),
+                        headers={DELETED_VERSION_HEADER: str(version)})
+                if response.status >= 300:
+                    raise NodeUnavailable("%s refused to delete its copy of %s: %s" % (node, key, response.status))
+                deleted.append(node)
+            except NodeUnavailable as e:
+                logging.warning("unable to delete the copy of %s: %s", key, e)
+                self.count('replication_failures')
+                self.hint(node, key, version)
+        return deleted
+
+    def hints(self):
+        """ the connection to the hints for this thread, each is a node and a key
+            whose value it's to be handed, and for a deletion the version that
+            was deleted
+        """
+        connection = getattr(self.hints_connections, 'connection', None)
+        if connection is None:
+            os.makedirs(os.path.dirname(self.hints_path), exist_ok=True)
+            connection = sqlite3.connect(self.hints_path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS hints (node TEXT, key TEXT, deleted_version INTEGER, "
+                "UNIQUE (node, key))")
+            self.hints_connections.connection = connection
+        return connection
+
+    def hint(self, node, key, deleted_version=None):
+        """ remembers that the node is to be handed the key's value, replacing any
+            hint for it already, so only the latest change is handed off
+        """
+        with self.timed('cluster', 'hint_write'):
+            self.hints().execute("INSERT OR REPLACE INTO hints (node, key, deleted_version) VALUES (?, ?, ?)",
+                (node, key, deleted_version))
+        self.count('hints')
+
+    def start_handoff(self):
+        if self.handoff_interval > 0 and self.handoff is None:
+            self.handoff = threading.Thread(target=self.run_handoff, name='cluster-handoff')
+            self.handoff.daemon = True
+            self.handoff.start()
+
+    def run_handoff(self):
+        while True:
+            time.sleep(self.handoff_interval)
+            try:
+                # keep going while there's a full batch to hand off
+                while self.hand_off() >= HANDOFF_BATCH_SIZE:
+                    pass
+            except Exception:
+                logging.exception("unable to hand off the changes hinted")
+
+    def hand_off(self, limit=HANDOFF_BATCH_SIZE):
+        """ hands a batch of the hinted changes to their nodes, returning how many
+            of them it could forget.  A hint is only forgotten once it's been
+            handed off, or if its node is no longer one of the cluster's
+        """
+        with self.timed('cluster', 'hint_read'):
+            hints = self.hints().execute("SELECT rowid, node, key, deleted_version FROM hints ORDER BY rowid LIMIT ?",
+                (limit,)).fetchall()
+        ring, previous_ring = self.current_rings()
+        members = set(ring.nodes) | set(previous_ring.nodes if previous_ring else [])
+        unavailable = set()
+        forgotten = 0
+        for rowid, node, key, deleted_version in hints:
+            if node in unavailable:
+                continue
+            handed_off = True
+            if node in members:
+                if self.local.read_metadata(key)[1] is not None:
+                    handed_off = bool(self.replicate(key, [node]))
+                elif deleted_version is not None:
+                    handed_off = bool(self.replicate_delete(key, deleted_version, [node]))
+                # otherwise the value has since been moved off this node, and it's
+                # up to the nodes it was moved to
+                if not handed_off:
+                    # the node is still unavailable, and has been hinted again
+                    unavailable.add(node)
+                    continue
+            self.count('hints_handed_off')
+            # a hint made again since it was read is kept
+            with self.timed('cluster', 'hint_write'):
+                self.hints().execute("DELETE FROM hints WHERE rowid = ?", (rowid,))
+            forgotten += 1
+        return forgotten
+
+    def read(self, key, stream=False):
+        ring, previous_ring = self.current_rings()
+        nodes = self.nodes_for(key)
+        if previous_ring:
+            nodes += [node for node in previous_ring.nodes_for(key, self.replicas) if node not in nodes]
+        for node in nodes:
+            if node == self.self_node:
+                result = self.local.read(key, stream=stream)
+            else:
+                try:
+                    result = self.read_copy(node, key, stream)
+                except NodeUnavailable as e:
+                    logging.warning("%s, trying the next node for %s", e, key)
+                    self.count('unavailable_nodes')
+                    continue
+            if result[1] is not None:
+                return result
+        return None, None, None, None
+
+    def read_copy(self, node, key, stream):
+        """ reads the copy of the value held by the node """
+        self.count('forwarded_requests')
+        with self.timed('cluster', 'get'):
+            response, connection = self.client.open(node, 'GET', copies_path(key))
+        if response.status != 200:
+            response.read()
+            connection.close()
+            return None, None, None, None
+        content_type = response.getheader('Content-Type')
+        metadata = json.loads(response.getheader(METADATA_HEADER) or '{}')
+        size = int(response.getheader('Content-Length'))
+        if stream:
+            def close():
+                response.close()
+                connection.close()
+            return content_type, StreamedBody(read_chunks(response), size, on_close=close), key, metadata
+        try:
+            with self.timed('cluster', 'read'):
+                body = response.read()
+        except (socket.error, http.client.HTTPException) as e:
+            raise NodeUnavailable("unable to read %s from %s: %s" % (key, node, e))
+        finally:
+            connection.close()
+        if response.getheader(ENCODING_HEADER):
+            body = body.decode(response.getheader(ENCODING_HEADER))
+        return content_type, body, key, metadata
+
+    def read_metadata(self, key):
+        for node in self.nodes_for(key):
+            if node == self.self_node:
+                content_type, metadata = self.local.read_metadata(key)
+            else:
+                try:
+                    with self.timed('cluster', 'head'):
+                        response, data = self.client.request(node, 'HEAD', copies_path(key))
+                except NodeUnavailable as e:
+                    self.count('unavailable_nodes')
+                    continue
+                if response.status != 200:
+                    continue
+                content_type = response.getheader('Content-Type')
+                metadata = json.loads(response.getheader(METADATA_HEADER) or '{}')
+            if metadata is not None:
+                return content_type, metadata
+        return None, None
+
+    def list_keys(self, prefix='', start_after=None, limit=100):
+        # every node holds keys of its own, so the first limit keys of each are
+        # merged
+        keys = set(self.local.list_keys(prefix, start_after=start_after, limit=limit))
+        parameters = dict(prefix=prefix, limit=limit)
+        if start_after is not None:
+            parameters['start_after'] = start_after
+        for node in self.current_rings()[0].nodes:
+            if node == self.self_node:
+                continue
+            try:
+                with self.timed('cluster', 'list_keys'):
+                    response, data = self.client.request(node, 'GET', '/__cluster__/keys?%s' % (urlencode(parameters)))
+            except NodeUnavailable as e:
+                logging.warning("unable to list the keys of %s: %s", node, e)
+                self.count('unavailable_nodes')
+                continue
+            keys.update(json.loads(data)['keys'])
+        return sorted(keys)[:limit]
+
+    def unexpired_keys(self, keys, now=None):
+        # each key's expiry is looked up in the index of the first of its nodes,
+        # with the keys sent to each node in one batch
+        keys_by_node = {}
+        for key in keys:
+            keys_by_node.setdefault(self.nodes_for(key)[0], []).append(key)
+        unexpired = set()
+        for node, node_keys in keys_by_node.items():
+            if node == self.self_node:
+                unexpired.update(self.local.unexpired_keys(node_keys, now))
+                continue
+            try:
+                with self.timed('cluster', 'unexpired_keys'):
+                    response, data = self.client.request(node, 'POST', '/__cluster__/unexpired',
+                        json.dumps(dict(keys=node_keys, now=now)).encode('utf-8'), {'Content-Type': 'application/json'})
+                if response.status != 200:
+                    raise NodeUnavailable("%s couldn't look up the expiry of keys: %s" % (node, response.status))
+                unexpired.update(json.loads(data)['keys'])
+            except NodeUnavailable as e:
+                # each is looked for on whichever of its nodes can be reached
+                logging.warning("%s, reading the metadata of each key instead", e)
+                self.count('unavailable_nodes')
+                unexpired.update(super(ClusterBackend, self).unexpired_keys(node_keys, now))
+        return [key for key in keys if key in unexpired]
+
+    def expired_entries(self, now, limit=100):
+        return self.local.expired_entries(now, limit)
+
+    def remove_expired_entries(self, entries):
+        self.local.remove_expired_entries(entries)
+
+    def set_nodes(self, nodes):
+        """ changes the nodes of the cluster, moving the keys held here to the
+            nodes that are now responsible for them in the background
+        """
+        ring, previous_ring = self.current_rings()
+        with self.nodes_lock:
+            self.previous_ring = previous_ring or ring
+            self.ring = HashRing(nodes, self.vnodes)
+            self.swept = False
+            self.write_nodes(self.ring.nodes, self.previous_ring.nodes)
+        self.rebalancer = threading.Thread(target=self.rebalance, args=(self.previous_ring, self.ring), name='cluster-rebalancer')
+        self.rebalancer.daemon = True
+        self.rebalancer.start()
+
+    def write_nodes(self, nodes, previous=None, swept=False):
+        os.makedirs(os.path.dirname(self.nodes_path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.nodes_path), prefix='.tmp-')
+        with os.fdopen(fd, 'w') as temp_file:
+            json.dump(dict(nodes=nodes, previous=previous, swept=swept), temp_file)
+        os.replace(temp_path, self.nodes_path)
+        self.nodes_modified = os.stat(self.nodes_path).st_mtime
+
+    def is_rebalancing(self):
+        return self.current_rings()[1] is not None
+
+    def rebalance(self, previous_ring, ring):
+        """ streams each key held here to the nodes newly responsible for it,
+            dropping it from here if this node no longer is.  A key that couldn't
+            be copied everywhere is kept.  The previous ring is only forgotten once
+            every node, old and new, has moved its keys
+        """
+        moved = 0
+        start_after = None
+        try:
+            while True:
+                keys = self.local.list_keys(start_after=start_after, limit=100)
+                if not keys:
+                    break
+                start_after = keys[-1]
+                for key in keys:
+                    before = previous_ring.nodes_for(key, self.replicas)
+                    after = ring.nodes_for(key, self.replicas)
+                    added = [node for node in after if node not in before and node != self.self_node]
+                    content_type, metadata = self.local.read_metadata(key)
+                    copied = self.replicate(key, added) if added else []
+                    if self.self_node not in after and len(copied) == len(added):
+                        # only what was copied is dropped, a value stored here
+                        # since is kept to be moved when the nodes next change
+                        if not self.local.delete_if(key, metadata):
+                            self.count('rebalance_conflicts')
+                    moved += 1 if added else 0
+            self.count('rebalanced_keys', moved)
+            logging.info("moved %s keys to the nodes now responsible for them", moved)
+        except Exception:
+            logging.exception("unable to move the keys to the nodes now responsible for them")
+            return
+        with self.nodes_lock:
+            if self.ring is not ring:
+                return
+            self.swept = True
+            self.write_nodes(ring.nodes, previous_ring.nodes, swept=True)
+        others = set(ring.nodes) | set(previous_ring.nodes)
+        others.discard(self.self_node)
+        while True:
+            others = set(node for node in others if not self.has_swept(node, ring))
+            if not others:
+                break
+            time.sleep(REBALANCE_CHECK_SECONDS)
+            # the nodes changing again starts another rebalance, which takes over
+            if self.ring is not ring:
+                return
+        with self.nodes_lock:
+            if self.ring is ring:
+                self.previous_ring = None
+                self.write_nodes(ring.nodes)
+
+    def has_swept(self, node, ring):
+        """ whether the node has moved its keys to the nodes of the ring """
+        try:
+            with self.timed('cluster', 'nodes'):
+                response, data = self.client.request(node, 'GET', '/__cluster__/nodes')
+        except NodeUnavailable as e:
+            logging.warning("unable to ask %s whether it's moved its keys: %s", node, e)
+            return False
+        if response.status != 200:
+            return False
+        state = json.loads(data)
+        return state['nodes'] == ring.nodes and (state.get('swept') or not state['rebalancing'])
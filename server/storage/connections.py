@@ -0,0 +1,90 @@
+""" The boto connections the DynamoBackend makes its calls through.  Nothing is
+    connected to until the first call is made, and a process only ever creates
+    one connection to each service, which every thread shares.  boto keeps the
+    HTTP connections made through it alive, so a call reuses a connection left
+    idle by an earlier one rather than setting up a new one.
+"""
+import os
+import logging
+import threading
+import boto
+from boto.connection import ConnectionPool, HostConnectionPool
+from boto.dynamodb2.layer1 import DynamoDBConnection
+from boto.s3.connection import OrdinaryCallingFormat
+
+class BoundedConnectionPool(ConnectionPool):
+    """ boto's pool of idle HTTP connections, keeping at most max_idle of them
+        for each host, anything beyond that is closed as it's handed back
+    """
+
+    def __init__(self, max_idle):
+        super(BoundedConnectionPool, self).__init__()
+        self.max_idle = max_idle
+
+    def put_http_connection(self, host, port, is_secure, conn):
+        with self.mutex:
+            key = (host, port, is_secure)
+            if key not in self.host_to_pool:
+                self.host_to_pool[key] = HostConnectionPool()
+            if self.host_to_pool[key].size() < self.max_idle:
+                self.host_to_pool[key].put(conn)
+                return
+        conn.close()
+
+def configure_boto(timeout=None, retries=None, idle_seconds=None):
+    """ sets the options boto reads as its connections are created and used, None
+        leaves boto's own default in place
+    """
+    if not boto.config.has_section('Boto'):
+        boto.config.add_section('Boto')
+    if timeout is not None:
+        boto.config.set('Boto', 'http_socket_timeout', str(timeout))
+    if retries is not None:
+        boto.config.set('Boto', 'num_retries', str(retries))
+    if idle_seconds is not None:
+        # connections left idle for longer than this aren't reused, as AWS may
+        # well have closed them
+        boto.config.set('Boto', 'connection_stale_duration', str(idle_seconds))
+
+class Connections(object):
+    """ Creates the connection to each service on first use.  A forked worker
+        creates its own rather than sharing the sockets of its parent.
+    """
+
+    def __init__(self, pool_size=10, timeout=None, retries=None, idle_seconds=None):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.idle_seconds = idle_seconds
+        self.lock = threading.Lock()
+        self.connections = {}
+        self.pid = None
+
+    def get(self, name, create):
+        connection = self.connections.get(name) if self.pid == os.getpid() else None
+        if connection is None:
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.connections = {}
+                    self.pid = os.getpid()
+                connection = self.connections.get(name)
+                if connection is None:
+                    configure_boto(self.timeout, self.retries, self.idle_seconds)
+                    connection = create()
+                    # boto doesn't take a pool of its own, so the one it creates
+                    # is replaced before anything has been put in it
+                    connection._pool = BoundedConnectionPool(self.pool_size)
+                    self.connections[name] = connection
+        return connection
+
+    def dynamodb(self):
+        return self.get('dynamodb', DynamoDBConnection)
+
+    def s3(self, bucket_name):
+        def connect():
+            if "." in bucket_name:
+                logging.debug("Using ordinary calling format for s3 connection")
+                return boto.connect_s3(calling_format=OrdinaryCallingFormat())
+            logging.debug("Using standard s3 connection")
+            return boto.connect_s3()
+        return self.get('s3', connect)
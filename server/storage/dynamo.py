@@ -0,0 +1,915 @@
+import os
+import time
+import uuid
+import heapq
+import hashlib
+import socket
+import logging
+import itertools
+import threading
+from io import BytesIO
+from collections import Counter
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+from boto.exception import S3ResponseError
+from boto.dynamodb2.table import Table
+from boto.dynamodb2.items import Item
+from boto.dynamodb2.exceptions import ItemNotFound, ValidationException, ConditionalCheckFailedException
+from boto.dynamodb2.exceptions import ResourceNotFoundException
+from server.storage import StorageBackend, StorageMisconfigured, StreamedBody, get_storage_path_for, read_exactly, read_chunks
+from server.storage import STREAM_CHUNK_SIZE, METADATA_ATTRIBUTES, etag_for, metadata_for
+from server.storage import CONDITION_ATTRIBUTES, following, is_expired
+from server.storage.connections import Connections
+from server.metrics import metrics, CACHE_LOOKUPS, BLOB_WRITES, BLOB_BYTES
+
+# the most keys DynamoDB will accept in a single BatchGetItem
+BATCH_GET_SIZE = 100
+# the most items DynamoDB will accept in a single BatchWriteItem
+BATCH_WRITE_SIZE = 25
+# the largest item DynamoDB will store
+MAX_ITEM_SIZE = 400 * 1024
+# S3 won't accept a multipart upload part smaller than 5MB, other than the last
+MIN_PART_SIZE = 5 * 1024 * 1024
+# the value of the location attribute of a pointer record, for a value stored in s3
+S3_LOCATION = 's3'
+# attributes of an item that aren't metadata of the value it holds
+ITEM_ATTRIBUTES = frozenset(['key', 'path', 'body', 'content-type', 'location', 'blob'])
+# the index table has a hash key of segment and a range key of key.  Keys are
+# spread over INDEX_BUCKETS partitions by a hash of their first segment,
+# everything up to and including the first /, so the keys under a prefix with a
+# / are all in one partition.  Any other prefix is listed by querying every
+# partition and merging what they hold, however many segments there are
+KEYS_PARTITION = 'k:%s'
+INDEX_BUCKETS = 16
+# values that expire are listed in the index by the hour they expire in, in
+# partitions of their own
+EXPIRY_PARTITION = 'x:%s'
+EXPIRY_BUCKET_SECONDS = 3600
+# large values are stored in s3 by the sha256 of their content, as blobs that
+# any number of keys can point to.  Each blob has a record in a partition of the
+# index, with the last time a value was pointed at it, so blobs nothing points
+# to any more can be found and collected
+BLOBS_PARTITION = 'b'
+# leases on work only one process should be doing at a time are kept in a
+# partition of the index, naming who holds them and until when
+LEASES_PARTITION = 'l'
+BLOB_COLLECTOR_LEASE = 'blob-collector'
+
+def metadata_from(item):
+    """ the metadata of the value held by an item, numbers come back from
+        DynamoDB as Decimals so any whole numbers are made ints again
+    """
+    metadata = {}
+    for name, value in item.items():
+        if name in ITEM_ATTRIBUTES:
+            continue
+        if isinstance(value, Decimal) and value == int(value):
+            value = int(value)
+        metadata[name] = value
+    return metadata
+
+def segment_for(key):
+    """ the part of the key it's partitioned by in the index """
+    slash = key.find('/')
+    return key if slash == -1 else key[:slash + 1]
+
+def index_partition_for(key):
+    """ the partition of the index the key is listed in """
+    bucket = int(hashlib.md5(segment_for(key).encode('utf-8')).hexdigest()[:8], 16) % INDEX_BUCKETS
+    return KEYS_PARTITION % (bucket)
+
+def expiry_entry_for(expires, key):
+    """ the index item listing a key under the hour it expires in, ordered by the
+        time it expires
+    """
+    return {'segment': EXPIRY_PARTITION % (expires // EXPIRY_BUCKET_SECONDS), 'key': '%012d %s' % (expires, key)}
+
+def blob_path_for(digest):
+    """ where in s3 the blob with the sha256 digest is stored """
+    return os.path.join('blobs', digest[:2], digest[2:4], digest)
+
+def upload_path():
+    """ a fresh path in s3 for a value being streamed, which nothing reads from,
+        to be kept until the value's content is known and it can become a blob
+    """
+    return os.path.join('uploads', uuid.uuid4().hex)
+
+def item_size(data):
+    """ the size DynamoDB will consider an item to be, the lengths of the attribute
+        names plus the lengths of their values
+    """
+    size = 0
+    for name, value in data.items():
+        if isinstance(value, Decimal) and value == int(value):
+            value = int(value)
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        elif not isinstance(value, bytes):
+            value = str(value)
+        size += len(name) + len(value)
+    return size
+
+class DynamoBackend(StorageBackend):
+    """ Stores values in DynamoDB, or in S3 for anything that is too large to be
+        stored as a DynamoDB item.  Values stored in S3 get a pointer record in
+        DynamoDB so reads know where to find them from a single lookup.  The
+        keys are also written to an index table so they can be listed in order.
+
+        Nothing is connected to until it's first used, see connections.py.
+    """
+
+    def __init__(self, table_name, bucket_name, table=None, bucket=None,
+            s3_fetch_threads=8, batch_retries=5, batch_retry_delay=0.05,
+            legacy_s3_fallback=True, part_size=8 * 1024 * 1024,
+            index_table_name=None, index_table=None, expiry_lookback=7 * 24 * 60 * 60,
+            pool_size=10, timeout=None, retries=None, idle_seconds=None, disk_cache=None,
+            deduplicate_blobs=True, blob_grace_seconds=24 * 60 * 60):
+        super(DynamoBackend, self).__init__()
+        logging.info("Using DDB table: %s" % (table_name))
+        logging.info("Using S3 bucket %s for large objects" %(bucket_name))
+        self.table_name = table_name
+        self.index_table_name = index_table_name or '%s-keys' % (table_name)
+        self.bucket_name = bucket_name
+        # each thread shares the connections, which keep up to pool_size idle
+        # HTTP connections to each service alive for calls to reuse
+        self.connections = Connections(pool_size, timeout, retries, idle_seconds)
+        self.clients_lock = threading.Lock()
+        # the table, index table and bucket are created as they're first used,
+        # unless they're provided
+        self._table = table
+        self._index_table = index_table
+        self._bucket = bucket
+        # how far back the reaper looks for expired values, and the last hour it
+        # has reaped everything from
+        self.expiry_lookback = expiry_lookback
+        self.reaped_through = None
+
+        # S3 transfers for multikey requests run concurrently on this pool
+        self.s3_pool = ThreadPoolExecutor(max_workers=s3_fetch_threads)
+        self.batch_retries = batch_retries
+        self.batch_retry_delay = batch_retry_delay
+        # values stored in s3 before pointer records existed can only be found
+        # by looking in s3 for anything missing from DynamoDB
+        self.legacy_s3_fallback = legacy_s3_fallback
+        # who this backend is when it holds a lease
+        self.lease_holder = '%s:%s' % (socket.gethostname(), uuid.uuid4().hex)
+        # streamed uploads hold at most one part of this size in memory at a time
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        # values read from s3 are kept in the disk cache, if one is provided, and
+        # read from there for as long as their pointer record is unchanged
+        self.disk_cache = disk_cache
+        # large values are stored by their content, so a value that's already in
+        # s3 under another key isn't uploaded again.  A blob nothing points to is
+        # only collected once it's gone unused for the grace period, which has to
+        # be longer than any write takes to point a value at the blob it claimed
+        self.deduplicate_blobs = deduplicate_blobs
+        self.blob_grace_seconds = blob_grace_seconds
+        # what the last collection found in s3, for stats
+        self.blob_summary = None
+
+    @property
+    def table(self):
+        if self._table is None:
+            with self.clients_lock:
+                if self._table is None:
+                    self._table = Table(self.table_name, connection=self.connections.dynamodb())
+        return self._table
+
+    @property
+    def index_table(self):
+        if self._index_table is None:
+            with self.clients_lock:
+                if self._index_table is None:
+                    self._index_table = Table(self.index_table_name, connection=self.connections.dynamodb())
+        return self._index_table
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            with self.clients_lock:
+                if self._bucket is None:
+                    # the bucket is known to exist, so there's no need to make a
+                    # call to find out
+                    self._bucket = self.connections.s3(self.bucket_name).get_bucket(self.bucket_name, validate=False)
+        return self._bucket
+
+    def warm_up(self):
+        # anything will do, so long as a connection is left open to be reused
+        with self.timed('dynamodb', 'warm_up'):
+            try:
+                self.table.get_item(path='__warm_up__')
+            except ItemNotFound:
+                pass
+            # every write lists its key in the index, so none would succeed
+            try:
+                self.index_table.describe()
+            except ResourceNotFoundException:
+                raise StorageMisconfigured("the index table %s doesn't exist" % (self.index_table_name))
+        with self.timed('s3', 'warm_up'):
+            self.bucket.get_key('__warm_up__')
+
+    def item_for(self, key, data, content_type, metadata=None):
+        item = metadata_for(etag_for(data), metadata)
+        item.update({'key': key, 'path': get_storage_path_for(key), 'body': data, 'content-type': content_type})
+        return item
+
+    def pointer_for(self, item):
+        pointer = dict((name, value) for name, value in item.items() if name != 'body')
+        pointer['location'] = S3_LOCATION
+        return pointer
+
+    def store(self, key, data, content_type, metadata=None):
+        item = self.item_for(key, data, content_type, metadata)
+        if item_size(item) > MAX_ITEM_SIZE:
+            self.store_in_s3(item)
+            self.index_keys([(key, item.get('expires'))])
+            return
+        try:
+            with self.timed('dynamodb', 'put'):
+                self.table.put_item(data=item, overwrite=True)
+            self.count('dynamo_writes')
+        except ValidationException as e:
+            # our estimate of the size was off, so it goes in our s3
+            # kvstore 'big stuff' bucket after all
+            self.count('dynamo_oversize_rejections')
+            self.store_in_s3(item)
+        self.index_keys([(key, item.get('expires'))])
+
+    def store_if(self, key, data, content_type, metadata=None, expected=None):
+        item = self.item_for(key, data, content_type, following(metadata, expected))
+        if item_size(item) > MAX_ITEM_SIZE:
+            # the body goes in s3 first, as a blob nothing points to until the
+            # pointer to it is written, which is what the condition is put on
+            self.upload_value(item, conditional=True)
+            item = self.pointer_for(item)
+        try:
+            with self.timed('dynamodb', 'conditional_put'):
+                self.table._put_item(Item(self.table, data=item).prepare_full(), expects=self.expects_for(expected))
+        except ConditionalCheckFailedException:
+            self.count('conditional_write_conflicts')
+            return False
+        self.count('dynamo_writes')
+        self.index_keys([(key, item.get('expires'))])
+        return True
+
+    def expects_for(self, expected):
+        """ the expectations DynamoDB checks before a conditional write that the
+            stored value is as expected.  Anything the value was expected to have
+            that it didn't is expected to still be missing
+        """
+        if expected is None:
+            return {'path': {'Exists': False}}
+        return dict((name, {'Value': self.table._dynamizer.encode(expected[name]), 'Exists': True}
+            if expected.get(name) is not None else {'Exists': False}) for name in CONDITION_ATTRIBUTES)
+
+    def store_in_s3(self, item):
+        self.upload_value(item)
+        with self.timed('dynamodb', 'put'):
+            self.table.put_item(data=self.pointer_for(item), overwrite=True)
+
+    def upload_value(self, item, conditional=False):
+        """ puts the body of the item in s3.  Deduplicated bodies are stored as the
+            blob of their content, which the item is then given the digest of.
+            Nothing can be put at the key's own path for a conditional write, as
+            it would replace the stored value before the condition is checked, so
+            its body is always stored as a blob, one of its own if need be
+        """
+        if not self.deduplicate_blobs and not conditional:
+            self.upload_to_s3(item['key'], item['body'], item['content-type'])
+            return
+        data = item['body'].encode('utf-8') if isinstance(item['body'], str) else item['body']
+        digest = hashlib.sha256(data).hexdigest()
+        claimed = self.claim_blob(digest, len(data)) if self.deduplicate_blobs else None
+        if claimed is None:
+            if self.deduplicate_blobs:
+                # being collected, so this value gets a copy of its own
+                self.count('blob_claim_conflicts')
+            if not conditional:
+                self.upload_to_s3(item['key'], data, item['content-type'])
+                return
+            # a blob no other value will point to, collected like any other
+            digest = '%s-%s' % (digest, item['version'])
+        if claimed:
+            self.count_blob_write('deduplicated', len(data))
+        else:
+            blob = self.bucket.new_key(blob_path_for(digest))
+            blob.set_metadata('content-type', item['content-type'])
+            with self.timed('s3', 'put'):
+                blob.set_contents_from_string(data)
+            self.count('s3_writes')
+            self.record_blob(digest, len(data))
+            self.count_blob_write('uploaded', len(data))
+        item['blob'] = digest
+
+    def count_blob_write(self, result, size):
+        self.count('blob_%s' % (result))
+        self.count('blob_%s_bytes' % (result), size)
+        metrics.inc(BLOB_WRITES, result=result)
+        metrics.inc(BLOB_BYTES, size, result=result)
+
+    def claim_blob(self, digest, size):
+        """ marks the blob as just used, so it won't be collected before the value
+            being stored points to it.  Returns True if the blob is already stored,
+            False if it isn't and None if it's being collected
+        """
+        try:
+            with self.timed('dynamodb', 'blob_get'):
+                record = self.index_table.get_item(segment=BLOBS_PARTITION, key=digest)
+        except ItemNotFound:
+            return False
+        if record.get('condemned') is not None:
+            return None
+        data = {'segment': BLOBS_PARTITION, 'key': digest, 'size': size, 'referenced': int(time.time())}
+        # a collection condemns a blob only if it hasn't been claimed since it
+        # looked, so one of the two writes to the record fails
+        expects = {'key': {'Value': self.index_table._dynamizer.encode(digest), 'Exists': True},
+            'condemned': {'Exists': False}}
+        try:
+            with self.timed('dynamodb', 'blob_claim'):
+                self.index_table._put_item(Item(self.index_table, data=data).prepare_full(), expects=expects)
+        except ConditionalCheckFailedException:
+            return None
+        return True
+
+    def record_blob(self, digest, size):
+        """ adds the record of a blob once it's in s3, a blob is never recorded
+            before it's there to be found
+        """
+        with self.timed('dynamodb', 'blob_put'):
+            self.index_table.put_item(data={'segment': BLOBS_PARTITION, 'key': digest, 'size': size,
+                'referenced': int(time.time())}, overwrite=True)
+
+    def upload_to_s3(self, key, data, content_type):
+        newS3Key = self.bucket.new_key(get_storage_path_for(key))
+        newS3Key.set_metadata('content-type', content_type)
+        newS3Key.set_metadata('key', key)
+        with self.timed('s3', 'put'):
+            newS3Key.set_contents_from_string(data)
+        self.count('s3_writes')
+
+    def store_stream(self, key, stream, content_type, content_length, metadata=None):
+        if content_length <= MAX_ITEM_SIZE:
+            # small enough that it may fit in DynamoDB
+            self.store(key, read_exactly(stream, content_length), content_type, metadata=metadata)
+        elif content_length <= self.part_size:
+            item = self.item_for(key, read_exactly(stream, content_length), content_type, metadata)
+            self.store_in_s3(item)
+            self.index_keys([(key, item.get('expires'))])
+        else:
+            # the value is streamed somewhere of its own, the key's path would
+            # have it read with the metadata of the value it's replacing
+            path = upload_path()
+            etag, digest = self.multipart_upload_to_s3(key, path, stream, content_type, content_length)
+            item = metadata_for(etag, metadata)
+            item.update({'key': key, 'path': get_storage_path_for(key), 'content-type': content_type})
+            try:
+                self.adopt_upload(item, path, digest, content_length)
+            except:
+                # nothing would ever find it to collect it
+                with self.timed('s3', 'delete'):
+                    self.bucket.delete_key(path)
+                raise
+            self.switch_pointer(item)
+            self.index_keys([(key, item.get('expires'))])
+
+    def multipart_upload_to_s3(self, key, path, stream, content_type, content_length):
+        """ uploads the stream to the path in s3 a part at a time, returning the
+            etag and sha256 digest of all that was uploaded
+        """
+        hash_o = hashlib.md5()
+        digest_o = hashlib.sha256()
+        upload = self.bucket.initiate_multipart_upload(path, metadata={'content-type': content_type, 'key': key})
+        try:
+            remaining = content_length
+            part_number = 0
+            while remaining > 0:
+                part = read_exactly(stream, min(self.part_size, remaining))
+                if not part:
+                    raise IOError("stream ended %s bytes short of its content length" % (remaining))
+                remaining -= len(part)
+                part_number += 1
+                hash_o.update(part)
+                digest_o.update(part)
+                with self.timed('s3', 'put_part'):
+                    upload.upload_part_from_file(BytesIO(part), part_number)
+            with self.timed('s3', 'complete_upload'):
+                upload.complete_upload()
+        except:
+            upload.cancel_upload()
+            raise
+        self.count('s3_writes')
+        self.count('s3_multipart_uploads')
+        return hash_o.hexdigest(), digest_o.hexdigest()
+
+    def adopt_upload(self, item, path, digest, size):
+        """ makes what was streamed to the path in s3 the blob of its content.  The
+            content isn't known until it's been uploaded, so only the storage of a
+            duplicate is saved, not its upload.  Without deduplication, or if the
+            blob is being collected, the value gets a blob of its own
+        """
+        claimed = self.claim_blob(digest, size) if self.deduplicate_blobs else None
+        if claimed is None:
+            if self.deduplicate_blobs:
+                self.count('blob_claim_conflicts')
+            # a blob no other value will point to, collected like any other
+            digest = '%s-%s' % (digest, item['version'])
+        if claimed:
+            self.count_blob_write('deduplicated', size)
+        else:
+            with self.timed('s3', 'copy'):
+                self.bucket.copy_key(blob_path_for(digest), self.bucket_name, path)
+            self.record_blob(digest, size)
+            self.count_blob_write('uploaded', size)
+        with self.timed('s3', 'delete'):
+            self.bucket.delete_key(path)
+        item['blob'] = digest
+
+    def switch_pointer(self, item):
+        """ points the key at the blob of the item, unless a later version of the
+            value has been stored while it was being uploaded.  What the key
+            pointed to before is left to be collected, other than a value at the
+            key's own path in s3 which nothing else can point to
+        """
+        try:
+            with self.timed('dynamodb', 'conditional_put'):
+                result = self.table.connection.put_item(self.table.table_name,
+                    Item(self.table, data=self.pointer_for(item)).prepare_full(),
+                    condition_expression='attribute_not_exists(#version) OR #version < :version',
+                    expression_attribute_names={'#version': 'version'},
+                    expression_attribute_values={':version': self.table._dynamizer.encode(item['version'])},
+                    return_values='ALL_OLD')
+        except ConditionalCheckFailedException:
+            self.count('conditional_write_conflicts')
+            return
+        previous = dict((name, self.table._dynamizer.decode(value)) for name, value in result.get('Attributes', {}).items())
+        if previous.get('location') == S3_LOCATION and previous.get('blob') is None:
+            with self.timed('s3', 'delete'):
+                self.bucket.delete_key(get_storage_path_for(item['key']))
+
+    def store_many(self, items):
+        items_by_path = {}
+        for key, data, content_type, metadata in items:
+            items_by_path[get_storage_path_for(key)] = self.item_for(key, data, content_type, metadata)
+
+        results = {}
+        to_dynamo = []
+        to_s3 = []
+        for item in items_by_path.values():
+            if item_size(item) > MAX_ITEM_SIZE:
+                # no point in asking DynamoDB to store something we know it won't
+                to_s3.append(item)
+            else:
+                to_dynamo.append(item)
+
+        def upload(item):
+            try:
+                self.upload_value(item)
+                return None
+            except Exception as e:
+                logging.exception("unable to store %s in s3", item['key'])
+                return str(e)
+
+        uploads = self.s3_pool.map(upload, to_s3)
+        self.write_batches(to_dynamo, results)
+        self.count('dynamo_writes', len([item for item in to_dynamo if results[item['key']] is None]))
+
+        # pointers are only written once their value is in s3, so there's never a
+        # pointer to something that isn't there
+        pointers = []
+        for item, error in zip(to_s3, uploads):
+            if error:
+                results[item['key']] = error
+            else:
+                pointers.append(self.pointer_for(item))
+        self.write_batches(pointers, results)
+        self.index_keys([(item['key'], item.get('expires')) for item in items_by_path.values()
+            if results.get(item['key']) is None])
+        return results
+
+    def write_batches(self, items, results):
+        for offset in range(0, len(items), BATCH_WRITE_SIZE):
+            batch = items[offset:offset + BATCH_WRITE_SIZE]
+            try:
+                unprocessed = self.batch_write(batch)
+            except ValidationException as e:
+                # something in the batch was bigger than we figured, so store
+                # each of them on their own letting store sort out where it goes
+                for item in batch:
+                    results[item['key']] = self.store_one(item)
+                continue
+            for item in batch:
+                if item['path'] in unprocessed:
+                    results[item['key']] = "unprocessed by DynamoDB, try again"
+                else:
+                    results[item['key']] = None
+
+    def store_one(self, item):
+        try:
+            if item.get('location') == S3_LOCATION:
+                with self.timed('dynamodb', 'put'):
+                    self.table.put_item(data=item, overwrite=True)
+            else:
+                self.store(item['key'], item['body'], item['content-type'], metadata=metadata_from(item))
+            return None
+        except Exception as e:
+            logging.exception("unable to store %s", item['key'])
+            return str(e)
+
+    def batch_write(self, items):
+        """ writes up to BATCH_WRITE_SIZE items, retrying with backoff for any that
+            DynamoDB reports as unprocessed.  Returns the paths of any items that
+            still weren't written once we've run out of retries.
+        """
+        requests = [{'PutRequest': {'Item': Item(self.table, data=item).prepare_full()}} for item in items]
+        delay = self.batch_retry_delay
+        for attempt in range(self.batch_retries + 1):
+            with self.timed('dynamodb', 'batch_write'):
+                response = self.table.connection.batch_write_item({self.table.table_name: requests})
+            requests = response.get('UnprocessedItems', {}).get(self.table.table_name, [])
+            if not requests:
+                return set()
+            logging.debug("%s items unprocessed by batch write, retrying in %ss", len(requests), delay)
+            time.sleep(delay)
+            delay *= 2
+        return set(request['PutRequest']['Item']['path']['S'] for request in requests)
+
+    def read(self, key, stream=False):
+        read_from_s3 = self.stream_from_s3 if stream else self.read_from_s3
+        try:
+            with self.timed('dynamodb', 'get'):
+                item = self.table.get_item(path=get_storage_path_for(key))
+        except ItemNotFound as e:
+            if self.legacy_s3_fallback:
+                # could be super big and stored before we kept pointers, so we'll
+                # try our s3 bucket before giving up for good
+                self.count('legacy_s3_reads')
+                return read_from_s3(key, {})
+            return None, None, None, None
+        if item.get('location') == S3_LOCATION:
+            self.count('s3_pointer_reads')
+            return read_from_s3(key, metadata_from(item), item)
+        self.count('dynamo_reads')
+        return item['content-type'], item['body'], key, metadata_from(item)
+
+    def read_metadata(self, key):
+        # only the metadata is fetched so a large body isn't transferred for nothing
+        try:
+            with self.timed('dynamodb', 'get_metadata'):
+                item = self.table.get_item(path=get_storage_path_for(key),
+                    attributes=['content-type', 'location'] + METADATA_ATTRIBUTES)
+        except ItemNotFound as e:
+            return None, None
+        self.count('dynamo_metadata_reads')
+        return item['content-type'], metadata_from(item)
+
+    def validator_for(self, metadata):
+        """ what a value is cached on disk with, None if it can't be cached as
+            there's no pointer record to check it against
+        """
+        if not self.disk_cache or not metadata.get('etag'):
+            return None
+        return [metadata.get(name) for name in CONDITION_ATTRIBUTES]
+
+    def open_cached(self, key, validator):
+        """ returns the header and file of the value cached on disk for the key, or
+            (None, None) if it isn't cached
+        """
+        if validator is None:
+            return None, None
+        with self.timed('disk_cache', 'open'):
+            header, cached_file = self.disk_cache.open(key, validator)
+        metrics.inc(CACHE_LOOKUPS, cache='disk', result='hit' if header else 'miss')
+        return header, cached_file
+
+    def s3_key_for(self, key, pointer):
+        """ the s3 key the value is found at and its content type, which for a
+            blob shared by other keys is the one in the pointer record
+        """
+        if pointer and pointer.get('blob'):
+            return self.bucket.new_key(blob_path_for(pointer['blob'])), pointer['content-type']
+        return self.bucket.new_key(get_storage_path_for(key)), None
+
+    def read_from_s3(self, key, metadata, pointer=None):
+        validator = self.validator_for(metadata)
+        header, cached_file = self.open_cached(key, validator)
+        if header:
+            with cached_file, self.timed('disk_cache', 'read'):
+                return header['content-type'], cached_file.read(), key, metadata
+        try:
+            s3Key, content_type = self.s3_key_for(key, pointer)
+            with self.timed('s3', 'get'):
+                body = s3Key.get_contents_as_string()
+            content_type = content_type or s3Key.get_metadata('content-type')
+            if validator is not None:
+                self.disk_cache.put(key, validator, {'content-type': content_type}, body)
+            return content_type, body, key, metadata
+        except S3ResponseError as e:
+            logging.debug("unable to find item for key %s anywhere\n%s", key, e)
+
+        return None, None, None, None
+
+    def stream_from_s3(self, key, metadata, pointer=None):
+        validator = self.validator_for(metadata)
+        header, cached_file = self.open_cached(key, validator)
+        if header:
+            size = os.fstat(cached_file.fileno()).st_size - cached_file.tell()
+            body = StreamedBody(read_chunks(cached_file), size, on_close=cached_file.close, file=cached_file)
+            return header['content-type'], body, key, metadata
+        s3Key, content_type = self.s3_key_for(key, pointer)
+        try:
+            with self.timed('s3', 'open'):
+                s3Key.open_read()
+        except S3ResponseError as e:
+            logging.debug("unable to find item for key %s anywhere\n%s", key, e)
+            return None, None, None, None
+        content_type = content_type or s3Key.get_metadata('content-type')
+
+        def chunks():
+            while True:
+                chunk = s3Key.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+        body = chunks()
+        if validator is not None:
+            # cached as it's streamed to the client
+            body = self.disk_cache.tee(key, validator, {'content-type': content_type}, body, s3Key.size)
+        return content_type, StreamedBody(body, s3Key.size, on_close=s3Key.close), key, metadata
+
+    def read_many(self, keys):
+        keys_by_path = dict((get_storage_path_for(key), key) for key in keys)
+        found = {}
+        paths = list(keys_by_path.keys())
+        in_s3 = {}
+        for offset in range(0, len(paths), BATCH_GET_SIZE):
+            for item in self.batch_get(paths[offset:offset + BATCH_GET_SIZE]):
+                key = keys_by_path[item['path']]
+                if item.get('location') == S3_LOCATION:
+                    in_s3[key] = (metadata_from(item), item)
+                else:
+                    found[key] = (item['content-type'], item['body'], key, metadata_from(item))
+        self.count('dynamo_reads', len(found))
+        self.count('s3_pointer_reads', len(in_s3))
+
+        if self.legacy_s3_fallback:
+            missing = [key for key in keys_by_path.values() if key not in found and key not in in_s3]
+            self.count('legacy_s3_reads', len(missing))
+            for key in missing:
+                in_s3[key] = ({}, None)
+
+        # fetch everything from s3 at once
+        in_s3 = list(in_s3.items())
+        results = self.s3_pool.map(lambda key_and_pointer: self.read_from_s3(key_and_pointer[0], *key_and_pointer[1]), in_s3)
+        for (key, pointer), result in zip(in_s3, results):
+            if result[1] is not None:
+                found[key] = result
+        return found
+
+    def batch_get(self, paths, attributes=None):
+        """ fetches up to BATCH_GET_SIZE items, or only their attributes if they're
+            given, retrying with backoff for any keys DynamoDB reports as
+            unprocessed
+        """
+        items = []
+        keys = [{'path': path} for path in paths]
+        delay = self.batch_retry_delay
+        for attempt in range(self.batch_retries + 1):
+            # the public batch_get drops unprocessed keys if a page comes back
+            # without any results, so we handle the retries ourselves
+            with self.timed('dynamodb', 'batch_get'):
+                results = self.table._batch_get(keys=keys, attributes=attributes)
+            items.extend(results['results'])
+            keys = results['unprocessed_keys']
+            if not keys:
+                return items
+            logging.debug("%s keys unprocessed by batch get, retrying in %ss", len(keys), delay)
+            time.sleep(delay)
+            delay *= 2
+        # we've been throttled for long enough, finish up one item at a time
+        for key in keys:
+            try:
+                with self.timed('dynamodb', 'get'):
+                    items.append(self.table.get_item(attributes=attributes, **key))
+            except ItemNotFound:
+                pass
+        return items
+
+    def unexpired_keys(self, keys, now=None):
+        # the expiry of each of the keys, fetched all at once
+        keys_by_path = dict((get_storage_path_for(key), key) for key in keys)
+        paths = list(keys_by_path.keys())
+        expired = set()
+        for offset in range(0, len(paths), BATCH_GET_SIZE):
+            for item in self.batch_get(paths[offset:offset + BATCH_GET_SIZE], attributes=['path', 'expires']):
+                if is_expired(metadata_from(item), now):
+                    expired.add(keys_by_path[item['path']])
+        return [key for key in keys if key not in expired]
+
+    def delete(self, key):
+        with self.timed('dynamodb', 'delete'):
+            deleted = self.delete_item(key)
+        self.delete_everything_else(key, deleted)
+
+    def delete_if(self, key, expected):
+        with self.timed('dynamodb', 'conditional_delete'):
+            deleted = self.delete_item(key, self.expects_for(expected))
+        if deleted is None:
+            self.count('conditional_write_conflicts')
+            return False
+        self.delete_everything_else(key, deleted)
+        return True
+
+    def delete_item(self, key, expects=None):
+        """ deletes the item of the key, so long as it meets the expectations,
+            returning what it held.  Returns an empty dictionary if there was no
+            item, or None if it didn't meet them
+        """
+        try:
+            result = self.table.connection.delete_item(self.table.table_name,
+                {'path': self.table._dynamizer.encode(get_storage_path_for(key))},
+                expected=expects, return_values='ALL_OLD')
+        except ConditionalCheckFailedException:
+            return None
+        return dict((name, self.table._dynamizer.decode(value)) for name, value in result.get('Attributes', {}).items())
+
+    def delete_everything_else(self, key, item):
+        """ deletes what's kept for the key other than its item, which held item """
+        # a value stored at the key's own path in s3, rather than as a blob, goes
+        # with its pointer.  While the legacy fallback is on, anything at that
+        # path could be found once the item has gone, a value from before
+        # pointers were kept may be there whatever the item held
+        if self.legacy_s3_fallback or (item.get('location') == S3_LOCATION and item.get('blob') is None):
+            with self.timed('s3', 'delete'):
+                self.bucket.delete_key(get_storage_path_for(key))
+        with self.timed('dynamodb', 'index_delete'):
+            self.index_table.delete_item(segment=index_partition_for(key), key=key)
+
+    def index_keys(self, keys):
+        """ adds the (key, expires) tuples to the index.  Keys that expire are also
+            listed under the hour they expire in
+        """
+        if not keys:
+            return
+        with self.timed('dynamodb', 'index_write'):
+            if len(keys) == 1 and keys[0][1] is None:
+                self.index_table.put_item(data={'segment': index_partition_for(keys[0][0]), 'key': keys[0][0]}, overwrite=True)
+            else:
+                with self.index_table.batch_write() as batch:
+                    for key, expires in keys:
+                        batch.put_item(data={'segment': index_partition_for(key), 'key': key})
+                        if expires is not None:
+                            batch.put_item(data=expiry_entry_for(int(expires), key))
+
+    def expired_entries(self, now, limit=100):
+        # the hours that can't have anything left in them are skipped, until this
+        # process has reaped one we look back as far as expiry_lookback
+        first_hour = self.reaped_through + 1 if self.reaped_through is not None else (now - self.expiry_lookback) // EXPIRY_BUCKET_SECONDS
+        current_hour = now // EXPIRY_BUCKET_SECONDS
+        entries = []
+        all_reaped = True
+        with self.timed('dynamodb', 'index_read'):
+            for hour in range(first_hour, current_hour + 1):
+                remaining = limit - len(entries)
+                results = self.index_table.query_2(segment__eq=EXPIRY_PARTITION % (hour),
+                    key__lt='%012d' % (now + 1), max_page_size=remaining)
+                found = 0
+                for item in results:
+                    expires, key = item['key'].split(' ', 1)
+                    entries.append((int(expires), key))
+                    found += 1
+                    if found >= remaining:
+                        break
+                # an hour that's over is done with once everything in it is reaped
+                all_reaped = all_reaped and found < remaining and hour < current_hour
+                if all_reaped:
+                    self.reaped_through = hour
+                if len(entries) >= limit:
+                    break
+        return entries
+
+    def remove_expired_entries(self, entries):
+        with self.timed('dynamodb', 'index_delete'):
+            with self.index_table.batch_write() as batch:
+                for expires, key in entries:
+                    batch.delete_item(**expiry_entry_for(expires, key))
+
+    def collect_blobs(self, now=None, lease_seconds=None):
+        now = int(now if now is not None else time.time())
+        # a collection that outlasts the lease may overlap with the next holder's,
+        # which is only wasted work as each blob is condemned before it's removed
+        if lease_seconds is not None and not self.hold_lease(BLOB_COLLECTOR_LEASE, lease_seconds, now):
+            return []
+        # everything pointing at a blob, it takes a scan of the whole table
+        references = Counter()
+        with self.timed('dynamodb', 'scan'):
+            for item in self.table.scan(blob__null=False, attributes=['blob']):
+                references[item['blob']] += 1
+        summary = Counter()
+        collected = []
+        with self.timed('dynamodb', 'index_read'):
+            records = list(self.index_table.query_2(segment__eq=BLOBS_PARTITION))
+        for record in records:
+            digest = record['key']
+            size = int(record.get('size', 0))
+            if references[digest]:
+                summary['blobs'] += 1
+                summary['stored_bytes'] += size
+                summary['references'] += references[digest]
+                summary['referenced_bytes'] += size * references[digest]
+                continue
+            if record.get('condemned') is None:
+                # it may have been claimed by a write that's yet to point to it
+                if int(record['referenced']) > now - self.blob_grace_seconds or not self.condemn_blob(record, now):
+                    summary['unreferenced_blobs'] += 1
+                    summary['stored_bytes'] += size
+                    continue
+            # a condemned blob can't be claimed, so it's safe to remove.  The
+            # record goes last so an interrupted collection is picked up again
+            with self.timed('s3', 'delete'):
+                self.bucket.delete_key(blob_path_for(digest))
+            with self.timed('dynamodb', 'index_delete'):
+                self.index_table.delete_item(segment=BLOBS_PARTITION, key=digest)
+            collected.append(digest)
+        summary['saved_bytes'] = summary['referenced_bytes'] - summary['stored_bytes']
+        self.blob_summary = dict(summary, collected_at=now)
+        self.count('blobs_collected', len(collected))
+        return collected
+
+    def hold_lease(self, name, seconds, now=None):
+        """ takes the named lease, or renews it if it's already held, for seconds.
+            Returns False if it's held by someone else
+        """
+        now = int(now if now is not None else time.time())
+        try:
+            with self.timed('dynamodb', 'lease_get'):
+                record = self.index_table.get_item(segment=LEASES_PARTITION, key=name)
+        except ItemNotFound:
+            record = None
+        if record is not None and record['holder'] != self.lease_holder and int(record['expires']) > now:
+            return False
+        # anyone else taking the lease at the same time changes the record from
+        # what was read, so only one of the writes succeeds
+        if record is None:
+            expects = {'key': {'Exists': False}}
+        else:
+            expects = dict((attribute, {'Value': self.index_table._dynamizer.encode(record[attribute]), 'Exists': True})
+                for attribute in ('holder', 'expires'))
+        data = {'segment': LEASES_PARTITION, 'key': name, 'holder': self.lease_holder, 'expires': now + seconds}
+        try:
+            with self.timed('dynamodb', 'lease_put'):
+                self.index_table._put_item(Item(self.index_table, data=data).prepare_full(), expects=expects)
+        except ConditionalCheckFailedException:
+            return False
+        return True
+
+    def condemn_blob(self, record, now):
+        """ marks the blob as being collected, so long as it hasn't been claimed
+            since the record was read
+        """
+        data = dict(record, condemned=now)
+        expects = {'referenced': {'Value': self.index_table._dynamizer.encode(record['referenced']), 'Exists': True},
+            'condemned': {'Exists': False}}
+        try:
+            with self.timed('dynamodb', 'blob_condemn'):
+                self.index_table._put_item(Item(self.index_table, data=data).prepare_full(), expects=expects)
+        except ConditionalCheckFailedException:
+            return False
+        return True
+
+    def stats(self):
+        stats = super(DynamoBackend, self).stats()
+        writes = stats.get('blob_uploaded', 0) + stats.get('blob_deduplicated', 0)
+        if writes:
+            stats['blob_dedup_ratio'] = round(stats.get('blob_deduplicated', 0) / float(writes), 4)
+        if self.blob_summary:
+            stats['blob_storage'] = dict(self.blob_summary)
+        return stats
+
+    def query_index(self, partition, prefix, page_size, start_after=None):
+        """ yields the range keys of the partition that start with the prefix, in
+            order, from the first after start_after.  Pages are fetched as they're
+            needed
+        """
+        if start_after is not None and start_after >= prefix:
+            results = self.index_table.query_2(segment__eq=partition, key__gt=start_after, max_page_size=page_size)
+        else:
+            results = self.index_table.query_2(segment__eq=partition, key__gte=prefix, max_page_size=page_size)
+        for item in results:
+            if not item['key'].startswith(prefix):
+                return
+            yield item['key']
+
+    def list_keys(self, prefix='', start_after=None, limit=100):
+        if '/' in prefix:
+            partitions = [index_partition_for(prefix)]
+            page_size = limit
+        else:
+            # the keys could be in any of the partitions, each is likely to hold
+            # a share of them so they're read in smaller pages
+            partitions = [KEYS_PARTITION % (bucket) for bucket in range(INDEX_BUCKETS)]
+            page_size = min(limit, max(10, 2 * limit // INDEX_BUCKETS))
+        with self.timed('dynamodb', 'index_read'):
+            keys = heapq.merge(*[self.query_index(partition, prefix, page_size, start_after=start_after)
+                for partition in partitions])
+            return list(itertools.islice(keys, limit))
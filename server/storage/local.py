@@ -0,0 +1,313 @@
+import os
+import json
+import time
+import fcntl
+import errno
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+from server.storage import StorageBackend, StreamedBody, get_storage_path_for, read_chunks
+from server.storage import etag_for, metadata_for, prefix_end, is_expected, is_expired, following
+from server.storage import STREAM_CHUNK_SIZE
+
+# header attributes that describe the file rather than being metadata of the value
+FILE_ATTRIBUTES = frozenset(['key', 'content-type', 'encoding'])
+# the sqlite database, under the root path, that keeps the stored keys in order
+INDEX_FILE_NAME = 'keys.sqlite3'
+# the most keys looked up in the index by a single query, sqlite limits the
+# number of parameters a query can have
+INDEX_QUERY_SIZE = 500
+
+class LocalBackend(StorageBackend):
+    """ Stores each value in its own file on local disk, sharded using the same
+        sha256 fan-out as get_storage_path_for.  Each file is a single line of
+        JSON metadata followed by the raw body.  Writes go to a temp file that is
+        renamed into place so readers never see a partially written value.  The
+        keys are also kept in a sqlite index so they can be listed in order.
+    """
+
+    def __init__(self, root_path, stream_threshold=1024 * 1024):
+        super(LocalBackend, self).__init__()
+        logging.info("Using local storage under: %s" % (root_path))
+        self.root_path = root_path
+        # bodies larger than this are streamed from disk when asked to
+        self.stream_threshold = stream_threshold
+        self.index_path = os.path.join(root_path, INDEX_FILE_NAME)
+        # sqlite connections can't be shared between threads
+        self.index_connections = threading.local()
+
+    def warm_up(self):
+        self.index()
+
+    def get_file_path_for(self, key):
+        return os.path.join(self.root_path, get_storage_path_for(key))
+
+    def store(self, key, data, content_type, metadata=None):
+        file_path = self.get_file_path_for(key)
+        header = metadata_for(etag_for(data), metadata)
+        header.update({'key': key, 'content-type': content_type})
+        if isinstance(data, str):
+            # remember that we were handed a string so we hand back the same
+            data = data.encode('utf-8')
+            header['encoding'] = 'utf-8'
+        elif data is None:
+            data = b''
+        with self.timed('local', 'write'):
+            self.write_file(file_path, header, [data])
+        self.index_key(key, header.get('expires'))
+
+    def store_if(self, key, data, content_type, metadata=None, expected=None):
+        with self.locked(key):
+            if not self.has_expected(key, expected):
+                return False
+            self.store(key, data, content_type, metadata=following(metadata, expected))
+            return True
+
+    @contextmanager
+    def locked(self, key):
+        """ locks the directory of the key, so checking what's stored and changing
+            it can't be interleaved with another conditional write or delete, from
+            this process or any other
+        """
+        directory = os.path.dirname(self.get_file_path_for(key))
+        os.makedirs(directory, exist_ok=True)
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            with self.timed('local', 'lock'):
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def has_expected(self, key, expected):
+        stored_content_type, stored = self.read_metadata(key)
+        if not is_expected(stored, expected):
+            self.count('conditional_write_conflicts')
+            return False
+        return True
+
+    def store_stream(self, key, stream, content_type, content_length, metadata=None):
+        # the etag isn't known until we've read the whole stream
+        header = metadata_for(None, metadata)
+        header.update({'key': key, 'content-type': content_type})
+
+        def chunks():
+            remaining = content_length
+            while remaining > 0:
+                chunk = stream.read(min(STREAM_CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise IOError("stream ended %s bytes short of its content length" % (remaining))
+                remaining -= len(chunk)
+                yield chunk
+
+        with self.timed('local', 'write'):
+            self.write_file(self.get_file_path_for(key), header, chunks())
+        self.index_key(key, header.get('expires'))
+
+    def store_copy(self, key, chunks, content_type, metadata, encoding=None):
+        """ stores a copy of a value kept elsewhere as it is, metadata and all,
+            unless what's stored already is as late a version.  Returns False if
+            it wasn't stored
+        """
+        with self.locked(key):
+            stored_content_type, stored = self.read_metadata(key)
+            if stored and stored.get('version', 0) >= metadata.get('version', 0):
+                return False
+            header = dict(metadata)
+            header.update({'key': key, 'content-type': content_type})
+            if encoding:
+                header['encoding'] = encoding
+            with self.timed('local', 'write'):
+                self.write_file(self.get_file_path_for(key), header, chunks)
+            self.index_key(key, header.get('expires'))
+            return True
+
+    def delete_copy(self, key, version):
+        """ deletes the copy of a value deleted elsewhere, unless what's stored is
+            a later version than the one that was deleted.  Returns False if it
+            wasn't deleted
+        """
+        with self.locked(key):
+            stored_content_type, stored = self.read_metadata(key)
+            if stored and stored.get('version', 0) > version:
+                return False
+            self.delete(key)
+            return True
+
+    def write_file(self, file_path, header, chunks):
+        """ writes the header line and the chunks of the body to file_path, if the
+            header has no etag it's calculated from the chunks as they're written
+        """
+        hash_o = None
+        if header['etag'] is None:
+            # md5 hex digests are always the same length, so a placeholder can be
+            # written and the header rewritten in place once the body is written
+            hash_o = hashlib.md5()
+            header['etag'] = '0' * hash_o.digest_size * 2
+        directory = os.path.dirname(file_path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                temp_file.write(json.dumps(header).encode('utf-8'))
+                temp_file.write(b'\n')
+                for chunk in chunks:
+                    if hash_o:
+                        hash_o.update(chunk)
+                    temp_file.write(chunk)
+                if hash_o:
+                    header['etag'] = hash_o.hexdigest()
+                    temp_file.seek(0)
+                    temp_file.write(json.dumps(header).encode('utf-8'))
+            os.replace(temp_path, file_path)
+        except:
+            os.unlink(temp_path)
+            raise
+
+    def open_file(self, key):
+        """ returns the open file for the key and its header, or (None, None) if
+            there's nothing stored for the key
+        """
+        try:
+            stored_file = open(self.get_file_path_for(key), 'rb')
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            logging.debug("unable to find item for key %s", key)
+            return None, None
+        try:
+            return stored_file, json.loads(stored_file.readline())
+        except:
+            stored_file.close()
+            raise
+
+    def metadata_from(self, header):
+        return dict((name, value) for name, value in header.items() if name not in FILE_ATTRIBUTES)
+
+    def read(self, key, stream=False):
+        with self.timed('local', 'open'):
+            stored_file, header = self.open_file(key)
+        if stored_file is None:
+            return None, None, None, None
+        metadata = self.metadata_from(header)
+        size = os.fstat(stored_file.fileno()).st_size - stored_file.tell()
+        if stream and size > self.stream_threshold and not header.get('encoding'):
+            body = StreamedBody(read_chunks(stored_file), size, on_close=stored_file.close)
+            return header['content-type'], body, key, metadata
+        with stored_file, self.timed('local', 'read'):
+            body = stored_file.read()
+        if header.get('encoding'):
+            body = body.decode(header['encoding'])
+        return header['content-type'], body, key, metadata
+
+    def read_metadata(self, key):
+        with self.timed('local', 'open'):
+            stored_file, header = self.open_file(key)
+        if stored_file is None:
+            return None, None
+        stored_file.close()
+        return header['content-type'], self.metadata_from(header)
+
+    def delete(self, key):
+        try:
+            with self.timed('local', 'delete'):
+                os.unlink(self.get_file_path_for(key))
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+        with self.timed('local', 'index_delete'):
+            self.index().execute("DELETE FROM keys WHERE key = ?", (key,))
+
+    def delete_if(self, key, expected):
+        with self.locked(key):
+            if not self.has_expected(key, expected):
+                return False
+            self.delete(key)
+            return True
+
+    def index(self):
+        """ the connection to the index of keys for this thread, the index is built
+            from what's on disk if it's being created.  The index also keeps the
+            expiry of each value stored to expire
+        """
+        connection = getattr(self.index_connections, 'connection', None)
+        if connection is None:
+            os.makedirs(self.root_path, exist_ok=True)
+            connection = sqlite3.connect(self.index_path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            exists = connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'keys'").fetchone()
+            connection.execute("CREATE TABLE IF NOT EXISTS expiries (expires INTEGER, key TEXT, "
+                "PRIMARY KEY (expires, key)) WITHOUT ROWID")
+            if not exists:
+                connection.execute("CREATE TABLE IF NOT EXISTS keys (key TEXT PRIMARY KEY) WITHOUT ROWID")
+                self.rebuild_index(connection)
+            self.index_connections.connection = connection
+        return connection
+
+    def rebuild_index(self, connection):
+        """ adds the key of every stored value to the index """
+        logging.info("Indexing the keys stored under %s", self.root_path)
+        connection.execute("BEGIN")
+        for directory, directory_names, file_names in os.walk(self.root_path):
+            for file_name in file_names:
+                if file_name.startswith('.') or len(file_name) != 64:
+                    continue
+                try:
+                    with open(os.path.join(directory, file_name), 'rb') as stored_file:
+                        header = json.loads(stored_file.readline())
+                    key = header['key']
+                except (IOError, OSError, ValueError, KeyError):
+                    logging.warning("unable to index %s", file_name)
+                    continue
+                self.index_key(key, header.get('expires'), connection)
+        connection.execute("COMMIT")
+
+    def index_key(self, key, expires=None, connection=None):
+        connection = connection or self.index()
+        with self.timed('local', 'index_write'):
+            connection.execute("INSERT OR IGNORE INTO keys (key) VALUES (?)", (key,))
+            if expires is not None:
+                connection.execute("INSERT OR IGNORE INTO expiries (expires, key) VALUES (?, ?)", (expires, key))
+
+    def list_keys(self, prefix='', start_after=None, limit=100):
+        conditions = ["key >= ?"]
+        parameters = [prefix]
+        if prefix_end(prefix) is not None:
+            conditions.append("key < ?")
+            parameters.append(prefix_end(prefix))
+        if start_after is not None:
+            conditions.append("key > ?")
+            parameters.append(start_after)
+        parameters.append(limit)
+        with self.timed('local', 'index_read'):
+            rows = self.index().execute("SELECT key FROM keys WHERE %s ORDER BY key LIMIT ?" % (
+                " AND ".join(conditions)), parameters).fetchall()
+        return [row[0] for row in rows]
+
+    def unexpired_keys(self, keys, now=None):
+        # only keys the index has an expiry for that has passed can have expired,
+        # though they may have been stored again since
+        now = int(now if now is not None else time.time())
+        expiring = set()
+        with self.timed('local', 'index_read'):
+            for offset in range(0, len(keys), INDEX_QUERY_SIZE):
+                batch = keys[offset:offset + INDEX_QUERY_SIZE]
+                expiring.update(row[0] for row in self.index().execute(
+                    "SELECT DISTINCT key FROM expiries WHERE expires <= ? AND key IN (%s)" % (
+                        ", ".join("?" * len(batch))), [now] + batch))
+        return [key for key in keys if key not in expiring or not is_expired(self.read_metadata(key)[1], now)]
+
+    def expired_entries(self, now, limit=100):
+        with self.timed('local', 'index_read'):
+            rows = self.index().execute("SELECT expires, key FROM expiries WHERE expires <= ? ORDER BY expires LIMIT ?",
+                (now, limit)).fetchall()
+        return [tuple(row) for row in rows]
+
+    def remove_expired_entries(self, entries):
+        with self.timed('local', 'index_delete'):
+            self.index().executemany("DELETE FROM expiries WHERE expires = ? AND key = ?", entries)
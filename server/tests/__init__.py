@@ -0,0 +1,17 @@
+import json
+import unittest
+from server import serialization
+
+class SerializerTestCase(unittest.TestCase):
+    """ A test case that runs with the stdlib JSON serializer, subclasses set
+        serializer to run the same tests with another one
+    """
+    serializer = 'json'
+
+    def setUp(self):
+        self.addCleanup(serialization.use, serialization.serializer)
+        serialization.use(self.serializer)
+
+    def encoded(self, text):
+        """ the JSON text as the serializer being used writes it """
+        return serialization.dumps(json.loads(text)).encode('utf-8')
@@ -0,0 +1,122 @@
+import json
+import time
+import shutil
+import asyncio
+import tempfile
+import unittest
+from server.asgi import AsgiAdapter
+from server.core import app
+from server.core_handlers import keyvalue_handlers
+from server.storage.local import LocalBackend
+
+def request(adapter, method, path, **kwargs):
+    return asyncio.run(call(adapter, method, path, **kwargs))
+
+async def call(adapter, method, path, query_string=b'', headers=None, body=b'', chunk_size=None):
+    """ runs a single request through the adapter, returning the status, headers
+        and body of the response along with the number of body messages sent
+    """
+    chunk_size = chunk_size or max(len(body), 1)
+    messages = [{'type': 'http.request', 'body': body[offset:offset + chunk_size],
+        'more_body': offset + chunk_size < len(body)} for offset in range(0, max(len(body), 1), chunk_size)]
+    sent = []
+    scope = {
+        'type': 'http', 'method': method, 'path': path, 'query_string': query_string,
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in (headers or {}).items()],
+        'server': ('localhost', 80), 'client': ('127.0.0.1', 12345),
+    }
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await adapter(scope, receive, send)
+    start = sent[0]
+    bodies = [message['body'] for message in sent[1:]]
+    return start['status'], dict((name.decode(), value.decode()) for name, value in start['headers']), b''.join(bodies), len(bodies)
+
+class TestAsgi(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.adapter = AsgiAdapter(app, threads=8)
+        self.storage_root = tempfile.mkdtemp()
+        keyvalue_handlers.storage = LocalBackend(self.storage_root, stream_threshold=1024)
+        keyvalue_handlers.read_cache.clear()
+
+    def tearDown(self):
+        self.adapter.executor.shutdown()
+        shutil.rmtree(self.storage_root)
+
+    def test_store_and_read(self):
+        body = json.dumps(dict(one=1)).encode('utf-8')
+        status, headers, data, _ = request(self.adapter, 'POST', '/test/asgi', body=body, chunk_size=3,
+            headers={'Content-Type': 'application/json', 'Content-Length': str(len(body))})
+        self.assertEqual(200, status)
+        status, headers, data, _ = request(self.adapter, 'GET', '/test/asgi', headers={'Origin': 'http://pants.com'})
+        self.assertEqual(200, status)
+        self.assertEqual(dict(one=1), json.loads(data))
+        self.assertEqual('application/json', headers['content-type'])
+        self.assertEqual('http://pants.com', headers['access-control-allow-origin'])
+        self.assertEqual('true', headers['access-control-allow-credentials'])
+
+    def test_jsonp(self):
+        keyvalue_handlers.storage.store('test/asgi/jsonp', json.dumps(dict(one=1)), 'application/json')
+        status, headers, data, _ = request(self.adapter, 'GET', '/test/asgi/jsonp', query_string=b'callback=run_me')
+        self.assertEqual(b'run_me({"one": 1});', data)
+
+    def test_missing_key(self):
+        status, headers, data, _ = request(self.adapter, 'GET', '/test/asgi/missing')
+        self.assertEqual(404, status)
+
+    def test_streamed_response(self):
+        value = b'pants' * 100000
+        keyvalue_handlers.storage.store('test/asgi/large', value, 'application/octet-stream')
+        status, headers, data, messages = request(self.adapter, 'GET', '/test/asgi/large')
+        self.assertEqual(value, data)
+        self.assertTrue(messages > 2)
+
+    def test_response_is_pulled_as_it_is_sent(self):
+        pulled = []
+
+        def streaming_app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'application/octet-stream')])
+            for i in range(100):
+                pulled.append(i)
+                yield b'x' * 1024
+
+        adapter = AsgiAdapter(streaming_app, threads=2)
+        pulled_when_sent = []
+        messages = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+        scope = {'type': 'http', 'method': 'GET', 'path': '/', 'query_string': b'', 'headers': []}
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            if message['type'] == 'http.response.body':
+                pulled_when_sent.append(len(pulled))
+
+        asyncio.run(adapter(scope, receive, send))
+        adapter.executor.shutdown()
+        # nothing is pulled from the view ahead of what's been sent
+        self.assertEqual(list(range(1, 101)) + [100], pulled_when_sent)
+
+    def test_requests_in_flight(self):
+        def slow_app(environ, start_response):
+            time.sleep(0.2)
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [environ['PATH_INFO'].encode('utf-8')]
+
+        adapter = AsgiAdapter(slow_app, threads=32)
+
+        async def run_all():
+            return await asyncio.gather(*[call(adapter, 'GET', '/%s' % (i)) for i in range(32)])
+
+        started = time.time()
+        results = asyncio.run(run_all())
+        adapter.executor.shutdown()
+        self.assertEqual(['/%s' % (i) for i in range(32)], [data.decode() for _, _, data, _ in results])
+        # far quicker than the 4 at a time we get from gthread
+        self.assertTrue(time.time() - started < 1.6)
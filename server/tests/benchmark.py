@@ -0,0 +1,265 @@
+""" Load tests the HTTP surface of the kvstore against in-memory stand-ins for
+    DynamoDB and S3 that wait a set latency on every call, reporting the
+    latency percentiles and throughput of each scenario.
+
+        python -m server.tests.benchmark --output benchmark.json
+        python -m server.tests.benchmark --baseline benchmark.json
+
+    Given a baseline from an earlier run it exits non zero if any scenario has
+    regressed by more than the tolerance, so it can be run as part of CI.
+"""
+import sys
+import json
+import math
+import time
+import logging
+import threading
+from argparse import ArgumentParser
+from urllib.parse import urlencode
+from server.core import app
+from server.cache import LRUCache
+from server.core_handlers import keyvalue_handlers
+from server.storage.dynamo import DynamoBackend
+from server.tests.fakes import FakeTable, FakeBucket, FakeIndexTable
+
+# the number of keys each scenario spreads its requests over, and that are read
+# at once by the multikey scenarios
+KEY_COUNT = 50
+MULTIKEY_COUNT = 10
+
+def value_of_size(size):
+    """ a JSON document roughly size bytes long """
+    return json.dumps(dict(value="x" * max(size - 13, 0)))
+
+def percentile(sorted_values, percent):
+    """ the nearest rank percentile of an already sorted list """
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(sorted_values)))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+def key_for(scenario, number):
+    return "benchmark/%s/%s" % (scenario, number % KEY_COUNT)
+
+def multikey_path(scenario, number):
+    return "/".join(key_for(scenario, number + offset) for offset in range(MULTIKEY_COUNT))
+
+class Scenario(object):
+    """ A kind of request to benchmark, setup stores anything the requests need
+        to find and request makes a single request with the test client
+    """
+    name = None
+
+    def __init__(self, size):
+        self.size = size
+        self.value = value_of_size(size)
+
+    def setup(self, client):
+        for number in range(KEY_COUNT):
+            client.post("/" + key_for(self.name, number), data=self.value, content_type="application/json")
+
+    def request(self, client, number):
+        raise NotImplementedError()
+
+class GetScenario(Scenario):
+    name = 'get'
+
+    def request(self, client, number):
+        return client.get("/" + key_for(self.name, number))
+
+class PostScenario(Scenario):
+    name = 'post'
+
+    def setup(self, client):
+        pass
+
+    def request(self, client, number):
+        return client.post("/" + key_for(self.name, number), data=self.value, content_type="application/json")
+
+class FormPostScenario(Scenario):
+    name = 'form_post'
+
+    def setup(self, client):
+        self.form = dict(value="x" * self.size, count="1", flag="true")
+
+    def request(self, client, number):
+        return client.post("/" + key_for(self.name, number), data=urlencode(self.form),
+            content_type="application/x-www-form-urlencoded")
+
+class DeleteScenario(Scenario):
+    name = 'delete'
+
+    def request(self, client, number):
+        return client.delete("/" + key_for(self.name, number))
+
+class JsonpScenario(Scenario):
+    name = 'jsonp'
+
+    def request(self, client, number):
+        return client.get("/" + key_for(self.name, number), query_string=dict(callback="run_me"))
+
+class MultikeyGetScenario(Scenario):
+    name = 'multikey_get'
+
+    def request(self, client, number):
+        return client.get("/__multikey__/" + multikey_path(self.name, number))
+
+class MultikeyPostScenario(Scenario):
+    name = 'multikey_post'
+
+    def setup(self, client):
+        self.values = [json.dumps(dict((key_for(self.name, number + offset), dict(value="x" * self.size))
+            for offset in range(MULTIKEY_COUNT))) for number in range(KEY_COUNT)]
+
+    def request(self, client, number):
+        return client.post("/__multikey__", data=self.values[number % KEY_COUNT], content_type="application/json")
+
+SCENARIOS = dict((scenario.name, scenario) for scenario in [
+    GetScenario, PostScenario, FormPostScenario, DeleteScenario,
+    JsonpScenario, MultikeyGetScenario, MultikeyPostScenario,
+])
+
+def run_scenario(scenario, concurrency, requests):
+    """ makes the requests for the scenario from concurrency threads at once,
+        returning a summary of how long they took
+    """
+    scenario.setup(app.test_client())
+    latencies = []
+    errors = []
+    next_number = iter(range(requests))
+    numbers_lock = threading.Lock()
+
+    def worker():
+        client = app.test_client()
+        while True:
+            with numbers_lock:
+                number = next(next_number, None)
+            if number is None:
+                return
+            started = time.perf_counter()
+            response = scenario.request(client, number)
+            elapsed = time.perf_counter() - started
+            with numbers_lock:
+                latencies.append(elapsed)
+                if response.status_code >= 400 and response.status_code != 404:
+                    errors.append(response.status_code)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    as_ms = lambda seconds: round(seconds * 1000, 3) if seconds is not None else None
+    return dict(
+        scenario=scenario.name,
+        size=scenario.size,
+        concurrency=concurrency,
+        requests=len(latencies),
+        errors=len(errors),
+        requests_per_second=round(len(latencies) / elapsed, 2) if elapsed else None,
+        p50_ms=as_ms(percentile(latencies, 50)),
+        p95_ms=as_ms(percentile(latencies, 95)),
+        p99_ms=as_ms(percentile(latencies, 99)),
+        max_ms=as_ms(latencies[-1] if latencies else None),
+    )
+
+def use_stand_in_storage(latency, jitter, read_cache_bytes, read_cache_ttl=5):
+    """ points the handlers at a DynamoBackend over in-memory stand ins """
+    table = FakeTable(latency=latency, jitter=jitter)
+    bucket = FakeBucket(latency=latency, jitter=jitter)
+    index_table = FakeIndexTable(latency=latency, jitter=jitter)
+    keyvalue_handlers.storage = DynamoBackend(table.table_name, 'kvstore-large', table=table, bucket=bucket,
+        index_table=index_table)
+    keyvalue_handlers.read_cache = LRUCache(read_cache_bytes, read_cache_ttl)
+    keyvalue_handlers.read_cache_ttl = read_cache_ttl
+
+def run(scenarios, sizes, concurrencies, requests, latency, jitter, read_cache_bytes, read_cache_ttl=5):
+    results = []
+    for name in scenarios:
+        for size in sizes:
+            for concurrency in concurrencies:
+                use_stand_in_storage(latency, jitter, read_cache_bytes, read_cache_ttl)
+                result = run_scenario(SCENARIOS[name](size), concurrency, requests)
+                logging.info("%(scenario)s size=%(size)s concurrency=%(concurrency)s: %(requests_per_second)s req/s, "
+                    "p50 %(p50_ms)sms p95 %(p95_ms)sms p99 %(p99_ms)sms", result)
+                results.append(result)
+    return results
+
+def regressions_from(results, baseline, tolerance):
+    """ returns a description of each result that is worse than the same scenario
+        in the baseline by more than the tolerance
+    """
+    baseline_results = dict(((result['scenario'], result['size'], result['concurrency']), result)
+        for result in baseline['results'])
+    regressions = []
+    for result in results:
+        previous = baseline_results.get((result['scenario'], result['size'], result['concurrency']))
+        if not previous:
+            continue
+        name = "%(scenario)s size=%(size)s concurrency=%(concurrency)s" % result
+        if result['p99_ms'] > previous['p99_ms'] * (1 + tolerance):
+            regressions.append("%s p99 went from %sms to %sms" % (name, previous['p99_ms'], result['p99_ms']))
+        if result['requests_per_second'] < previous['requests_per_second'] * (1 - tolerance):
+            regressions.append("%s went from %s to %s req/s" % (
+                name, previous['requests_per_second'], result['requests_per_second']))
+        if result['errors'] > previous['errors']:
+            regressions.append("%s had %s errors" % (name, result['errors']))
+    return regressions
+
+def main(argv=None):
+    arg_parser = ArgumentParser(description="Benchmarks the kvstore against in-memory storage")
+    arg_parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    arg_parser.add_argument("--sizes", default="100,10240,512000", help="value sizes in bytes")
+    arg_parser.add_argument("--concurrency", default="1,4,16")
+    arg_parser.add_argument("--requests", default=200, type=int, help="requests per scenario")
+    arg_parser.add_argument("--latency", default=0.005, type=float, help="seconds each storage call takes")
+    arg_parser.add_argument("--jitter", default=0.2, type=float, help="fraction the latency varies by")
+    arg_parser.add_argument("--read-cache-bytes", default=0, type=int, help="0 sends every read to storage")
+    arg_parser.add_argument("--read-cache-ttl", default=5, type=float, help="seconds a read is cached for")
+    arg_parser.add_argument("--output", help="file the results are written to as JSON")
+    arg_parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    arg_parser.add_argument("--tolerance", default=0.25, type=float)
+    args = arg_parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    logging.getLogger().setLevel(logging.INFO)
+
+    scenarios = args.scenarios.split(",")
+    for name in scenarios:
+        if name not in SCENARIOS:
+            arg_parser.error("unknown scenario %s, choose from %s" % (name, ", ".join(SCENARIOS)))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    app.config['TESTING'] = True
+    results = run(
+        scenarios,
+        [int(size) for size in args.sizes.split(",")],
+        [int(concurrency) for concurrency in args.concurrency.split(",")],
+        args.requests, args.latency, args.jitter, args.read_cache_bytes, args.read_cache_ttl
+    )
+    report = dict(
+        started=int(time.time()),
+        config=dict(requests=args.requests, latency=args.latency, jitter=args.jitter,
+            read_cache_bytes=args.read_cache_bytes, read_cache_ttl=args.read_cache_ttl),
+        results=results,
+    )
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+    if baseline:
+        regressions = regressions_from(results, baseline, args.tolerance)
+        for regression in regressions:
+            logging.error(regression)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
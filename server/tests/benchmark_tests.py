@@ -0,0 +1,36 @@
+import unittest
+from server.core_handlers import keyvalue_handlers
+from server.tests import benchmark
+
+class TestBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.storage = keyvalue_handlers.storage
+        self.read_cache = keyvalue_handlers.read_cache
+        self.read_cache_ttl = keyvalue_handlers.read_cache_ttl
+
+    def tearDown(self):
+        keyvalue_handlers.storage = self.storage
+        keyvalue_handlers.read_cache = self.read_cache
+        keyvalue_handlers.read_cache_ttl = self.read_cache_ttl
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(50, benchmark.percentile(values, 50))
+        self.assertEqual(99, benchmark.percentile(values, 99))
+        self.assertEqual(1, benchmark.percentile([1], 99))
+        self.assertEqual(None, benchmark.percentile([], 50))
+
+    def test_run(self):
+        results = benchmark.run(sorted(benchmark.SCENARIOS), [100], [2], 20, 0, 0, 0)
+        self.assertEqual(sorted(benchmark.SCENARIOS), [result['scenario'] for result in results])
+        for result in results:
+            self.assertEqual(20, result['requests'])
+            self.assertEqual(0, result['errors'])
+            self.assertTrue(result['p50_ms'] <= result['p95_ms'] <= result['p99_ms'] <= result['max_ms'])
+
+    def test_regressions(self):
+        baseline = dict(results=[dict(scenario='get', size=100, concurrency=1, p99_ms=10, requests_per_second=100, errors=0)])
+        same = [dict(scenario='get', size=100, concurrency=1, p99_ms=11, requests_per_second=90, errors=0)]
+        slower = [dict(scenario='get', size=100, concurrency=1, p99_ms=20, requests_per_second=50, errors=0)]
+        self.assertEqual([], benchmark.regressions_from(same, baseline, 0.25))
+        self.assertEqual(2, len(benchmark.regressions_from(slower, baseline, 0.25)))
@@ -0,0 +1,215 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from server.cache import LRUCache, SingleFlight, SharedStream, DiskCache, GENERATION_STRIPES
+from server.storage import StreamedBody
+
+class TestLRUCache(unittest.TestCase):
+    def test_get_and_set(self):
+        cache = LRUCache(100, 60)
+        self.assertEqual((False, None), cache.get("one"))
+        cache.set("one", "value", 5)
+        self.assertEqual((True, "value"), cache.get("one"))
+        self.assertEqual(1, cache.stats()['hits'])
+        self.assertEqual(1, cache.stats()['misses'])
+
+    def test_evicts_least_recently_used_over_budget(self):
+        cache = LRUCache(10, 60)
+        cache.set("one", 1, 4)
+        cache.set("two", 2, 4)
+        cache.get("one")
+        cache.set("three", 3, 4)
+        self.assertEqual((True, 1), cache.get("one"))
+        self.assertEqual((False, None), cache.get("two"))
+        self.assertEqual(1, cache.stats()['evictions'])
+        self.assertEqual(8, cache.stats()['bytes'])
+
+    def test_too_large_is_not_cached(self):
+        cache = LRUCache(10, 60)
+        cache.set("one", 1, 11)
+        self.assertEqual((False, None), cache.get("one"))
+
+    def test_expires(self):
+        cache = LRUCache(10, 60)
+        cache.set("one", 1, 1, ttl_seconds=0.01)
+        time.sleep(0.02)
+        self.assertEqual((False, None), cache.get("one"))
+        self.assertEqual(1, cache.stats()['expirations'])
+
+    def test_set_after_invalidation_is_dropped(self):
+        cache = LRUCache(10, 60)
+        generation = cache.generation("one")
+        cache.invalidate("one")
+        cache.set("one", 1, 1, generation=generation)
+        self.assertEqual((False, None), cache.get("one"))
+        generation = cache.generation("one")
+        cache.clear()
+        cache.set("one", 1, 1, generation=generation)
+        self.assertEqual((False, None), cache.get("one"))
+
+    def test_set_after_invalidation_of_other_keys_is_kept(self):
+        cache = LRUCache(10, 60)
+        generation = cache.generation("one")
+        for number in range(100):
+            key = "other/%s" % (number)
+            # unless it shares a stripe with the key
+            if hash(key) % GENERATION_STRIPES != hash("one") % GENERATION_STRIPES:
+                cache.invalidate(key)
+        cache.set("one", 1, 1, generation=generation)
+        self.assertEqual((True, 1), cache.get("one"))
+
+class TestSingleFlight(unittest.TestCase):
+    def run_at_once(self, count, target):
+        threads = [threading.Thread(target=target) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_concurrent_fetches_are_coalesced(self):
+        flights = SingleFlight()
+        fetches = []
+        results = []
+
+        def fetch():
+            fetches.append(1)
+            time.sleep(0.1)
+            return "value"
+
+        self.run_at_once(8, lambda: results.append(flights.do("one", fetch)))
+        self.assertEqual(1, len(fetches))
+        self.assertEqual(["value"] * 8, [result for result, shared in results])
+        self.assertEqual(7, len([shared for result, shared in results if shared]))
+        self.assertEqual(dict(led=1, joined=7, in_flight=0), flights.stats())
+        # once it's done the next fetch is made again
+        self.assertEqual(("value", False), flights.do("one", fetch))
+
+    def test_errors_are_shared(self):
+        flights = SingleFlight()
+        errors = []
+
+        def fetch():
+            time.sleep(0.1)
+            raise IOError("unreachable")
+
+        def do():
+            try:
+                flights.do("one", fetch)
+            except IOError as e:
+                errors.append(e)
+
+        self.run_at_once(4, do)
+        self.assertEqual(4, len(errors))
+        self.assertEqual(0, flights.stats()['in_flight'])
+
+    def test_overlapping_many_share_fetches(self):
+        flights = SingleFlight()
+        fetched = []
+        results = []
+
+        def fetch_many(keys):
+            fetched.extend(keys)
+            time.sleep(0.1)
+            return dict((key, key.upper()) for key in keys if key != "missing")
+
+        keys = [["one", "two", "missing"], ["two", "three", "one"], ["three", "one"]]
+        self.run_at_once(3, lambda: results.append(flights.do_many(keys.pop(), fetch_many)))
+        self.assertEqual(["missing", "one", "three", "two"], sorted(fetched))
+        for result in results:
+            for key, (value, shared) in result.items():
+                self.assertEqual(None if key == "missing" else key.upper(), value)
+
+    def test_results_handed_to_others_are_shared(self):
+        flights = SingleFlight()
+        results = []
+
+        def fetch():
+            time.sleep(0.1)
+            return "value"
+
+        self.run_at_once(4, lambda: results.append(flights.do("one", fetch, share=lambda result, count: (result, count))))
+        self.assertEqual([("value", 4)] * 4, [result for result, shared in results])
+        # a result no one else is handed isn't shared
+        self.assertEqual(("value", False), flights.do("one", fetch, share=lambda result, count: (result, count)))
+
+class TestSharedStream(unittest.TestCase):
+    def test_readers_share_one_read_of_the_body(self):
+        reads = []
+        closed = []
+
+        def chunks():
+            for chunk in [b"one", b"two", b"three"]:
+                reads.append(chunk)
+                yield chunk
+
+        shared = SharedStream(StreamedBody(chunks(), 11, on_close=lambda: closed.append(1)), 3)
+        first, second, third = shared.reader(), shared.reader(), shared.reader()
+        self.assertEqual(b"one", next(iter(first)))
+        self.assertEqual(b"onetwothree", second.read())
+        self.assertEqual(b"onetwothree", b"one" + b"".join(first))
+        first.close()
+        self.assertEqual([b"one", b"two", b"three"], reads)
+        self.assertEqual([], closed)
+        third.close()
+        self.assertEqual([1], closed)
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def read(self, cache, key, validator):
+        header, cached_file = cache.open(key, validator)
+        if header is None:
+            return None
+        with cached_file:
+            return header['content-type'], cached_file.read()
+
+    def test_put_and_open(self):
+        cache = DiskCache(self.root, 1000)
+        self.assertEqual(None, self.read(cache, "one", [1, "a"]))
+        cache.put("one", [1, "a"], {'content-type': 'text/plain'}, b"value")
+        self.assertEqual(('text/plain', b"value"), self.read(cache, "one", [1, "a"]))
+        # anything cached with a different validator has since changed
+        self.assertEqual(None, self.read(cache, "one", [2, "b"]))
+        # every worker on the host shares what's cached
+        self.assertEqual(('text/plain', b"value"), self.read(DiskCache(self.root, 1000), "one", [1, "a"]))
+        stats = cache.stats()
+        self.assertEqual((1, 2, 1), (stats['hits'], stats['misses'], stats['entries']))
+        self.assertTrue(stats['bytes'] > 5)
+
+    def test_invalidate(self):
+        cache = DiskCache(self.root, 1000)
+        cache.put("one", [1], {'content-type': 'text/plain'}, b"value")
+        cache.invalidate("one")
+        self.assertEqual(None, self.read(cache, "one", [1]))
+        self.assertEqual(0, cache.stats()['entries'])
+
+    def test_evicts_least_recently_used_over_budget(self):
+        cache = DiskCache(self.root, 600, max_entry_bytes=300)
+        cache.put("one", [1], {'content-type': 'text/plain'}, b"1" * 200)
+        cache.put("two", [1], {'content-type': 'text/plain'}, b"2" * 200)
+        cache.index().execute("UPDATE entries SET used = used - 100")
+        self.read(cache, "one", [1])
+        cache.put("three", [1], {'content-type': 'text/plain'}, b"3" * 200)
+        self.assertEqual(None, self.read(cache, "two", [1]))
+        self.assertEqual(b"1" * 200, self.read(cache, "one", [1])[1])
+        self.assertEqual(1, cache.stats()['evictions'])
+        cache.put("large", [1], {'content-type': 'text/plain'}, b"4" * 301)
+        self.assertEqual(None, self.read(cache, "large", [1]))
+
+    def test_tee_only_caches_what_is_read_to_the_end(self):
+        cache = DiskCache(self.root, 1000)
+        chunks = cache.tee("one", [1], {'content-type': 'text/plain'}, iter([b"a", b"b"]), 2)
+        self.assertEqual(b"a", next(chunks))
+        chunks.close()
+        self.assertEqual(None, self.read(cache, "one", [1]))
+        self.assertEqual([], [name for name in os.listdir(os.path.dirname(cache.index_path)) if name.startswith('.tmp-')])
+        chunks = cache.tee("one", [1], {'content-type': 'text/plain'}, iter([b"a", b"b"]), 2)
+        self.assertEqual([b"a", b"b"], list(chunks))
+        self.assertEqual(('text/plain', b"ab"), self.read(cache, "one", [1]))
@@ -0,0 +1,289 @@
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import tempfile
+import unittest
+import subprocess
+import http.client
+from collections import Counter
+from server.storage.local import LocalBackend
+from server.storage.cluster import HashRing, SECRET_HEADER
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+SECRET = 'cluster-tests-secret'
+NODE_COMMAND = "from server.core import app; app.run(host='127.0.0.1', port=%s, threaded=True, use_reloader=False)"
+
+def free_port():
+    with socket.socket() as free:
+        free.bind(('127.0.0.1', 0))
+        return free.getsockname()[1]
+
+class TestHashRing(unittest.TestCase):
+    def setUp(self):
+        self.nodes = ["http://127.0.0.1:%s" % (port) for port in range(5001, 5005)]
+        self.keys = ["key/%s" % (number) for number in range(2000)]
+
+    def test_replicas_are_distinct_nodes(self):
+        ring = HashRing(self.nodes)
+        for key in self.keys[:100]:
+            nodes = ring.nodes_for(key, 3)
+            self.assertEqual(3, len(set(nodes)))
+            self.assertEqual(nodes[:1], ring.nodes_for(key))
+        self.assertEqual(4, len(ring.nodes_for("key", 10)))
+        self.assertEqual([], HashRing([]).nodes_for("key"))
+
+    def test_keys_are_spread_over_the_nodes(self):
+        ring = HashRing(self.nodes)
+        counts = Counter(ring.nodes_for(key)[0] for key in self.keys)
+        self.assertEqual(set(self.nodes), set(counts))
+        for node, count in counts.items():
+            self.assertTrue(250 < count < 750, "%s has %s keys" % (node, count))
+
+    def test_adding_a_node_only_moves_keys_to_it(self):
+        before = HashRing(self.nodes[:3])
+        after = HashRing(self.nodes)
+        moved = [key for key in self.keys if before.nodes_for(key) != after.nodes_for(key)]
+        self.assertTrue(len(moved) < len(self.keys) / 2)
+        self.assertEqual(set([self.nodes[3]]), set(after.nodes_for(key)[0] for key in moved))
+
+class TestStoreCopy(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.storage = LocalBackend(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_copies_keep_their_metadata(self):
+        metadata = dict(etag="etag", version=10, expires=int(time.time()) + 60)
+        self.assertTrue(self.storage.store_copy("one", [b"1"], "text/plain", metadata, encoding='utf-8'))
+        self.assertEqual(("text/plain", "1", "one", metadata), self.storage.read("one"))
+        self.assertEqual(["one"], self.storage.list_keys())
+        self.assertEqual(1, len(self.storage.expired_entries(metadata['expires'])))
+
+    def test_deleted_copies_are_no_later_than_the_deleted_version(self):
+        self.storage.store_copy("one", [b"2"], "text/plain", dict(etag="2", version=20))
+        self.assertFalse(self.storage.delete_copy("one", 10))
+        self.assertEqual(b"2", self.storage.read("one")[1])
+        self.assertTrue(self.storage.delete_copy("one", 20))
+        self.assertEqual(None, self.storage.read("one")[1])
+        self.assertTrue(self.storage.delete_copy("one", 20))
+
+    def test_later_versions_are_kept(self):
+        self.storage.store_copy("one", [b"2"], "text/plain", dict(etag="2", version=20))
+        self.assertFalse(self.storage.store_copy("one", [b"1"], "text/plain", dict(etag="1", version=10)))
+        self.assertFalse(self.storage.store_copy("one", [b"2"], "text/plain", dict(etag="2", version=20)))
+        self.assertEqual(b"2", self.storage.read("one")[1])
+
+class TestCluster(unittest.TestCase):
+    """ runs each node of the cluster in a process of its own """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.processes = {}
+        self.nodes = ["http://127.0.0.1:%s" % (free_port()) for number in range(3)]
+        for node in self.nodes:
+            self.start_node(node, self.nodes)
+
+    def tearDown(self):
+        for process in self.processes.values():
+            process.terminate()
+            process.wait()
+        shutil.rmtree(self.root)
+
+    def start_node(self, node, nodes):
+        port = node.rsplit(':', 1)[1]
+        env = dict(os.environ,
+            ROOT_STORAGE_PATH=os.path.join(self.root, port),
+            KVSTORE_STORAGE_ENGINE='cluster',
+            KVSTORE_CLUSTER_NODES=",".join(nodes),
+            KVSTORE_CLUSTER_SELF=node,
+            KVSTORE_CLUSTER_SECRET=SECRET,
+            KVSTORE_CLUSTER_REPLICAS='2',
+            KVSTORE_METRICS_DIR=os.path.join(self.root, 'metrics', port),
+            KVSTORE_READ_CACHE_BYTES='0',
+            KVSTORE_DISK_CACHE_BYTES='0',
+            KVSTORE_REAPER_INTERVAL='0',
+            KVSTORE_CLUSTER_HANDOFF_INTERVAL='0.2',
+            LOG_LEVEL='WARNING')
+        self.processes[node] = subprocess.Popen([sys.executable, '-c', NODE_COMMAND % (port)], cwd=REPOSITORY_ROOT,
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        for attempt in range(100):
+            try:
+                if self.request(node, 'GET', '/__cluster__/nodes')[0] == 200:
+                    return
+            except (socket.error, http.client.HTTPException):
+                pass
+            time.sleep(0.1)
+        raise Exception("%s didn't start" % (node))
+
+    def stop_node(self, node):
+        process = self.processes.pop(node)
+        process.terminate()
+        process.wait()
+
+    def request(self, node, method, path, body=None, headers=None, secret=SECRET):
+        headers = dict(headers or {})
+        if path.startswith('/__cluster__/') and secret:
+            headers[SECRET_HEADER] = secret
+        connection = http.client.HTTPConnection(*node[len('http://'):].split(':'), timeout=10)
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+    def store(self, node, key, value):
+        status, data = self.request(node, 'POST', '/%s' % (key), json.dumps(value), {'Content-Type': 'application/json'})
+        self.assertEqual(200, status)
+
+    def read(self, node, key):
+        status, data = self.request(node, 'GET', '/%s' % (key))
+        return json.loads(data) if status == 200 else None
+
+    def holders_of(self, key):
+        return set(node for node in self.processes
+            if self.request(node, 'HEAD', '/__cluster__/copies/%s' % (key))[0] == 200)
+
+    def wait_for(self, condition, message):
+        for attempt in range(100):
+            if condition():
+                return
+            time.sleep(0.1)
+        raise Exception(message)
+
+    def wait_for_rebalancing(self):
+        for attempt in range(100):
+            if not any(json.loads(self.request(node, 'GET', '/__cluster__/nodes')[1])['rebalancing']
+                    for node in self.processes):
+                return
+            time.sleep(0.1)
+        raise Exception("the keys weren't moved")
+
+    def test_cluster_routes_need_the_secret(self):
+        self.store(self.nodes[0], "secret/key", dict(secret=True))
+        for secret in (None, 'not-the-secret'):
+            self.assertEqual(403, self.request(self.nodes[0], 'GET', '/__cluster__/nodes', secret=secret)[0])
+            self.assertEqual(403, self.request(self.nodes[0], 'GET', '/__cluster__/copies/secret/key', secret=secret)[0])
+            self.assertEqual(403, self.request(self.nodes[0], 'DELETE', '/__cluster__/copies/secret/key',
+                headers={'X-Kvstore-Deleted-Version': str(2 ** 62)}, secret=secret)[0])
+            self.assertEqual(403, self.request(self.nodes[0], 'PUT', '/__cluster__/nodes',
+                json.dumps(dict(nodes=self.nodes[:1])), {'Content-Type': 'application/json'}, secret=secret)[0])
+        self.assertEqual(dict(secret=True), self.read(self.nodes[1], "secret/key"))
+        self.assertEqual(200, self.request(self.nodes[0], 'GET', '/__cluster__/nodes')[0])
+
+    def test_keys_are_stored_on_their_replicas_and_read_from_any_node(self):
+        keys = ["cluster/%s" % (number) for number in range(20)]
+        for key in keys:
+            self.store(self.nodes[0], key, dict(key=key))
+        ring = HashRing(self.nodes)
+        for key in keys:
+            self.assertEqual(set(ring.nodes_for(key, 2)), self.holders_of(key))
+            for node in self.nodes:
+                self.assertEqual(dict(key=key), self.read(node, key))
+        status, data = self.request(self.nodes[1], 'GET', '/__keys__?prefix=cluster/&limit=100')
+        self.assertEqual(sorted(keys), json.loads(data)['keys'])
+
+        self.request(self.nodes[2], 'DELETE', '/%s' % (keys[0]))
+        self.assertEqual(set(), self.holders_of(keys[0]))
+        self.assertEqual(None, self.read(self.nodes[0], keys[0]))
+
+        # every key is still on one of the nodes that are left
+        self.stop_node(self.nodes[1])
+        for key in keys[1:]:
+            self.assertEqual(dict(key=key), self.read(self.nodes[0], key))
+            self.store(self.nodes[2], key, dict(key=key, stored_again=True))
+            self.assertEqual(dict(key=key, stored_again=True), self.read(self.nodes[0], key))
+
+    def test_large_values_are_streamed_between_nodes(self):
+        large = os.urandom(1024 * 1024)
+        ring = HashRing(self.nodes)
+        # stored through a node that isn't responsible for the key
+        key = next("large/%s" % (number) for number in range(100)
+            if self.nodes[0] not in ring.nodes_for("large/%s" % (number), 2))
+        status, data = self.request(self.nodes[0], 'POST', '/%s' % (key), large, {'Content-Type': 'application/octet-stream'})
+        self.assertEqual(200, status)
+        self.assertEqual(set(ring.nodes_for(key, 2)), self.holders_of(key))
+        self.assertEqual((200, large), self.request(self.nodes[0], 'GET', '/%s' % (key)))
+
+    def test_keys_move_as_nodes_join_and_leave(self):
+        keys = ["moving/%s" % (number) for number in range(30)]
+        for key in keys:
+            self.store(self.nodes[0], key, dict(key=key))
+
+        joined = self.nodes + ["http://127.0.0.1:%s" % (free_port())]
+        self.start_node(joined[-1], joined)
+        status, data = self.request(self.nodes[0], 'PUT', '/__cluster__/nodes', json.dumps(dict(nodes=joined)),
+            {'Content-Type': 'application/json'})
+        self.assertEqual(200, status)
+        self.wait_for_rebalancing()
+        ring = HashRing(joined)
+        for key in keys:
+            self.assertEqual(set(ring.nodes_for(key, 2)), self.holders_of(key))
+            self.assertEqual(dict(key=key), self.read(joined[-1], key))
+
+        # the node leaving hands its keys over before it goes
+        left = joined[1:]
+        status, data = self.request(joined[-1], 'PUT', '/__cluster__/nodes', json.dumps(dict(nodes=left)),
+            {'Content-Type': 'application/json'})
+        self.assertEqual(200, status)
+        self.wait_for_rebalancing()
+        self.stop_node(joined[0])
+        ring = HashRing(left)
+        for key in keys:
+            self.assertEqual(set(ring.nodes_for(key, 2)), self.holders_of(key))
+            self.assertEqual(dict(key=key), self.read(left[0], key))
+
+    def test_previous_nodes_are_kept_until_every_node_has_moved_its_keys(self):
+        keys = ["waiting/%s" % (number) for number in range(20)]
+        for key in keys:
+            self.store(self.nodes[0], key, dict(key=key))
+        self.stop_node(self.nodes[2])
+        left = self.nodes[:2]
+        status, data = self.request(self.nodes[0], 'PUT', '/__cluster__/nodes', json.dumps(dict(nodes=left)),
+            {'Content-Type': 'application/json'})
+        self.assertEqual(502, status)
+        # the nodes left have moved their keys, but can't tell that the one that
+        # missed the change has
+        self.wait_for(lambda: all(json.loads(self.request(node, 'GET', '/__cluster__/nodes')[1])['swept']
+            for node in left), "the keys weren't moved")
+        time.sleep(2)
+        for node in left:
+            self.assertTrue(json.loads(self.request(node, 'GET', '/__cluster__/nodes')[1])['rebalancing'])
+
+        self.start_node(self.nodes[2], self.nodes)
+        status, data = self.request(self.nodes[2], 'PUT', '/__cluster__/nodes', json.dumps(dict(nodes=left)),
+            {'Content-Type': 'application/json'})
+        self.assertEqual(200, status)
+        self.wait_for_rebalancing()
+        for key in keys:
+            self.assertEqual(set(left), self.holders_of(key))
+
+    def test_expired_keys_are_not_listed(self):
+        for number in range(10):
+            self.request(self.nodes[0], 'POST', '/expiring/%s' % (number), json.dumps(dict(number=number)),
+                {'Content-Type': 'application/json', 'X-TTL': '1' if number % 2 else '3600'})
+        time.sleep(2)
+        status, data = self.request(self.nodes[1], 'GET', '/__keys__?prefix=expiring/&limit=100')
+        self.assertEqual(["expiring/%s" % (number) for number in range(0, 10, 2)], json.loads(data)['keys'])
+
+    def test_nodes_that_missed_changes_are_handed_them(self):
+        keys = ["missed/%s" % (number) for number in range(20)]
+        for key in keys[:10]:
+            self.store(self.nodes[0], key, dict(key=key))
+        self.stop_node(self.nodes[1])
+        for key in keys[:5]:
+            self.request(self.nodes[0], 'DELETE', '/%s' % (key))
+        for key in keys[5:]:
+            self.store(self.nodes[0], key, dict(key=key, stored_again=True))
+
+        self.start_node(self.nodes[1], self.nodes)
+        ring = HashRing(self.nodes)
+        expected = dict((key, set(ring.nodes_for(key, 2)) if key in keys[5:] else set()) for key in keys)
+        self.wait_for(lambda: all(self.holders_of(key) == expected[key] for key in keys), "the changes weren't handed off")
+        for key in keys[5:]:
+            self.assertEqual(dict(key=key, stored_again=True), self.read(self.nodes[1], key))
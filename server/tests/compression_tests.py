@@ -0,0 +1,24 @@
+import unittest
+from server.compression import compress, decompress, decompress_chunks, is_compressible, maybe_compress, GZIP
+
+class TestCompression(unittest.TestCase):
+    def test_round_trip(self):
+        self.assertEqual(b"pants" * 100, decompress(compress("pants" * 100, GZIP), GZIP))
+
+    def test_decompress_chunks(self):
+        compressed = compress(b"pants" * 10000, GZIP)
+        chunks = [compressed[offset:offset + 7] for offset in range(0, len(compressed), 7)]
+        self.assertEqual(b"pants" * 10000, b"".join(decompress_chunks(chunks, GZIP)))
+
+    def test_is_compressible(self):
+        self.assertTrue(is_compressible("application/json"))
+        self.assertTrue(is_compressible("text/html; charset=utf-8"))
+        self.assertTrue(is_compressible("application/vnd.api+json"))
+        self.assertFalse(is_compressible("image/png"))
+        self.assertFalse(is_compressible(None))
+
+    def test_maybe_compress(self):
+        self.assertEqual(None, maybe_compress("pants" * 100, "text/plain", None, 10))
+        self.assertEqual(None, maybe_compress("pants", "text/plain", GZIP, 10))
+        self.assertEqual(None, maybe_compress("pants" * 100, "image/png", GZIP, 10))
+        self.assertTrue(maybe_compress("pants" * 100, "text/plain", GZIP, 10))
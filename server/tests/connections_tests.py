@@ -0,0 +1,59 @@
+import os
+import boto
+import threading
+import unittest
+from server.storage.connections import BoundedConnectionPool, Connections, configure_boto
+
+class FakeHttpConnection(object):
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+class FakeBotoConnection(object):
+    created = 0
+
+    def __init__(self):
+        FakeBotoConnection.created += 1
+
+class TestConnections(unittest.TestCase):
+    def setUp(self):
+        FakeBotoConnection.created = 0
+
+    def test_pool_keeps_at_most_max_idle(self):
+        pool = BoundedConnectionPool(2)
+        connections = [FakeHttpConnection() for i in range(3)]
+        for connection in connections:
+            pool.put_http_connection('dynamodb', 443, True, connection)
+        self.assertEqual(2, pool.size())
+        self.assertEqual([False, False, True], [connection.closed for connection in connections])
+        self.assertTrue(pool.get_http_connection('dynamodb', 443, True) in connections[:2])
+        pool.put_http_connection('s3', 443, True, connections[2])
+        self.assertEqual(2, pool.size())
+
+    def test_created_once_and_shared(self):
+        connections = Connections(pool_size=3)
+        created = []
+        threads = [threading.Thread(target=lambda: created.append(connections.get('fake', FakeBotoConnection)))
+            for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, FakeBotoConnection.created)
+        self.assertEqual(1, len(set(id(connection) for connection in created)))
+        self.assertEqual(3, created[0]._pool.max_idle)
+
+    def test_forked_process_creates_its_own(self):
+        connections = Connections()
+        connections.get('fake', FakeBotoConnection)
+        # as if this were a worker forked after the connection was created
+        connections.pid = os.getpid() + 1
+        connections.get('fake', FakeBotoConnection)
+        self.assertEqual(2, FakeBotoConnection.created)
+
+    def test_configure_boto(self):
+        configure_boto(timeout=2, retries=1)
+        self.assertEqual(2, boto.config.getint('Boto', 'http_socket_timeout'))
+        self.assertEqual(1, boto.config.getint('Boto', 'num_retries'))
@@ -0,0 +1,82 @@
+""" Times convert_types_in_dictionary against the exception driven converter it
+    replaced, on a wide form and on a deeply nested one.
+
+        python -m server.tests.conversion_benchmark
+"""
+import sys
+import json
+import timeit
+from argparse import ArgumentParser
+from server.core import convert_types_in_dictionary
+
+def try_run(this):
+    try:
+        return this()
+    except:
+        return None
+
+def reference_convert_into_number(value):
+    as_number = try_run(lambda: int(value)) or try_run(lambda: float(value))
+    if as_number or as_number == 0:
+        return as_number
+    else:
+        return value
+
+def reference_convert_types_in_dictionary(this_dictionary):
+    into_this_dictionary = {}
+    for key, value in list(this_dictionary.items()):
+        if type(value) == dict:
+            value = reference_convert_types_in_dictionary(value)
+        elif type(value) == list:
+            value = reference_convert_types_in_list(value)
+        else:
+            value = reference_convert_into_number(value)
+        into_this_dictionary[key] = value
+    return into_this_dictionary
+
+def reference_convert_types_in_list(this_list):
+    into_this_list = []
+    for item in this_list:
+        if type(item) == list:
+            new_value = reference_convert_types_in_list(item)
+        elif type(item) == dict:
+            new_value = reference_convert_types_in_dictionary(item)
+        else:
+            new_value = reference_convert_into_number(item)
+        into_this_list.append(new_value)
+    return into_this_list
+
+# the sort of values a form is made of, mostly words with some numbers
+LEAF_VALUES = ["pants", "1", "0", "1.5", "-2", "blue shirt", "", "1e3", "true", "12345678"]
+
+def wide_payload(width):
+    return dict(("field%s" % (number), LEAF_VALUES[number % len(LEAF_VALUES)]) for number in range(width))
+
+def deep_payload(depth, width):
+    payload = wide_payload(width)
+    for level in range(depth):
+        payload = dict(wide_payload(width), child=payload, items=list(LEAF_VALUES))
+    return payload
+
+def time_conversion(convert, payload, number):
+    return min(timeit.repeat(lambda: convert(payload), number=number, repeat=5)) / number
+
+def main(argv=None):
+    arg_parser = ArgumentParser(description="Benchmarks converting form values into numbers")
+    arg_parser.add_argument("--width", default=1000, type=int)
+    arg_parser.add_argument("--depth", default=25, type=int)
+    arg_parser.add_argument("--number", default=20, type=int)
+    args = arg_parser.parse_args(argv)
+
+    results = []
+    for name, payload in [("wide", wide_payload(args.width)), ("deep", deep_payload(args.depth, 20))]:
+        assert convert_types_in_dictionary(payload) == reference_convert_types_in_dictionary(payload)
+        before = time_conversion(reference_convert_types_in_dictionary, payload, args.number)
+        after = time_conversion(convert_types_in_dictionary, payload, args.number)
+        results.append(dict(payload=name, reference_ms=round(before * 1000, 3),
+            current_ms=round(after * 1000, 3), speedup=round(before / after, 2)))
+    json.dump(results, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+if __name__ == "__main__":
+    main()
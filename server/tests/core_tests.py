@@ -1,9 +1,15 @@
 import uuid
+import shutil
+import tempfile
 import unittest
 from server.core import *
+from server import serialization
+from server.cache import ResponseCache
+from server.tests import SerializerTestCase
 
-class TestFixture(unittest.TestCase):
+class TestFixture(SerializerTestCase):
     def setUp(self):
+        super(TestFixture, self).setUp()
         app.config['TESTING'] = True
         self.app = app.test_client()
 
@@ -44,7 +50,7 @@ class TestFixture(unittest.TestCase):
 
     def test_callback(self):
         response = self.app.get("/diagnostic/echo?callback=run_me&bare=true")
-        self.assertEqual(b'run_me({"bare": "true"});', response.data)
+        self.assertEqual(b'run_me(%s);' % self.encoded('{"bare": "true"}'), response.data)
         self.assertEqual('application/javascript', response.content_type)
     
     def test_callback_alone(self):
@@ -53,7 +59,7 @@ class TestFixture(unittest.TestCase):
 
     def test_no_callback(self):
         response = self.app.get("/diagnostic/echo?bare=true")
-        self.assertEqual(b'{"bare": "true"}', response.data);
+        self.assertEqual(self.encoded('{"bare": "true"}'), response.data);
 
     @app.route("/test_me", methods=["GET"])
     def im_here_for_documentation():
@@ -69,26 +75,26 @@ class TestFixture(unittest.TestCase):
         response = self.app.get("/test_me")
         self.assertEqual(b"this is a test response", response.data)
 
-    def test_view_returning_none_gets_handled_in_json_response(self):
-        @app.route("/return_null", methods=["GET"])
-        @make_my_response_json
-        def null_view():
-            return None
+    @app.route("/return_null", methods=["GET"])
+    @make_my_response_json
+    def null_view():
+        return None
 
+    def test_view_returning_none_gets_handled_in_json_response(self):
         response = self.app.get("/return_null")
         self.assertEqual(200, response.status_code)
         jr = json.loads(response.data)
         self.assertEqual({}, jr)
 
-    def test_view_returning_dict_with_callback_in_request(self):
-        @app.route("/bad_callback", methods=["GET"])
-        @make_my_response_json
-        def null_view():
-            return dict(pants="blue")
+    @app.route("/bad_callback", methods=["GET"])
+    @make_my_response_json
+    def dict_view():
+        return dict(pants="blue")
 
+    def test_view_returning_dict_with_callback_in_request(self):
         response = self.app.get("/bad_callback?callback=run_me")
         self.assertEqual(200, response.status_code)
-        self.assertEqual(b'run_me({"pants": "blue"});', response.data)
+        self.assertEqual(b'run_me(%s);' % self.encoded('{"pants": "blue"}'), response.data)
 
     def test_static_works_at_all(self):
         if not os.path.exists("./static/"):
@@ -120,6 +126,14 @@ class TestFixture(unittest.TestCase):
         self.assertEqual(1, converted['myint'])
         self.assertEqual(1.3, converted['myfloat'])
 
+    def test_convert_dictionary_request_non_finite(self):
+        response = self.app.get("/convert?mynan=nan&myinf=-inf&mynull=null")
+        self.assertEqual(200, response.status_code)
+        converted = json.loads(response.data)
+        self.assertNotEqual(converted['mynan'], converted['mynan'])
+        self.assertEqual(float('-inf'), converted['myinf'])
+        self.assertEqual("null", converted['mynull'])
+
     def test_convert_dictionary_request_multiple(self):
         response = self.app.post("/convert?myint=2&myint=4")
         self.assertEqual(200, response.status_code)
@@ -145,6 +159,30 @@ class TestFixture(unittest.TestCase):
         self.assertEqual(3, converted['child']['childint'])
         self.assertEqual([1,2], converted['childlist'])
 
+    def test_convert_matches_exception_based_conversion(self):
+        from server.tests.conversion_benchmark import reference_convert_into_number
+        values = ["0", "-0", "00", "0.0", "1", "-12", "+7", " 42 ", "1_000", "1__0", "_1", "1.", ".5", ".",
+            "1.5e3", "1e-3", "1E+3", "e3", "1e", "inf", "-Infinity", "nan", "0x10", "", "   ", "pants",
+            "1 2", "\u0661\u0662", "12345678901234567890", "1.3", "True", 2, 2.5, 0, None, True]
+        for value in values:
+            expected = reference_convert_into_number(value)
+            converted = convert_into_number(value)
+            if expected != expected:
+                # nan
+                self.assertNotEqual(converted, converted)
+                continue
+            self.assertEqual((type(expected), str(expected)), (type(converted), str(converted)), value)
+
+    def test_convert_dictionary_depth_is_capped(self):
+        nested = dict(myint="1")
+        for level in range(app.config['MAX_CONVERSION_DEPTH']):
+            nested = dict(child=nested)
+        converted = convert_types_in_dictionary(nested)
+        for level in range(app.config['MAX_CONVERSION_DEPTH']):
+            converted = converted['child']
+        self.assertEqual(dict(myint=1), converted)
+        with self.assertRaises(BadRequest):
+            convert_types_in_dictionary(dict(items=[nested]))
 
     @app.route("/return_list", methods=["GET", "POST"])
     @make_my_response_json
@@ -209,3 +247,67 @@ class TestFixture(unittest.TestCase):
         self.assertEqual(200, response.status_code)
         self.assertEqual(b'this is a string', response.data)
         self.assertEqual('application/json', response.content_type)
+
+    cached_calls = []
+
+    @app.route("/cached_response", methods=["GET"])
+    @cache_my_response(vary_by=['pants'])
+    def cached_response():
+        TestFixture.cached_calls.append(request.values.get('pants'))
+        return json_response(**dict(calls=len(TestFixture.cached_calls)))
+
+    def test_cached_response(self):
+        first = self.app.get("/cached_response?pants=blue")
+        self.assertEqual(200, first.status_code)
+        self.assertTrue('Expires' in first.headers)
+        second = self.app.get("/cached_response?pants=blue")
+        self.assertEqual(first.data, second.data)
+        self.assertEqual("application/json", second.content_type)
+        different = self.app.get("/cached_response?pants=red")
+        self.assertNotEqual(first.data, different.data)
+        reloaded = self.app.get("/cached_response?pants=blue&_reload_cache=true")
+        self.assertNotEqual(first.data, reloaded.data)
+
+    def test_shared_response_cache(self):
+        shared_path = tempfile.mkdtemp()
+        try:
+            producer = lambda: (b"shared", 200, [("Content-Type", "text/plain")])
+            one_worker = ResponseCache(1024, shared_path=shared_path)
+            another_worker = ResponseCache(1024, shared_path=shared_path)
+            expires_at, value = one_worker.get_or_return_from_cache("key", 60, producer)
+            self.assertEqual((expires_at, value), another_worker.get_or_return_from_cache("key", 60, None))
+            self.assertEqual(1, another_worker.stats()['shared_hits'])
+        finally:
+            shutil.rmtree(shared_path)
+
+    def test_shared_response_cache_is_bounded(self):
+        shared_path = tempfile.mkdtemp()
+        try:
+            cache = ResponseCache(1024, shared_path=shared_path, shared_max_bytes=4000)
+            for number in range(20):
+                cache.get_or_return_from_cache("key/%s" % (number), 60, lambda: (b"x" * 500, 200, []))
+            shared = cache.stats()['shared']
+            self.assertTrue(shared['bytes'] <= 4000)
+            self.assertTrue(shared['evictions'] > 0)
+            self.assertEqual(shared['entries'], sum(len(file_names) for directory, directory_names, file_names
+                in os.walk(shared_path) if directory != shared_path))
+
+            cache.get_or_return_from_cache("expiring", -1, lambda: (b"gone", 200, []))
+            entries = cache.stats()['shared']['entries']
+            another_worker = ResponseCache(1024, shared_path=shared_path, shared_max_bytes=4000)
+            self.assertEqual((None, (b"missing", 404, [])),
+                another_worker.get_or_return_from_cache("expiring", 60, lambda: (b"missing", 404, [])))
+            # the expired response is removed by whoever finds it
+            self.assertEqual(entries - 1, another_worker.stats()['shared']['entries'])
+        finally:
+            shutil.rmtree(shared_path)
+
+    def test_response_cache_does_not_cache_failures(self):
+        cache = ResponseCache(1024)
+        expires_at, value = cache.get_or_return_from_cache("key", 60, lambda: (b"nope", 404, []))
+        self.assertEqual(None, expires_at)
+        self.assertEqual((False, None), cache.memory.get("key"))
+
+@unittest.skipUnless(serialization.orjson, "orjson isn't installed")
+class TestFixtureWithOrjson(TestFixture):
+    serializer = 'orjson'
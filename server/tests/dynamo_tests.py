@@ -0,0 +1,465 @@
+import time
+import shutil
+import hashlib
+import tempfile
+import unittest
+from io import BytesIO
+from server.storage import get_storage_path_for, StreamedBody, StorageMisconfigured, etag_for
+from server.cache import DiskCache
+from server.storage.dynamo import DynamoBackend, blob_path_for, index_partition_for, INDEX_BUCKETS
+from server.tests.fakes import FakeTable, FakeBucket, FakeIndexTable, MAX_ITEM_SIZE
+
+def blob_path_of(data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return blob_path_for(hashlib.sha256(data).hexdigest())
+
+class TestDynamoBackend(unittest.TestCase):
+    def setUp(self):
+        self.table = FakeTable()
+        self.bucket = FakeBucket()
+        self.index_table = FakeIndexTable()
+        self.storage = DynamoBackend('kvstore', 'kvstore-large', table=self.table, bucket=self.bucket,
+            index_table=self.index_table, batch_retry_delay=0)
+
+    def test_store_and_read(self):
+        self.storage.store("one", '{"one": 1}', "application/json")
+        self.assertEqual(("application/json", '{"one": 1}', "one"), self.storage.read("one")[:3])
+
+    def test_large_values_go_straight_to_s3_with_a_pointer(self):
+        large = "x" * MAX_ITEM_SIZE
+        self.storage.store("large", large, "text/plain")
+        self.assertTrue(blob_path_of(large) in self.bucket.objects)
+        self.assertFalse('body' in self.table.items[get_storage_path_for("large")])
+        self.assertEqual(("text/plain", large.encode('utf-8'), "large"), self.storage.read("large")[:3])
+        stats = self.storage.stats()
+        self.assertEqual(1, stats['s3_writes'])
+        self.assertEqual(1, stats['s3_pointer_reads'])
+        self.assertFalse('dynamo_oversize_rejections' in stats)
+
+    def test_replacing_large_value_with_small(self):
+        self.storage.store("replaced", "x" * MAX_ITEM_SIZE, "text/plain")
+        self.storage.store("replaced", "small", "text/plain")
+        self.assertEqual(("text/plain", "small", "replaced"), self.storage.read("replaced")[:3])
+
+    def test_read_missing(self):
+        self.assertEqual((None, None, None, None), self.storage.read("missing"))
+        self.assertEqual(1, self.storage.stats()['legacy_s3_reads'])
+
+    def test_read_missing_without_legacy_fallback(self):
+        self.storage.legacy_s3_fallback = False
+        self.assertEqual((None, None, None, None), self.storage.read("missing"))
+        self.assertEqual([], self.bucket.calls)
+
+    def test_read_legacy_s3_value(self):
+        self.storage.upload_to_s3("legacy", "legacy", "text/plain")
+        self.assertEqual(("text/plain", b"legacy", "legacy"), self.storage.read("legacy")[:3])
+
+    def test_delete_large_value(self):
+        self.storage.store("large", "x" * MAX_ITEM_SIZE, "text/plain")
+        self.storage.delete("large")
+        self.assertEqual((None, None, None, None), self.storage.read("large"))
+
+    def test_delete_small_value_leaves_s3_alone(self):
+        self.storage.legacy_s3_fallback = False
+        self.storage.store("small", "small", "text/plain")
+        self.storage.delete("small")
+        self.assertTrue(self.storage.delete_if("small", None))
+        self.assertEqual([], self.bucket.calls)
+        self.assertEqual((None, None, None, None), self.storage.read("small"))
+
+    def test_delete_value_stored_at_its_path(self):
+        self.storage.legacy_s3_fallback = False
+        self.storage.deduplicate_blobs = False
+        self.storage.store("large", "x" * MAX_ITEM_SIZE, "text/plain")
+        self.assertTrue(get_storage_path_for("large") in self.bucket.objects)
+        self.storage.delete("large")
+        self.assertEqual({}, self.bucket.objects)
+
+    def test_read_many_batches_by_100(self):
+        keys = ["key%s" % i for i in range(250)]
+        for key in keys:
+            self.storage.store(key, key, "text/plain")
+        found = self.storage.read_many(keys)
+        self.assertEqual(250, len(found))
+        self.assertEqual(("text/plain", "key42", "key42"), found["key42"][:3])
+        self.assertEqual([100, 100, 50], [call[1] for call in self.table.calls if call[0] == 'batch_get'])
+
+    def test_read_many_retries_unprocessed_keys(self):
+        self.table.unprocessed_batches = 2
+        keys = ["key%s" % i for i in range(5)]
+        for key in keys:
+            self.storage.store(key, key, "text/plain")
+        found = self.storage.read_many(keys)
+        self.assertEqual(set(keys), set(found.keys()))
+
+    def test_read_many_follows_pointers_and_skips_missing(self):
+        self.storage.store("small", "small", "text/plain")
+        self.storage.store("large", "x" * MAX_ITEM_SIZE, "text/plain")
+        found = self.storage.read_many(["small", "large", "missing", "small"])
+        self.assertEqual(set(["small", "large"]), set(found.keys()))
+        self.assertEqual("text/plain", found["large"][0])
+        # the key found in DynamoDB is never looked for in s3
+        self.assertFalse(('get', get_storage_path_for("small")) in self.bucket.calls)
+
+    def test_store_many_batches_by_25(self):
+        items = [("key%s" % i, "value%s" % i, "text/plain", None) for i in range(60)]
+        results = self.storage.store_many(items)
+        self.assertEqual(60, len(results))
+        self.assertEqual(set([None]), set(results.values()))
+        self.assertEqual([25, 25, 10], [call[1] for call in self.table.calls if call[0] == 'batch_write'])
+        self.assertEqual(("text/plain", "value42", "key42"), self.storage.read("key42")[:3])
+
+    def test_store_many_retries_unprocessed_items(self):
+        self.table.unprocessed_batches = 2
+        items = [("key%s" % i, "value%s" % i, "text/plain", None) for i in range(5)]
+        results = self.storage.store_many(items)
+        self.assertEqual(set([None]), set(results.values()))
+        self.assertEqual(5, len(self.table.items))
+
+    def test_store_many_reports_items_left_unprocessed(self):
+        self.table.unprocessed_batches = 100
+        self.storage.batch_retries = 0
+        items = [("key%s" % i, "value%s" % i, "text/plain", None) for i in range(3)]
+        results = self.storage.store_many(items)
+        self.assertEqual(None, results["key0"])
+        self.assertTrue(results["key1"])
+
+    def test_store_many_sends_large_values_straight_to_s3(self):
+        large = "x" * MAX_ITEM_SIZE
+        results = self.storage.store_many([("small", "small", "text/plain", None), ("large", large, "text/plain", None)])
+        self.assertEqual(dict(small=None, large=None), results)
+        self.assertTrue(blob_path_of(large) in self.bucket.objects)
+        self.assertFalse(('put_item', get_storage_path_for("large")) in self.table.calls)
+        self.assertEqual('s3', self.table.items[get_storage_path_for("large")]['location'])
+        self.assertEqual(large.encode('utf-8'), self.storage.read("large")[1])
+
+    def test_store_stream_uses_multipart_upload_for_large_values(self):
+        data = b"x" * (11 * 1024 * 1024)
+        self.storage.store_stream("streamed", BytesIO(data), "application/octet-stream", len(data))
+        parts = [call for call in self.bucket.calls if call[0] == 'upload_part']
+        self.assertEqual(2, len(parts))
+        self.assertEqual(data, self.bucket.objects[blob_path_of(data)][1])
+        self.assertFalse(get_storage_path_for("streamed") in self.bucket.objects)
+        self.assertEqual('s3', self.table.items[get_storage_path_for("streamed")]['location'])
+
+    def test_store_stream_cancels_upload_of_short_stream(self):
+        data = b"x" * (9 * 1024 * 1024)
+        with self.assertRaises(IOError):
+            self.storage.store_stream("short", BytesIO(data), "application/octet-stream", len(data) + 1)
+        self.assertEqual(['cancel_upload'], [call[0] for call in self.bucket.calls if call[0] == 'cancel_upload'])
+        self.assertFalse(get_storage_path_for("short") in self.table.items)
+
+    def test_streamed_upload_is_never_read_before_its_pointer_is_written(self):
+        self.storage.deduplicate_blobs = False
+        self.storage.legacy_s3_fallback = False
+        self.storage.part_size = 5 * 1024 * 1024
+        self.storage.store("streamed", "x" * MAX_ITEM_SIZE, "text/plain")
+        self.assertTrue(get_storage_path_for("streamed") in self.bucket.objects)
+        first = self.storage.read_metadata("streamed")[1]
+        data = b"y" * (6 * 1024 * 1024)
+        self.storage.store_stream("streamed", BytesIO(data), "application/octet-stream", len(data))
+        uploads = set(call[1] for call in self.bucket.calls if call[0] == 'upload_part')
+        self.assertFalse(get_storage_path_for("streamed") in uploads)
+        self.assertEqual(("application/octet-stream", data), self.storage.read("streamed")[:2])
+        self.assertTrue(self.storage.read_metadata("streamed")[1]['version'] > first['version'])
+        # what the key held at its own path went with the pointer to it, and the
+        # upload became a blob that's collected once nothing points to it
+        self.assertEqual(1, len(self.bucket.objects))
+        self.storage.store("streamed", "small", "text/plain")
+        self.assertEqual(1, len(self.storage.collect_blobs(time.time() + self.storage.blob_grace_seconds + 1)))
+        self.assertEqual({}, self.bucket.objects)
+
+    def test_streamed_upload_does_not_replace_a_later_version(self):
+        data = b"y" * (11 * 1024 * 1024)
+        self.storage.store("streamed", "later", "text/plain",
+            metadata={'version': 2 ** 62})
+        self.storage.store_stream("streamed", BytesIO(data), "application/octet-stream", len(data))
+        self.assertEqual("later", self.storage.read("streamed")[1])
+        self.assertEqual(1, self.storage.stats()['conditional_write_conflicts'])
+
+    def test_store_stream_small_value(self):
+        self.storage.store_stream("small", BytesIO(b"small"), "text/plain", 5)
+        self.assertEqual(("text/plain", b"small", "small"), self.storage.read("small")[:3])
+
+    def test_read_stream(self):
+        data = b"x" * MAX_ITEM_SIZE
+        self.storage.store("large", data, "application/octet-stream")
+        content_type, body, key, metadata = self.storage.read("large", stream=True)
+        self.assertTrue(isinstance(body, StreamedBody))
+        self.assertEqual(len(data), body.size)
+        self.assertEqual(data, b"".join(body))
+
+    def test_read_stream_missing(self):
+        self.assertEqual((None, None, None, None), self.storage.read("missing", stream=True))
+
+    def test_metadata_stored_with_values(self):
+        self.storage.store("small", "small", "text/plain", metadata={'cache-control': 'max-age=60'})
+        self.storage.store("large", "x" * MAX_ITEM_SIZE, "text/plain")
+        content_type, body, key, metadata = self.storage.read("small")
+        self.assertEqual('max-age=60', metadata['cache-control'])
+        self.assertEqual(etag_for("small"), metadata['etag'])
+        self.assertTrue(isinstance(metadata['last-modified'], int))
+        content_type, body, key, metadata = self.storage.read("large")
+        self.assertEqual(etag_for("x" * MAX_ITEM_SIZE), metadata['etag'])
+
+    def test_read_metadata_does_not_fetch_body(self):
+        self.storage.store("large", "x" * MAX_ITEM_SIZE, "text/plain")
+        content_type, metadata = self.storage.read_metadata("large")
+        self.assertEqual("text/plain", content_type)
+        self.assertEqual(etag_for("x" * MAX_ITEM_SIZE), metadata['etag'])
+        self.assertFalse(('get', get_storage_path_for("large")) in self.bucket.calls)
+        self.assertEqual((None, None), self.storage.read_metadata("missing"))
+
+    def test_streamed_upload_etag(self):
+        data = b"x" * (11 * 1024 * 1024)
+        self.storage.store_stream("streamed", BytesIO(data), "application/octet-stream", len(data))
+        self.assertEqual(etag_for(data), self.storage.read_metadata("streamed")[1]['etag'])
+
+    def test_list_keys(self):
+        for key in ["user/2/b", "user/1/a", "user/10", "users", "user", "video/1", "u"]:
+            self.storage.store(key, "1", "text/plain")
+        self.storage.store_many([("user/1/b", "1", "text/plain", None), ("large/1", "x" * MAX_ITEM_SIZE, "text/plain", None)])
+        self.assertEqual(["user/1/a", "user/1/b"], self.storage.list_keys("user/1/"))
+        self.assertEqual(["user/1/a", "user/1/b", "user/10"], self.storage.list_keys("user/1"))
+        self.assertEqual(["u", "user", "user/1/a", "user/1/b", "user/10", "user/2/b", "users"], self.storage.list_keys("u"))
+        self.assertEqual(["large/1", "u", "user"], self.storage.list_keys(limit=3))
+        self.assertEqual(["user/1/a", "user/1/b"], self.storage.list_keys("u", start_after="user", limit=2))
+        self.assertEqual(["user/10", "user/2/b", "users"], self.storage.list_keys("u", start_after="user/1/b"))
+        self.assertEqual([], self.storage.list_keys("x"))
+        self.storage.delete("user/1/a")
+        self.assertEqual(["user/1/b"], self.storage.list_keys("user/1/"))
+
+    def test_list_keys_fetches_pages_as_needed(self):
+        for number in range(50):
+            self.storage.store("paged/%02d" % (number), "1", "text/plain")
+        self.index_table.calls = []
+        self.assertEqual(["paged/%02d" % (number) for number in range(10, 15)],
+            self.storage.list_keys("paged/", start_after="paged/09", limit=5))
+        self.assertEqual([('query', index_partition_for("paged/"), 0)], self.index_table.calls)
+
+    def test_list_keys_of_a_flat_keyspace_queries_each_partition_once(self):
+        keys = ["flat%03d" % (number) for number in range(300)]
+        self.storage.store_many([(key, "1", "text/plain", None) for key in keys])
+        self.index_table.calls = []
+        self.assertEqual(keys[:20], self.storage.list_keys(limit=20))
+        self.assertEqual(INDEX_BUCKETS, len(self.index_table.calls))
+        self.assertEqual(keys[150:250], self.storage.list_keys("flat", start_after=keys[149]))
+        self.assertEqual(keys[299:], self.storage.list_keys("flat29", start_after=keys[298]))
+        self.assertEqual(keys, self.storage.list_keys(limit=1000))
+
+    def test_reap_expired(self):
+        now = int(time.time())
+        self.storage.store("expired", "x" * MAX_ITEM_SIZE, "text/plain", metadata=dict(expires=now - 10))
+        self.storage.store_many([("expired/many", "1", "text/plain", dict(expires=now - 10))])
+        self.storage.store("restored", "1", "text/plain", metadata=dict(expires=now - 10))
+        self.storage.store("restored", "2", "text/plain")
+        self.storage.store("later", "1", "text/plain", metadata=dict(expires=now + 7200))
+        self.assertEqual(["expired", "expired/many"], sorted(self.storage.reap_expired(now)))
+        self.assertEqual((None, None, None, None), self.storage.read("expired"))
+        # its blob is left for the collector
+        self.assertTrue(blob_path_of("x" * MAX_ITEM_SIZE) in self.bucket.objects)
+        self.assertEqual("2", self.storage.read("restored")[1])
+        self.assertEqual(["later", "restored"], self.storage.list_keys())
+        self.assertEqual([], self.storage.reap_expired(now))
+        self.assertEqual(["later"], self.storage.reap_expired(now + 7200))
+
+    def test_reaper_skips_hours_already_reaped(self):
+        now = int(time.time())
+        self.storage.store("expired", "1", "text/plain", metadata=dict(expires=now - 7200))
+        self.assertEqual(["expired"], self.storage.reap_expired(now))
+        # only the hour we're in is left to be looked at
+        self.assertEqual(now // 3600 - 1, self.storage.reaped_through)
+
+    def test_unexpired_keys(self):
+        now = int(time.time())
+        self.storage.store("expired", "1", "text/plain", metadata=dict(expires=now - 10))
+        self.storage.store("later", "1", "text/plain", metadata=dict(expires=now + 10))
+        self.storage.store("kept", "1", "text/plain")
+        self.table.calls = []
+        self.assertEqual(["kept", "later", "missing"], self.storage.unexpired_keys(["kept", "expired", "later", "missing"]))
+        self.assertEqual([('batch_get', 4)], self.table.calls)
+
+    def test_store_if(self):
+        self.assertTrue(self.storage.store_if("one", "1", "text/plain"))
+        self.assertFalse(self.storage.store_if("one", "2", "text/plain"))
+        content_type, metadata = self.storage.read_metadata("one")
+        self.assertFalse(self.storage.store_if("one", "2", "text/plain", expected=dict(metadata, etag=etag_for("3"))))
+        self.assertTrue(self.storage.store_if("one", "2", "text/plain", expected=metadata))
+        self.assertEqual("2", self.storage.read("one")[1])
+        self.assertEqual(2, self.storage.stats()['conditional_write_conflicts'])
+        self.assertEqual(["one"], self.storage.list_keys())
+
+    def test_store_if_large_value(self):
+        large = "x" * MAX_ITEM_SIZE
+        self.assertTrue(self.storage.store_if("large", large, "text/plain"))
+        self.assertFalse('body' in self.table.items[get_storage_path_for("large")])
+        self.assertEqual(large.encode('utf-8'), self.storage.read("large")[1])
+        content_type, metadata = self.storage.read_metadata("large")
+        self.assertFalse(self.storage.store_if("large", "y" * MAX_ITEM_SIZE, "text/plain"))
+        self.assertTrue(self.storage.store_if("large", "z" * MAX_ITEM_SIZE, "text/plain", expected=metadata))
+        self.assertEqual(b"z" * MAX_ITEM_SIZE, self.storage.read("large")[1])
+        # nothing was ever written to the key's own path
+        self.assertFalse(get_storage_path_for("large") in self.bucket.objects)
+
+    def test_store_if_large_value_without_deduplication(self):
+        self.storage.deduplicate_blobs = False
+        self.storage.store("large", "x" * MAX_ITEM_SIZE, "text/plain")
+        content_type, metadata = self.storage.read_metadata("large")
+        self.assertFalse(self.storage.store_if("large", "y" * MAX_ITEM_SIZE, "text/plain"))
+        self.assertEqual(b"x" * MAX_ITEM_SIZE, self.storage.read("large")[1])
+        self.assertTrue(self.storage.store_if("large", "z" * MAX_ITEM_SIZE, "text/plain", expected=metadata))
+        self.assertEqual(b"z" * MAX_ITEM_SIZE, self.storage.read("large")[1])
+        # the blob of the write that failed is left to be collected
+        self.assertEqual(1, len(self.storage.collect_blobs(time.time() + self.storage.blob_grace_seconds + 1)))
+        self.assertEqual(b"z" * MAX_ITEM_SIZE, self.storage.read("large")[1])
+
+    def test_versions(self):
+        self.storage.store("one", "1", "text/plain")
+        first = self.storage.read_metadata("one")[1]
+        self.storage.store("one", "1", "text/plain")
+        second = self.storage.read_metadata("one")[1]
+        self.assertTrue(second['version'] > first['version'])
+        self.assertFalse(self.storage.store_if("one", "2", "text/plain", expected=first))
+        # a version from a clock ahead of ours is still followed
+        ahead = dict(second, version=second['version'] + 10 ** 9)
+        self.table.items[get_storage_path_for("one")]['version'] = ahead['version']
+        self.assertTrue(self.storage.store_if("one", "2", "text/plain", expected=ahead))
+        self.assertEqual(ahead['version'] + 1, self.storage.read_metadata("one")[1]['version'])
+
+    def test_delete_if(self):
+        self.storage.store("large", "x" * MAX_ITEM_SIZE, "text/plain")
+        content_type, metadata = self.storage.read_metadata("large")
+        self.assertFalse(self.storage.delete_if("large", dict(metadata, version=1)))
+        self.assertTrue(get_storage_path_for("large") in self.table.items)
+        self.assertTrue(self.storage.delete_if("large", metadata))
+        self.assertFalse(get_storage_path_for("large") in self.table.items)
+        self.assertEqual((None, None), self.storage.read_metadata("large"))
+        self.assertEqual([], self.storage.list_keys())
+
+    def test_identical_large_values_are_uploaded_once(self):
+        large = "x" * MAX_ITEM_SIZE
+        self.storage.store("template", large, "text/plain")
+        self.storage.store("copy/1", large, "application/octet-stream")
+        self.storage.store_many([("copy/2", large, "text/plain", None)])
+        self.assertEqual(1, len([call for call in self.bucket.calls if call[0] == 'put']))
+        self.assertEqual([blob_path_of(large)], list(self.bucket.objects))
+        self.assertEqual(("application/octet-stream", large.encode('utf-8')), self.storage.read("copy/1")[:2])
+        found = self.storage.read_many(["template", "copy/2"])
+        self.assertEqual(("text/plain", large.encode('utf-8')), found["copy/2"][:2])
+        stats = self.storage.stats()
+        self.assertEqual(1, stats['blob_uploaded'])
+        self.assertEqual(2, stats['blob_deduplicated'])
+        self.assertEqual(2 * MAX_ITEM_SIZE, stats['blob_deduplicated_bytes'])
+        self.assertEqual(0.6667, stats['blob_dedup_ratio'])
+
+    def test_streamed_duplicate_is_deduplicated(self):
+        data = b"x" * (11 * 1024 * 1024)
+        self.storage.store("stored", data, "application/octet-stream")
+        self.storage.store_stream("streamed", BytesIO(data), "application/octet-stream", len(data))
+        self.assertEqual([blob_path_of(data)], list(self.bucket.objects))
+        self.assertFalse([call for call in self.bucket.calls if call[0] == 'copy'])
+        self.assertEqual(data, self.storage.read("streamed")[1])
+        self.assertEqual(1, self.storage.stats()['blob_deduplicated'])
+
+    def test_collect_blobs(self):
+        now = int(time.time())
+        self.storage.store("one", "1" * MAX_ITEM_SIZE, "text/plain")
+        self.storage.store("two", "1" * MAX_ITEM_SIZE, "text/plain")
+        self.storage.store("three", "3" * MAX_ITEM_SIZE, "text/plain")
+        self.storage.store("three", "small", "text/plain")
+        self.storage.delete("two")
+        # nothing points to the blob of three any more, but it could have just
+        # been claimed by a write that's yet to point to it
+        self.assertEqual([], self.storage.collect_blobs(now))
+        self.assertEqual(1, self.storage.blob_summary['unreferenced_blobs'])
+        collected = self.storage.collect_blobs(now + self.storage.blob_grace_seconds + 1)
+        self.assertEqual([hashlib.sha256(b"3" * MAX_ITEM_SIZE).hexdigest()], collected)
+        self.assertEqual([blob_path_of("1" * MAX_ITEM_SIZE)], list(self.bucket.objects))
+        self.assertEqual(b"1" * MAX_ITEM_SIZE, self.storage.read("one")[1])
+        summary = self.storage.stats()['blob_storage']
+        self.assertEqual(1, summary['blobs'])
+        self.assertEqual(1, summary['references'])
+        self.assertEqual(0, summary['saved_bytes'])
+
+    def test_collect_blobs_reports_bytes_saved(self):
+        for key in ["one", "two", "three"]:
+            self.storage.store(key, "1" * MAX_ITEM_SIZE, "text/plain")
+        self.storage.collect_blobs()
+        summary = self.storage.blob_summary
+        self.assertEqual(3, summary['references'])
+        self.assertEqual(MAX_ITEM_SIZE, summary['stored_bytes'])
+        self.assertEqual(2 * MAX_ITEM_SIZE, summary['saved_bytes'])
+
+    def test_blobs_are_collected_by_the_lease_holder(self):
+        now = int(time.time())
+        other = DynamoBackend('kvstore', 'kvstore-large', table=self.table, bucket=self.bucket,
+            index_table=self.index_table, blob_grace_seconds=0)
+        self.storage.store("one", "1" * MAX_ITEM_SIZE, "text/plain")
+        self.storage.delete("one")
+        self.assertTrue(self.storage.hold_lease('blob-collector', 60, now))
+        self.assertEqual([], other.collect_blobs(now + 1, lease_seconds=60))
+        self.assertEqual(1, len(self.bucket.objects))
+        # the lease is renewed by its holder, and taken over once it's expired
+        self.assertTrue(self.storage.hold_lease('blob-collector', 60, now + 30))
+        self.assertEqual([], other.collect_blobs(now + 60, lease_seconds=60))
+        self.assertEqual(1, len(other.collect_blobs(now + 90, lease_seconds=60)))
+        self.assertEqual({}, self.bucket.objects)
+        self.assertFalse(self.storage.hold_lease('blob-collector', 60, now + 120))
+
+    def test_condemned_blob_is_not_claimed(self):
+        large = "x" * MAX_ITEM_SIZE
+        self.storage.store("one", large, "text/plain")
+        self.storage.delete("one")
+        record = dict(self.index_table.items[('b', hashlib.sha256(large.encode('utf-8')).hexdigest())])
+        self.assertTrue(self.storage.condemn_blob(record, int(time.time())))
+        # a claim made since the record was read stops it being condemned
+        self.assertFalse(self.storage.condemn_blob(record, int(time.time())))
+        self.storage.store("two", large, "text/plain")
+        self.assertTrue(get_storage_path_for("two") in self.bucket.objects)
+        self.assertEqual(1, self.storage.stats()['blob_claim_conflicts'])
+        self.storage.collect_blobs()
+        self.assertEqual(large.encode('utf-8'), self.storage.read("two")[1])
+
+    def test_deduplication_can_be_turned_off(self):
+        self.storage.deduplicate_blobs = False
+        large = "x" * MAX_ITEM_SIZE
+        self.storage.store("one", large, "text/plain")
+        self.storage.store("two", large, "text/plain")
+        self.assertEqual(set([get_storage_path_for("one"), get_storage_path_for("two")]), set(self.bucket.objects))
+        self.assertEqual(large.encode('utf-8'), self.storage.read("two")[1])
+
+    def test_nothing_is_connected_to_until_used(self):
+        storage = DynamoBackend('kvstore', 'kvstore-large')
+        self.assertEqual({}, storage.connections.connections)
+
+    def test_warm_up(self):
+        self.storage.warm_up()
+        self.assertEqual([('get_item', '__warm_up__')], self.table.calls)
+        self.assertEqual([('describe',)], self.index_table.calls)
+        self.assertEqual([('head', '__warm_up__')], self.bucket.calls)
+
+    def test_warm_up_fails_without_the_index_table(self):
+        self.index_table.exists = False
+        with self.assertRaises(StorageMisconfigured):
+            self.storage.warm_up()
+
+    def test_large_values_are_cached_on_disk(self):
+        cache_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_root)
+        self.storage.disk_cache = DiskCache(cache_root, 10 * MAX_ITEM_SIZE)
+        large = "x" * MAX_ITEM_SIZE
+        self.storage.store("large", large, "text/plain")
+        content_type, body, key, metadata = self.storage.read("large", stream=True)
+        self.assertEqual(large.encode('utf-8'), body.read())
+        self.bucket.calls = []
+        content_type, body, key, metadata = self.storage.read("large", stream=True)
+        self.assertTrue(body.file is not None)
+        self.assertEqual(MAX_ITEM_SIZE, body.size)
+        self.assertEqual(("text/plain", large.encode('utf-8')), (content_type, body.read()))
+        self.assertEqual(large.encode('utf-8'), self.storage.read_many(["large"])["large"][1])
+        self.assertEqual([], self.bucket.calls)
+        # the pointer record has changed, so what's cached isn't used
+        self.storage.store("large", "y" * MAX_ITEM_SIZE, "text/plain")
+        self.assertEqual(b"y" * MAX_ITEM_SIZE, self.storage.read("large")[1])
+        self.assertEqual(b"y" * MAX_ITEM_SIZE, self.storage.read("large", stream=True)[1].read())
@@ -0,0 +1,374 @@
+""" In-memory stand-ins for the boto DynamoDB table and S3 bucket used by the
+    DynamoBackend, so it can be exercised without AWS.  Both can be given a
+    latency, in seconds, that each call to them waits, so they can stand in for
+    the real thing when benchmarking.
+"""
+import time
+import random
+import threading
+from boto.exception import S3ResponseError
+from boto.dynamodb.types import Dynamizer
+from boto.dynamodb2.exceptions import ItemNotFound, ValidationException, ConditionalCheckFailedException
+from boto.dynamodb2.exceptions import ResourceNotFoundException
+
+# DynamoDB won't store an item larger than this
+MAX_ITEM_SIZE = 400 * 1024
+
+def item_size(data):
+    return sum(len(name) + len(value if isinstance(value, (str, bytes)) else str(value))
+        for name, value in data.items())
+
+def wait_for(latency, jitter):
+    """ sleeps for latency seconds, give or take the jitter fraction of it """
+    if latency:
+        time.sleep(latency * random.uniform(1 - jitter, 1 + jitter))
+
+class FakeConnection(object):
+    def __init__(self, table):
+        self.table = table
+
+    def batch_write_item(self, request_items):
+        requests = request_items[self.table.table_name]
+        self.table.wait()
+        self.table.calls.append(('batch_write', len(requests)))
+        if len(requests) > 25:
+            raise ValidationException(400, "Too many items requested for the BatchWriteItem call")
+        with self.table.lock:
+            unprocessed = []
+            if self.table.unprocessed_batches and len(requests) > 1:
+                self.table.unprocessed_batches -= 1
+                requests, unprocessed = requests[:1], requests[1:]
+        items = []
+        for request in requests:
+            raw_item = request['PutRequest']['Item']
+            item = dict((name, self.table._dynamizer.decode(value)) for name, value in raw_item.items())
+            if item_size(item) > MAX_ITEM_SIZE:
+                raise ValidationException(400, "Item size has exceeded the maximum allowed size")
+            items.append(item)
+        for item in items:
+            self.table.items[item['path']] = item
+        if unprocessed:
+            return {'UnprocessedItems': {self.table.table_name: unprocessed}}
+        return {'UnprocessedItems': {}}
+
+    def put_item(self, table_name, item, condition_expression=None, expression_attribute_names=None,
+            expression_attribute_values=None, return_values=None):
+        """ the put DynamoBackend makes to replace an earlier version, the only
+            condition understood is 'attribute_not_exists(#a) OR #a < :v'
+        """
+        data = dict((name, self.table._dynamizer.decode(value)) for name, value in item.items())
+        self.table.wait()
+        self.table.calls.append(('conditional_put_item', data['path']))
+        with self.table.lock:
+            current = self.table.items.get(data['path'], {})
+            if condition_expression is not None:
+                name = list(expression_attribute_names.values())[0]
+                value = self.table._dynamizer.decode(list(expression_attribute_values.values())[0])
+                if name in current and not current[name] < value:
+                    raise ConditionalCheckFailedException(400, "The conditional request failed")
+            self.table.items[data['path']] = data
+        if return_values != 'ALL_OLD' or not current:
+            return {}
+        return {'Attributes': dict((name, self.table._dynamizer.encode(value)) for name, value in current.items())}
+
+    def delete_item(self, table_name, key, expected=None, return_values=None):
+        """ the delete DynamoBackend makes, with the expectations checked as
+            DynamoDB would
+        """
+        path = self.table._dynamizer.decode(key['path'])
+        self.table.wait()
+        self.table.calls.append(('delete_item', path))
+        with self.table.lock:
+            current = self.table.items.get(path, {})
+            for name, expect in (expected or {}).items():
+                if expect.get('Exists', True):
+                    matched = name in current and current[name] == self.table._dynamizer.decode(expect['Value'])
+                else:
+                    matched = name not in current
+                if not matched:
+                    raise ConditionalCheckFailedException(400, "The conditional request failed")
+            deleted = self.table.items.pop(path, None)
+        if return_values != 'ALL_OLD' or not deleted:
+            return {}
+        return {'Attributes': dict((name, self.table._dynamizer.encode(value)) for name, value in deleted.items())}
+
+class FakeTable(object):
+    def __init__(self, unprocessed_batches=0, latency=0, jitter=0):
+        self.table_name = 'kvstore'
+        self.latency = latency
+        self.jitter = jitter
+        self.items = {}
+        self.calls = []
+        self.lock = threading.Lock()
+        self.connection = FakeConnection(self)
+        self._dynamizer = Dynamizer()
+        # the number of batch requests for which only the first key will be processed
+        self.unprocessed_batches = unprocessed_batches
+
+    def wait(self):
+        wait_for(self.latency, self.jitter)
+
+    def get_item(self, path, attributes=None, consistent=False):
+        self.wait()
+        self.calls.append(('get_item', path))
+        if path not in self.items:
+            raise ItemNotFound("Item %s couldn't be found." % path)
+        item = dict(self.items[path])
+        if attributes is not None:
+            item = dict((name, value) for name, value in item.items() if name in attributes)
+        return item
+
+    def put_item(self, data, overwrite=False):
+        self.wait()
+        self.calls.append(('put_item', data['path']))
+        if item_size(data) > MAX_ITEM_SIZE:
+            raise ValidationException(400, "Item size has exceeded the maximum allowed size")
+        self.items[data['path']] = dict(data)
+        return True
+
+    def _put_item(self, item_data, expects=None):
+        """ the put Item.save makes, with the item encoded and the expectations
+            checked as DynamoDB would
+        """
+        self.wait()
+        data = dict((name, self._dynamizer.decode(value)) for name, value in item_data.items())
+        self.calls.append(('conditional_put_item', data['path']))
+        if item_size(data) > MAX_ITEM_SIZE:
+            raise ValidationException(400, "Item size has exceeded the maximum allowed size")
+        with self.lock:
+            current = self.items.get(data['path'], {})
+            for name, expect in (expects or {}).items():
+                if expect.get('Exists', True):
+                    matched = name in current and current[name] == self._dynamizer.decode(expect['Value'])
+                else:
+                    matched = name not in current
+                if not matched:
+                    raise ConditionalCheckFailedException(400, "The conditional request failed")
+            self.items[data['path']] = data
+        return True
+
+    def delete_item(self, path, expected=None):
+        self.wait()
+        self.calls.append(('delete_item', path))
+        with self.lock:
+            current = self.items.get(path, {})
+            for condition, value in (expected or {}).items():
+                name, operator = condition.rsplit('__', 1)
+                if operator == 'null' and (name in current) == value:
+                    return False
+                if operator == 'eq' and current.get(name) != value:
+                    return False
+            self.items.pop(path, None)
+        return True
+
+    def scan(self, attributes=None, **filters):
+        """ only the __null filter is understood """
+        self.wait()
+        self.calls.append(('scan',))
+        with self.lock:
+            items = [dict(item) for item in self.items.values()]
+        for item in items:
+            if all((name in item) != value for name, value in
+                    ((condition.rsplit('__', 1)[0], value) for condition, value in filters.items())):
+                yield dict((name, value) for name, value in item.items() if attributes is None or name in attributes)
+
+    def _batch_get(self, keys, consistent=False, attributes=None):
+        self.wait()
+        self.calls.append(('batch_get', len(keys)))
+        if len(keys) > 100:
+            raise ValidationException(400, "Too many items requested for the BatchGetItem call")
+        with self.lock:
+            unprocessed = []
+            if self.unprocessed_batches and len(keys) > 1:
+                self.unprocessed_batches -= 1
+                keys, unprocessed = keys[:1], keys[1:]
+        results = [dict((name, value) for name, value in self.items[key['path']].items()
+            if attributes is None or name in attributes) for key in keys if key['path'] in self.items]
+        return dict(results=results, last_key=None, unprocessed_keys=unprocessed)
+
+class FakeKey(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.key = name
+        self.metadata = {}
+
+    def set_metadata(self, name, value):
+        self.metadata[name] = value
+
+    def get_metadata(self, name):
+        return self.metadata.get(name)
+
+    def set_contents_from_string(self, data):
+        self.bucket.wait()
+        self.bucket.calls.append(('put', self.key))
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.bucket.objects[self.key] = (dict(self.metadata), data)
+
+    def get_contents_as_string(self):
+        self.bucket.wait()
+        self.bucket.calls.append(('get', self.key))
+        if self.key not in self.bucket.objects:
+            raise S3ResponseError(404, "Not Found")
+        metadata, data = self.bucket.objects[self.key]
+        self.metadata = dict(metadata)
+        return data
+
+    def open_read(self):
+        self.bucket.wait()
+        self.bucket.calls.append(('open', self.key))
+        if self.key not in self.bucket.objects:
+            raise S3ResponseError(404, "Not Found")
+        metadata, data = self.bucket.objects[self.key]
+        self.metadata = dict(metadata)
+        self.size = len(data)
+        self.offset = 0
+        self.closed = False
+
+    def read(self, size):
+        data = self.bucket.objects[self.key][1][self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+    def close(self):
+        self.closed = True
+
+class FakeMultiPartUpload(object):
+    def __init__(self, bucket, key_name, metadata):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.metadata = metadata
+        self.parts = {}
+
+    def upload_part_from_file(self, fp, part_num):
+        self.bucket.wait()
+        self.bucket.calls.append(('upload_part', self.key_name, part_num))
+        self.parts[part_num] = fp.read()
+
+    def complete_upload(self):
+        self.bucket.wait()
+        data = b''.join(self.parts[part_num] for part_num in sorted(self.parts))
+        self.bucket.objects[self.key_name] = (dict(self.metadata), data)
+
+    def cancel_upload(self):
+        self.bucket.calls.append(('cancel_upload', self.key_name))
+
+class FakeBucket(object):
+    def __init__(self, latency=0, jitter=0):
+        self.objects = {}
+        self.calls = []
+        self.latency = latency
+        self.jitter = jitter
+
+    def wait(self):
+        wait_for(self.latency, self.jitter)
+
+    def new_key(self, key_name=None):
+        return FakeKey(self, key_name)
+
+    def get_key(self, key_name):
+        self.wait()
+        self.calls.append(('head', key_name))
+        return FakeKey(self, key_name) if key_name in self.objects else None
+
+    def initiate_multipart_upload(self, key_name, metadata=None):
+        return FakeMultiPartUpload(self, key_name, metadata or {})
+
+    def copy_key(self, new_key_name, src_bucket_name, src_key_name):
+        self.wait()
+        self.calls.append(('copy', src_key_name, new_key_name))
+        metadata, data = self.objects[src_key_name]
+        self.objects[new_key_name] = (dict(metadata), data)
+
+    def delete_key(self, key_name):
+        self.wait()
+        self.calls.append(('delete', key_name))
+        self.objects.pop(key_name, None)
+
+class FakeBatchTable(object):
+    def __init__(self, table):
+        self.table = table
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def put_item(self, data, overwrite=False):
+        self.table.put_item(data, overwrite=overwrite)
+
+    def delete_item(self, **kwargs):
+        self.table.delete_item(**kwargs)
+
+class FakeIndexTable(object):
+    """ the index of keys, a table with a hash key of segment and a range key of key """
+
+    def __init__(self, latency=0, jitter=0, exists=True):
+        self.items = {}
+        self.calls = []
+        self.latency = latency
+        self.jitter = jitter
+        self.exists = exists
+        self.lock = threading.Lock()
+        self._dynamizer = Dynamizer()
+
+    def wait(self):
+        wait_for(self.latency, self.jitter)
+
+    def describe(self):
+        self.wait()
+        self.calls.append(('describe',))
+        if not self.exists:
+            raise ResourceNotFoundException(400, "Requested resource not found: Table: kvstore-keys not found")
+        return {'Table': {'TableName': 'kvstore-keys'}}
+
+    def get_item(self, segment, key):
+        self.wait()
+        self.calls.append(('get_item', segment, key))
+        if (segment, key) not in self.items:
+            raise ItemNotFound("Item %s %s couldn't be found." % (segment, key))
+        return dict(self.items[(segment, key)])
+
+    def put_item(self, data, overwrite=False):
+        self.wait()
+        self.calls.append(('put_item', data['segment'], data['key']))
+        self.items[(data['segment'], data['key'])] = dict(data)
+        return True
+
+    def _put_item(self, item_data, expects=None):
+        self.wait()
+        data = dict((name, self._dynamizer.decode(value)) for name, value in item_data.items())
+        self.calls.append(('conditional_put_item', data['segment'], data['key']))
+        with self.lock:
+            current = self.items.get((data['segment'], data['key']), {})
+            for name, expect in (expects or {}).items():
+                if expect.get('Exists', True):
+                    matched = name in current and current[name] == self._dynamizer.decode(expect['Value'])
+                else:
+                    matched = name not in current
+                if not matched:
+                    raise ConditionalCheckFailedException(400, "The conditional request failed")
+            self.items[(data['segment'], data['key'])] = data
+        return True
+
+    def delete_item(self, segment, key):
+        self.wait()
+        self.calls.append(('delete_item', segment, key))
+        self.items.pop((segment, key), None)
+        return True
+
+    def batch_write(self):
+        return FakeBatchTable(self)
+
+    def query_2(self, segment__eq, key__gt=None, key__gte=None, key__lt=None, max_page_size=None):
+        """ yields the items a page at a time, like the ResultSet boto returns """
+        keys = sorted(key for segment, key in list(self.items) if segment == segment__eq
+            and (key__gt is None or key > key__gt) and (key__gte is None or key >= key__gte)
+            and (key__lt is None or key < key__lt))
+        page_size = max_page_size or len(keys) or 1
+        for offset in range(0, len(keys), page_size):
+            self.wait()
+            self.calls.append(('query', segment__eq, offset // page_size))
+            for key in keys[offset:offset + page_size]:
+                yield dict(self.items[(segment__eq, key)])
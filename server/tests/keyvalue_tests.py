@@ -0,0 +1,726 @@
+import io
+import os
+import gzip
+import json
+import shutil
+import time
+import tempfile
+import threading
+import unittest
+from server import messages, serialization
+from server.core import app
+from server.core_handlers import keyvalue_handlers
+from server.core_handlers.keyvalue_handlers import get_storage_path_for
+from server.storage import etag_for, StorageMisconfigured
+from server.storage.local import LocalBackend
+from server.storage.dynamo import DynamoBackend
+from server.cache import DiskCache
+from server.tests import SerializerTestCase
+from server.tests.fakes import FakeTable, FakeBucket, FakeIndexTable, MAX_ITEM_SIZE
+
+class TestKeyValue(SerializerTestCase):
+    def setUp(self):
+        super(TestKeyValue, self).setUp()
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        self.storage_root = tempfile.mkdtemp()
+        keyvalue_handlers.storage = LocalBackend(self.storage_root)
+        keyvalue_handlers.read_cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.storage_root)
+        keyvalue_handlers.compression = None
+
+    def turn_on_read_cache(self, ttl=5, negative_ttl=1):
+        """ the read cache is off unless it's configured, as it is here """
+        for name in ('read_cache_ttl', 'read_cache_negative_ttl'):
+            self.addCleanup(setattr, keyvalue_handlers, name, getattr(keyvalue_handlers, name))
+        self.addCleanup(setattr, keyvalue_handlers.read_cache, 'ttl_seconds', keyvalue_handlers.read_cache.ttl_seconds)
+        keyvalue_handlers.read_cache.ttl_seconds = ttl
+        keyvalue_handlers.read_cache_ttl = ttl
+        keyvalue_handlers.read_cache_negative_ttl = negative_ttl
+
+    def test_store_and_read_json(self):
+        response = self.app.post("/test/json", data=json.dumps(dict(one=1)), content_type="application/json")
+        self.assertEqual(200, response.status_code)
+        response = self.app.get("/test/json")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("application/json", response.content_type)
+        self.assertEqual(dict(one=1), json.loads(response.data))
+
+    def test_store_and_read_form(self):
+        self.app.post("/test/form", data=dict(myint="1", mystring="pants"))
+        response = self.app.get("/test/form")
+        self.assertEqual(dict(myint=1, mystring="pants"), json.loads(response.data))
+
+    def test_store_and_read_binary(self):
+        self.app.post("/test/binary", data=b"\x00\x01\x02", content_type="application/octet-stream")
+        response = self.app.get("/test/binary")
+        self.assertEqual(b"\x00\x01\x02", response.data)
+        self.assertEqual("application/octet-stream", response.content_type)
+
+    def test_stored_in_fan_out_layout(self):
+        self.app.post("/test/layout", data=json.dumps(dict(one=1)), content_type="application/json")
+        path = os.path.join(self.storage_root, get_storage_path_for("test/layout"))
+        self.assertTrue(os.path.exists(path))
+
+    def test_read_missing(self):
+        response = self.app.get("/test/not/there")
+        self.assertEqual(404, response.status_code)
+        response = self.app.get("/test/not/there?return404=false")
+        self.assertEqual(200, response.status_code)
+
+    def test_read_with_callback(self):
+        self.app.post("/test/jsonp", data=json.dumps(dict(one=1)), content_type="application/json")
+        response = self.app.get("/test/jsonp?callback=run_me")
+        self.assertEqual(b'run_me(%s);' % self.encoded('{"one": 1}'), response.data)
+
+    def test_delete(self):
+        self.app.post("/test/delete", data=json.dumps(dict(one=1)), content_type="application/json")
+        response = self.app.delete("/test/delete")
+        self.assertEqual(200, response.status_code)
+        response = self.app.get("/test/delete")
+        self.assertEqual(404, response.status_code)
+        # deleting something that isn't there is fine
+        response = self.app.delete("/test/delete")
+        self.assertEqual(200, response.status_code)
+
+    def test_multikey(self):
+        response = self.app.post("/__multikey__", data=json.dumps({"multione": 1, "multitwo": dict(two=2)}),
+            content_type="application/json")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(dict(multione="ok", multitwo="ok"), json.loads(response.data)['results'])
+        response = self.app.get("/__multikey__/multione/multitwo/multithree")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({"multione": 1, "multitwo": dict(two=2)}, json.loads(response.data))
+        response = self.app.get("/__multikey__/multithree/multifour")
+        self.assertEqual(404, response.status_code)
+
+    def test_read_is_cached(self):
+        self.turn_on_read_cache()
+        self.app.post("/test/cached", data=json.dumps(dict(one=1)), content_type="application/json")
+        self.app.get("/test/cached")
+        os.unlink(os.path.join(self.storage_root, get_storage_path_for("test/cached")))
+        response = self.app.get("/test/cached")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(dict(one=1), json.loads(response.data))
+
+    def test_store_invalidates_cached_read(self):
+        self.turn_on_read_cache()
+        self.app.post("/test/invalidate", data=json.dumps(dict(one=1)), content_type="application/json")
+        self.app.get("/test/invalidate")
+        self.app.post("/test/invalidate", data=json.dumps(dict(one=2)), content_type="application/json")
+        response = self.app.get("/test/invalidate")
+        self.assertEqual(dict(one=2), json.loads(response.data))
+        self.app.delete("/test/invalidate")
+        response = self.app.get("/test/invalidate")
+        self.assertEqual(404, response.status_code)
+
+    def test_missing_read_is_cached(self):
+        self.turn_on_read_cache()
+        self.app.get("/test/negative")
+        LocalBackend(self.storage_root).store("test/negative", "{}", "application/json")
+        response = self.app.get("/test/negative")
+        self.assertEqual(404, response.status_code)
+
+    def test_reads_are_not_cached_by_default(self):
+        self.app.post("/test/uncached", data=json.dumps(dict(one=1)), content_type="application/json")
+        self.app.get("/test/uncached")
+        self.app.get("/test/uncached/missing")
+        # as if another worker had handled these writes
+        LocalBackend(self.storage_root).store("test/uncached", json.dumps(dict(one=2)), "application/json")
+        LocalBackend(self.storage_root).store("test/uncached/missing", "{}", "application/json")
+        self.assertEqual(dict(one=2), json.loads(self.app.get("/test/uncached").data))
+        self.assertEqual(200, self.app.get("/test/uncached/missing").status_code)
+
+    def test_read_cache_stats_in_diagnostic(self):
+        self.turn_on_read_cache()
+        before = json.loads(self.app.get("/diagnostic").data)['read_cache']
+        self.app.get("/test/diagnostic")
+        self.app.get("/test/diagnostic")
+        after = json.loads(self.app.get("/diagnostic").data)['read_cache']
+        self.assertEqual(1, after['hits'] - before['hits'])
+        self.assertEqual(1, after['misses'] - before['misses'])
+
+    def test_large_values_are_streamed(self):
+        keyvalue_handlers.storage = LocalBackend(self.storage_root, stream_threshold=1024)
+        data = b"x" * (keyvalue_handlers.stream_threshold + 1)
+        response = self.app.post("/test/streamed", data=data, content_type="application/octet-stream")
+        self.assertEqual(200, response.status_code)
+        response = self.app.get("/test/streamed")
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(str(len(data)), response.headers['Content-Length'])
+        self.assertEqual("application/octet-stream", response.content_type)
+        self.assertEqual(data, response.data)
+
+    def test_large_values_are_streamed_with_callback(self):
+        keyvalue_handlers.storage = LocalBackend(self.storage_root, stream_threshold=2)
+        self.app.post("/test/streamed/jsonp", data=b'{"one": 1}', content_type="text/plain")
+        response = self.app.get("/test/streamed/jsonp?callback=run_me")
+        self.assertEqual(b'run_me({"one": 1});', response.data)
+        self.assertEqual("application/javascript", response.content_type)
+
+    def test_conditional_get(self):
+        self.app.post("/test/conditional", data=json.dumps(dict(one=1)), content_type="application/json",
+            headers={"X-Cache-Control": "max-age=60"})
+        response = self.app.get("/test/conditional")
+        etag = response.headers['ETag']
+        self.assertEqual('"%s"' % etag_for(self.encoded('{"one": 1}')), etag)
+        self.assertEqual("max-age=60", response.headers['Cache-Control'])
+        self.assertTrue(response.headers['Last-Modified'])
+        response = self.app.get("/test/conditional", headers={"If-None-Match": etag})
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(b"", response.data)
+        self.assertEqual(etag, response.headers['ETag'])
+        response = self.app.get("/test/conditional", headers={"If-None-Match": '"nope"'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(dict(one=1), json.loads(response.data))
+
+    def test_conditional_get_modified_since(self):
+        self.app.post("/test/conditional/since", data="pants", content_type="text/plain")
+        last_modified = self.app.get("/test/conditional/since").headers['Last-Modified']
+        response = self.app.get("/test/conditional/since", headers={"If-Modified-Since": last_modified})
+        self.assertEqual(304, response.status_code)
+        response = self.app.get("/test/conditional/since", headers={"If-Modified-Since": "Sat, 01 Jan 2000 00:00:00 GMT"})
+        self.assertEqual(200, response.status_code)
+
+    def test_conditional_get_without_body_read(self):
+        keyvalue_handlers.storage = LocalBackend(self.storage_root, stream_threshold=2)
+        self.app.post("/test/conditional/large", data="pants", content_type="text/plain")
+        etag = self.app.get("/test/conditional/large").headers['ETag']
+        keyvalue_handlers.storage.read = None
+        response = self.app.get("/test/conditional/large", headers={"If-None-Match": etag})
+        self.assertEqual(304, response.status_code)
+
+    def test_conditional_get_missing(self):
+        response = self.app.get("/test/conditional/missing", headers={"If-None-Match": '"nope"'})
+        self.assertEqual(404, response.status_code)
+
+    def test_compressed_values(self):
+        keyvalue_handlers.compression = 'gzip'
+        value = json.dumps(dict(pants=["blue"] * 1000))
+        self.app.post("/test/compressed", data=value, content_type="application/json")
+        content_type, body, key, metadata = keyvalue_handlers.storage.read("test/compressed")
+        self.assertEqual('gzip', metadata['content-encoding'])
+        self.assertTrue(len(body) < len(value))
+
+        response = self.app.get("/test/compressed", headers={"Accept-Encoding": "gzip, deflate"})
+        self.assertEqual("gzip", response.headers['Content-Encoding'])
+        self.assertEqual("Accept-Encoding", response.headers['Vary'])
+        self.assertEqual(self.encoded(value), gzip.decompress(response.data))
+        etag = response.headers['ETag']
+
+        response = self.app.get("/test/compressed")
+        self.assertFalse('Content-Encoding' in response.headers)
+        self.assertEqual(self.encoded(value), response.data)
+        self.assertEqual("W/%s" % etag, response.headers['ETag'])
+        response = self.app.get("/test/compressed", headers={"If-None-Match": "W/%s" % etag})
+        self.assertEqual(304, response.status_code)
+
+        response = self.app.get("/test/compressed?callback=run_me")
+        self.assertEqual(b"run_me(%s);" % self.encoded(value), response.data)
+
+    def test_compressed_multikey_values(self):
+        keyvalue_handlers.compression = 'gzip'
+        value = dict(pants=["blue"] * 1000)
+        self.app.post("/__multikey__", data=json.dumps(dict(compressedone=value, compressedtwo=1)),
+            content_type="application/json")
+        response = self.app.get("/__multikey__/compressedone/compressedtwo")
+        self.assertEqual(dict(compressedone=value, compressedtwo=1), json.loads(response.data))
+
+    def test_small_and_binary_values_are_not_compressed(self):
+        keyvalue_handlers.compression = 'gzip'
+        self.app.post("/test/uncompressed", data="x" * 2000, content_type="application/octet-stream")
+        self.app.post("/test/uncompressed/small", data="{}", content_type="application/json")
+        self.assertFalse('content-encoding' in keyvalue_handlers.storage.read("test/uncompressed")[3])
+        self.assertFalse('content-encoding' in keyvalue_handlers.storage.read("test/uncompressed/small")[3])
+
+    def test_multikey_splices_stored_json(self):
+        keyvalue_handlers.storage.store("spliceone", '{"two":  [1, 2]}', "application/json")
+        keyvalue_handlers.storage.store("splicetext", b"pants", "text/plain")
+        response = self.app.get("/__multikey__/splicetext/splicemissing/spliceone/splicetext")
+        self.assertEqual("application/json", response.content_type)
+        # the stored JSON is spliced in as it is, whatever the serializer writes
+        self.assertEqual(('{"splicetext"%s"pants"%s"spliceone"%s{"two":  [1, 2]}}' % (
+            serialization.key_separator, serialization.item_separator, serialization.key_separator)).encode('utf-8'),
+            response.data)
+
+    def test_change_events(self):
+        stream = io.StringIO()
+        publisher = messages.publisher
+        messages.publisher = messages.Publisher(stream=stream)
+        event_sources = app.config['LOCAL_EVENT_SOURCES']
+        app.config['LOCAL_EVENT_SOURCES'] = frozenset([keyvalue_handlers.STORE_EVENT_SOURCE, keyvalue_handlers.DELETE_EVENT_SOURCE])
+        try:
+            self.app.post("/test/events", data=json.dumps(dict(one=1)), content_type="application/json", headers={"Uid": "pants"})
+            self.app.post("/__multikey__", data=json.dumps(dict(eventsone=1)), content_type="application/json")
+            self.app.delete("/test/events")
+            messages.publisher.flush(5)
+        finally:
+            messages.publisher = publisher
+            app.config['LOCAL_EVENT_SOURCES'] = event_sources
+        events = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([
+            dict(source="kvstore.store", message=dict(key="test/events", content_type="application/json"), user_token="pants"),
+            dict(source="kvstore.store", message=dict(key="eventsone", content_type="application/json"), user_token="DEFAULT"),
+            dict(source="kvstore.delete", message=dict(key="test/events"), user_token="DEFAULT"),
+        ], events)
+
+    def test_list_keys(self):
+        for key in ["user/2", "user/1/a", "user/1/b", "users", "video"]:
+            self.app.post("/%s" % (key), data="1", content_type="text/plain")
+        response = self.app.get("/__keys__?prefix=user/&limit=2")
+        self.assertEqual(dict(keys=["user/1/a", "user/1/b"], next="user/1/b"), json.loads(response.data))
+        response = self.app.get("/__keys__?prefix=user/&limit=2&after=user/1/b")
+        self.assertEqual(dict(keys=["user/2"], next=None), json.loads(response.data))
+        self.app.delete("/user/2")
+        response = self.app.get("/__keys__?prefix=user")
+        self.assertEqual(dict(keys=["user/1/a", "user/1/b", "users"], next=None), json.loads(response.data))
+        response = self.app.get("/__keys__?limit=pants")
+        self.assertEqual(400, response.status_code)
+
+    def test_list_keys_indexes_what_was_already_stored(self):
+        keyvalue_handlers.storage.store("indexed/one", "1", "text/plain")
+        keyvalue_handlers.storage.store("indexed/two", "2", "text/plain")
+        os.unlink(os.path.join(self.storage_root, "keys.sqlite3"))
+        keyvalue_handlers.storage = LocalBackend(self.storage_root)
+        response = self.app.get("/__keys__?prefix=indexed/")
+        self.assertEqual(["indexed/one", "indexed/two"], json.loads(response.data)['keys'])
+
+    def test_ttl(self):
+        response = self.app.post("/test/ttl", data="1", content_type="text/plain", headers={"X-TTL": "60"})
+        self.assertEqual(200, response.status_code)
+        content_type, metadata = keyvalue_handlers.storage.read_metadata("test/ttl")
+        self.assertTrue(time.time() + 55 < metadata['expires'] <= time.time() + 60)
+        self.app.post("/test/ttl/query?ttl=60", data="1", content_type="text/plain")
+        self.assertTrue('expires' in keyvalue_handlers.storage.read_metadata("test/ttl/query")[1])
+        self.app.post("/__multikey__", data=json.dumps({"test/ttl/multikey": 1}), content_type="application/json",
+            headers={"X-TTL": "60"})
+        self.assertTrue('expires' in keyvalue_handlers.storage.read_metadata("test/ttl/multikey")[1])
+        self.assertEqual(400, self.app.post("/test/ttl", data="1", content_type="text/plain", headers={"X-TTL": "0"}).status_code)
+        self.assertEqual(400, self.app.post("/test/ttl?ttl=pants", data="1", content_type="text/plain").status_code)
+
+    def test_expired_values_are_missing(self):
+        keyvalue_handlers.storage.store("test/expired", "1", "text/plain", metadata=dict(expires=int(time.time()) - 1))
+        self.assertEqual(404, self.app.get("/test/expired").status_code)
+        self.assertEqual(404, self.app.get("/__multikey__/test/expired").status_code)
+        response = self.app.get("/test/expired", headers={"If-None-Match": '"%s"' % (etag_for("1"))})
+        self.assertEqual(404, response.status_code)
+
+    def test_expired_values_are_not_served_from_cache(self):
+        self.turn_on_read_cache()
+        self.app.post("/test/expired/cached", data="1", content_type="text/plain", headers={"X-TTL": "60"})
+        self.app.get("/test/expired/cached")
+        # as if the value had expired since it was cached
+        content_type, body, file_path, metadata = keyvalue_handlers.read_cache.get("test/expired/cached")[1]
+        metadata = dict(metadata, expires=int(time.time()) - 1)
+        keyvalue_handlers.read_cache.set("test/expired/cached", (content_type, body, file_path, metadata), 100)
+        self.assertEqual(404, self.app.get("/test/expired/cached").status_code)
+        self.assertEqual(404, self.app.get("/__multikey__/test/expired/cached").status_code)
+
+    def test_values_are_not_cached_past_their_expiry(self):
+        self.assertEqual(keyvalue_handlers.read_cache_ttl, keyvalue_handlers.cache_ttl_for({}))
+        self.assertTrue(keyvalue_handlers.cache_ttl_for(dict(expires=int(time.time()) + 1)) <= 1)
+
+    def test_reap_expired(self):
+        keyvalue_handlers.storage.store("test/reaped", "1", "text/plain", metadata=dict(expires=int(time.time()) - 1))
+        keyvalue_handlers.storage.store("test/restored", "1", "text/plain", metadata=dict(expires=int(time.time()) - 1))
+        keyvalue_handlers.storage.store("test/restored", "2", "text/plain")
+        self.app.post("/test/kept", data="1", content_type="text/plain", headers={"X-TTL": "60"})
+        self.assertEqual(["test/reaped"], keyvalue_handlers.reap_expired())
+        self.assertFalse(os.path.exists(os.path.join(self.storage_root, get_storage_path_for("test/reaped"))))
+        self.assertEqual(["test/kept", "test/restored"], json.loads(self.app.get("/__keys__?prefix=test/").data)['keys'])
+        self.assertEqual([], keyvalue_handlers.reap_expired())
+        self.assertEqual(["test/kept"], keyvalue_handlers.reap_expired(now=time.time() + 60))
+        self.assertEqual(2, keyvalue_handlers.storage.stats()['expired_deletes'])
+
+    def test_reaper_keeps_values_stored_while_it_reaps(self):
+        storage = keyvalue_handlers.storage
+        storage.store("test/raced", "1", "text/plain", metadata=dict(expires=int(time.time()) - 1))
+        read_metadata = storage.read_metadata
+
+        def stored_again_once_read(key):
+            found = read_metadata(key)
+            storage.store(key, "2", "text/plain")
+            return found
+        storage.read_metadata = stored_again_once_read
+        self.assertEqual([], keyvalue_handlers.reap_expired())
+        self.assertEqual("2", storage.read("test/raced")[1])
+
+    def test_list_keys_leaves_out_expired_values(self):
+        for number in range(5):
+            keyvalue_handlers.storage.store("test/listed/%s" % (number), "1", "text/plain",
+                metadata=dict(expires=int(time.time()) + (60 if number % 2 else -1)))
+        keyvalue_handlers.storage.store("test/listed/5", "1", "text/plain", metadata=dict(expires=int(time.time()) - 1))
+        keyvalue_handlers.storage.store("test/listed/5", "2", "text/plain")
+        response = self.app.get("/__keys__?prefix=test/listed/&limit=2")
+        self.assertEqual(dict(keys=["test/listed/1", "test/listed/3"], next="test/listed/3"), json.loads(response.data))
+        response = self.app.get("/__keys__?prefix=test/listed/&limit=2&after=test/listed/3")
+        self.assertEqual(dict(keys=["test/listed/5"], next=None), json.loads(response.data))
+
+    def test_patch(self):
+        self.app.post("/test/patch", data=json.dumps(dict(a=1, b=dict(c=2, d=3))), content_type="application/json",
+            headers={"X-Cache-Control": "max-age=60"})
+        response = self.app.patch("/test/patch", data=json.dumps(dict(a=None, b=dict(c=4), e=[5])),
+            content_type="application/merge-patch+json")
+        self.assertEqual(200, response.status_code)
+        response = self.app.get("/test/patch")
+        self.assertEqual(dict(b=dict(c=4, d=3), e=[5]), json.loads(response.data))
+        self.assertEqual("max-age=60", response.headers['Cache-Control'])
+        self.app.patch("/test/patch/new", data=json.dumps(dict(a=1)), content_type="application/json")
+        self.assertEqual(dict(a=1), json.loads(self.app.get("/test/patch/new").data))
+
+    def test_values_the_stdlib_wrote_are_read_by_each_serializer(self):
+        # NaN and Infinity, and integers too large for 64 bits, as the stdlib writes them
+        stored = '{"nan": NaN, "inf": -Infinity, "big": 18446744073709551616}'
+        keyvalue_handlers.storage.store("nonfinite", stored, "application/json")
+        keyvalue_handlers.storage.store("nonfinitetext", "text", "text/plain")
+        response = self.app.get("/__multikey__/nonfinite/nonfinitetext")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(json.loads(stored), json.loads(response.data)['nonfinite'])
+
+        response = self.app.patch("/nonfinite", data=json.dumps(dict(patched=True)), content_type="application/json")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(self.encoded('{"nan": NaN, "inf": -Infinity, "big": 18446744073709551616, "patched": true}'),
+            self.app.get("/nonfinite").data)
+
+        self.app.post("/test/nonfinite/form", data=dict(nan="nan", inf="inf"))
+        stored = json.loads(self.app.get("/test/nonfinite/form").data)
+        self.assertNotEqual(stored['nan'], stored['nan'])
+        self.assertEqual(float('inf'), stored['inf'])
+
+        response = self.app.post("/__import__", data='{"key": "test/nonfinite/imported", "body": "x", "metadata": {"version": 1e999}}\n')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(b"x", self.app.get("/test/nonfinite/imported").data)
+
+    def test_patch_and_increment_json_stored_with_a_charset(self):
+        self.app.post("/test/patch/charset", data=json.dumps(dict(a=1, count=1)), content_type="application/json; charset=utf-8")
+        response = self.app.patch("/test/patch/charset", data=json.dumps(dict(b=2)), content_type="application/json")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(dict(a=1, b=2, count=1), json.loads(self.app.get("/test/patch/charset").data))
+        response = self.app.post("/__increment__/test/patch/charset?field=count")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(2, json.loads(self.app.get("/test/patch/charset").data)['count'])
+
+    def test_patch_needs_json(self):
+        response = self.app.patch("/test/patch", data="a=1", content_type="application/x-www-form-urlencoded")
+        self.assertEqual(400, response.status_code)
+        self.app.post("/test/patch/text", data="text", content_type="text/plain")
+        response = self.app.patch("/test/patch/text", data=json.dumps(dict(a=1)), content_type="application/json")
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(b"text", self.app.get("/test/patch/text").data)
+
+    def test_patch_conflict(self):
+        self.app.post("/test/patch", data=json.dumps(dict(a=1)), content_type="application/json")
+        storage = keyvalue_handlers.storage
+        tries = []
+        # somebody else always gets there first
+        storage.store_if = lambda key, data, content_type, metadata=None, expected=None: tries.append(time.time()) and False
+        keyvalue_handlers.update_retry_delay, keyvalue_handlers.update_retry_max_delay = 0.004, 0.01
+        try:
+            response = self.app.patch("/test/patch", data=json.dumps(dict(a=2)), content_type="application/json")
+        finally:
+            keyvalue_handlers.update_retry_delay, keyvalue_handlers.update_retry_max_delay = 0.01, 0.5
+        self.assertEqual(409, response.status_code)
+        self.assertEqual(keyvalue_handlers.update_retries, len(tries))
+        # the tries are spread out, waiting no longer than the max each time
+        self.assertTrue(tries[-1] - tries[0] < 0.01 * keyvalue_handlers.update_retries + 0.5)
+
+    def test_increment(self):
+        response = self.app.post("/__increment__/test/count")
+        self.assertEqual(dict(message="ok", value=1), json.loads(response.data))
+        response = self.app.post("/__increment__/test/count?by=-3")
+        self.assertEqual(-2, json.loads(response.data)['value'])
+        response = self.app.post("/__increment__/test/count?by=0.5")
+        self.assertEqual(-1.5, json.loads(response.data)['value'])
+        self.assertEqual(-1.5, json.loads(self.app.get("/test/count").data))
+        self.app.post("/test/counts", data=json.dumps(dict(views=10, name="pants")), content_type="application/json")
+        response = self.app.post("/__increment__/test/counts?field=views&by=5")
+        self.assertEqual(15, json.loads(response.data)['value'])
+        self.app.post("/__increment__/test/counts?field=likes")
+        self.assertEqual(dict(views=15, likes=1, name="pants"), json.loads(self.app.get("/test/counts").data))
+        self.assertEqual(400, self.app.post("/__increment__/test/counts?field=name").status_code)
+        self.assertEqual(400, self.app.post("/__increment__/test/counts").status_code)
+        self.assertEqual(400, self.app.post("/__increment__/test/count?by=pants").status_code)
+        self.assertEqual(400, self.app.post("/__increment__/test/count?by=nan").status_code)
+
+    def test_concurrent_increments_are_all_counted(self):
+        def increment():
+            client = app.test_client()
+            for i in range(10):
+                self.assertEqual(200, client.post("/__increment__/test/concurrent").status_code)
+
+        threads = [threading.Thread(target=increment) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(40, json.loads(self.app.get("/test/concurrent").data))
+
+    def test_if_match(self):
+        self.app.post("/test/versioned", data="1", content_type="text/plain")
+        etag = self.app.get("/test/versioned").headers['ETag']
+        response = self.app.post("/test/versioned", data="2", content_type="text/plain", headers={"If-Match": '"pants"'})
+        self.assertEqual(412, response.status_code)
+        response = self.app.post("/test/versioned", data="2", content_type="text/plain", headers={"If-Match": etag})
+        self.assertEqual(200, response.status_code)
+        response = self.app.post("/test/versioned", data="3", content_type="text/plain", headers={"If-Match": etag})
+        self.assertEqual(412, response.status_code)
+        self.assertEqual(b"2", self.app.get("/test/versioned").data)
+        response = self.app.post("/test/versioned/missing", data="1", content_type="text/plain", headers={"If-Match": "*"})
+        self.assertEqual(412, response.status_code)
+
+    def test_if_none_match_creates_only(self):
+        headers = {"If-None-Match": "*"}
+        self.assertEqual(200, self.app.post("/test/created", data="1", content_type="text/plain", headers=headers).status_code)
+        self.assertEqual(412, self.app.post("/test/created", data="2", content_type="text/plain", headers=headers).status_code)
+        self.assertEqual(b"1", self.app.get("/test/created").data)
+
+    def test_if_match_conflict_with_write_of_the_same_value(self):
+        self.app.post("/test/versioned", data="1", content_type="text/plain")
+        storage = keyvalue_handlers.storage
+        check_preconditions = keyvalue_handlers.check_preconditions
+
+        def checked_then_stored_again(key):
+            checked = check_preconditions(key)
+            # the same value is stored again between the check and the write,
+            # only its version tells them apart
+            storage.store(key, "1", "text/plain")
+            return checked
+
+        keyvalue_handlers.check_preconditions = checked_then_stored_again
+        try:
+            response = self.app.post("/test/versioned", data="2", content_type="text/plain",
+                headers={"If-Match": '"%s"' % (etag_for("1"))})
+        finally:
+            keyvalue_handlers.check_preconditions = check_preconditions
+        self.assertEqual(412, response.status_code)
+        self.assertEqual(b"1", self.app.get("/test/versioned").data)
+
+    def test_delete_if_match(self):
+        self.app.post("/test/versioned", data="1", content_type="text/plain")
+        response = self.app.delete("/test/versioned", headers={"If-Match": '"%s"' % (etag_for("2"))})
+        self.assertEqual(412, response.status_code)
+        self.assertEqual(200, self.app.get("/test/versioned").status_code)
+        response = self.app.delete("/test/versioned", headers={"If-Match": '"%s"' % (etag_for("1"))})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(404, self.app.get("/test/versioned").status_code)
+        self.assertEqual(412, self.app.delete("/test/versioned", headers={"If-Match": "*"}).status_code)
+
+    def test_concurrent_reads_are_coalesced(self):
+        self.app.post("/test/popular", data="1", content_type="text/plain")
+        keyvalue_handlers.read_cache.clear()
+        storage = keyvalue_handlers.storage
+        read = storage.read
+        reads = []
+
+        def slow_read(key, stream=False):
+            reads.append(key)
+            time.sleep(0.1)
+            return read(key, stream=stream)
+
+        storage.read = slow_read
+        joined = keyvalue_handlers.read_flights.stats()['joined']
+        responses = []
+
+        def get():
+            responses.append(app.test_client().get("/test/popular"))
+
+        threads = [threading.Thread(target=get) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([b"1"] * 8, [response.data for response in responses])
+        self.assertEqual(["test/popular"], reads)
+        self.assertEqual(7, keyvalue_handlers.read_flights.stats()['joined'] - joined)
+
+    def test_concurrent_streamed_reads_share_one_read(self):
+        keyvalue_handlers.storage = storage = LocalBackend(self.storage_root, stream_threshold=10)
+        large = b"x" * 1024 * 1024
+        self.app.post("/test/large", data=large, content_type="application/octet-stream")
+        read = storage.read
+        reads = []
+
+        def slow_read(key, stream=False):
+            reads.append(key)
+            time.sleep(0.1)
+            return read(key, stream=stream)
+
+        storage.read = slow_read
+        responses = []
+
+        def get():
+            responses.append(app.test_client().get("/test/large"))
+
+        threads = [threading.Thread(target=get) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([large] * 8, [response.data for response in responses])
+        self.assertEqual(["test/large"], reads)
+
+    def test_reads_after_a_write_are_not_coalesced_with_reads_before_it(self):
+        self.app.post("/test/popular", data="1", content_type="text/plain")
+        keyvalue_handlers.read_cache.clear()
+        generation = keyvalue_handlers.read_cache.generation("test/popular")
+        self.app.post("/test/popular", data="2", content_type="text/plain")
+        # as if a read from before the write were still in progress
+        flight_key = ("test/popular", True, generation)
+        keyvalue_handlers.read_flights.flights[flight_key] = None
+        try:
+            self.assertEqual(b"2", self.app.get("/test/popular").data)
+        finally:
+            del keyvalue_handlers.read_flights.flights[flight_key]
+
+    def test_large_values_are_sent_from_the_disk_cache(self):
+        disk_cache = DiskCache(os.path.join(self.storage_root, "cache"), 10 * MAX_ITEM_SIZE)
+        bucket = FakeBucket()
+        keyvalue_handlers.storage = DynamoBackend('kvstore', 'kvstore-large', table=FakeTable(), bucket=bucket,
+            index_table=FakeIndexTable(), disk_cache=disk_cache)
+        keyvalue_handlers.disk_cache, previous = disk_cache, keyvalue_handlers.disk_cache
+        try:
+            large = b"x" * MAX_ITEM_SIZE
+            self.app.post("/test/large", data=large, content_type="application/octet-stream")
+            self.assertEqual(large, self.app.get("/test/large").data)
+            bucket.calls = []
+            response = self.app.get("/test/large")
+            self.assertEqual(large, response.data)
+            self.assertEqual(str(MAX_ITEM_SIZE), response.headers['Content-Length'])
+            self.assertEqual([], bucket.calls)
+            self.assertEqual(1, disk_cache.stats()['hits'])
+            self.app.delete("/test/large")
+            self.assertEqual(404, self.app.get("/test/large").status_code)
+            self.assertEqual(1, disk_cache.stats()['hits'])
+        finally:
+            keyvalue_handlers.disk_cache = previous
+
+    def test_warm_up_stops_the_worker_only_if_storage_is_misconfigured(self):
+        keyvalue_handlers.storage = DynamoBackend('kvstore', 'kvstore-large', table=FakeTable(), bucket=FakeBucket(),
+            index_table=FakeIndexTable(exists=False))
+        with self.assertRaises(StorageMisconfigured):
+            keyvalue_handlers.warm_up()
+
+        def unreachable():
+            raise IOError("unreachable")
+
+        # storage that can't be reached yet is only logged
+        keyvalue_handlers.storage.warm_up = unreachable
+        keyvalue_handlers.warm_up()
+
+    def test_large_values_are_updated_conditionally(self):
+        keyvalue_handlers.storage = DynamoBackend('kvstore', 'kvstore-large', table=FakeTable(), bucket=FakeBucket(),
+            index_table=FakeIndexTable())
+        large = dict(value="x" * MAX_ITEM_SIZE)
+        response = self.app.post("/test/large", data=json.dumps(large), content_type="application/json",
+            headers={"If-None-Match": "*"})
+        self.assertEqual(200, response.status_code)
+        response = self.app.patch("/test/large", data=json.dumps(dict(patched=True)), content_type="application/json")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(dict(large, patched=True), json.loads(self.app.get("/test/large").data))
+        response = self.app.post("/__increment__/test/large?field=count")
+        self.assertEqual(dict(message="ok", value=1), json.loads(response.data))
+
+    def export(self, query_string=None):
+        response = self.app.get("/__export__", query_string=query_string)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("application/x-ndjson", response.content_type)
+        return [json.loads(line) for line in response.data.decode('utf-8').splitlines()]
+
+    def test_export_and_import(self):
+        self.app.post("/export/json", data=json.dumps(dict(one=1)), content_type="application/json")
+        self.app.post("/export/binary", data=b"\x00\xff", content_type="application/octet-stream")
+        self.app.post("/export/ttl", data="kept", content_type="text/plain", headers={'X-TTL': '60'})
+        self.app.post("/other", data="not exported", content_type="text/plain")
+        lines = self.export(dict(prefix="export/"))
+        self.assertEqual(["export/binary", "export/json", "export/ttl"], [line['key'] for line in lines[:-1]])
+        self.assertEqual(dict(next=None), lines[-1])
+        self.assertEqual("base64", lines[0]['encoding'])
+        self.assertEqual(etag_for(b"\x00\xff"), lines[0]['metadata']['etag'])
+
+        keyvalue_handlers.storage = LocalBackend(os.path.join(self.storage_root, "imported"))
+        keyvalue_handlers.read_cache.clear()
+        body = "".join(json.dumps(line) + "\n" for line in lines)
+        response = self.app.post("/__import__", data=body, content_type="application/x-ndjson")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(3, json.loads(response.data)['imported'])
+        self.assertEqual(b"\x00\xff", self.app.get("/export/binary").data)
+        self.assertEqual(dict(one=1), json.loads(self.app.get("/export/json").data))
+        response = self.app.get("/export/ttl")
+        self.assertEqual("text/plain", response.content_type.split(";")[0])
+        self.assertEqual(lines[2]['metadata']['expires'], keyvalue_handlers.storage.read_metadata("export/ttl")[1]['expires'])
+
+    def test_export_resumes_from_the_last_key(self):
+        for number in range(5):
+            self.app.post("/resumed/%s" % (number), data=str(number), content_type="text/plain")
+        keyvalue_handlers.export_page_size = 2
+        try:
+            lines = self.export(dict(limit=3))
+            self.assertEqual(["resumed/0", "resumed/1", "resumed/2"], [line['key'] for line in lines[:-1]])
+            self.assertEqual(dict(next="resumed/2"), lines[-1])
+            lines = self.export(dict(after=lines[-1]['next']))
+            self.assertEqual(["resumed/3", "resumed/4", None], [line.get('key') for line in lines])
+        finally:
+            keyvalue_handlers.export_page_size = 100
+        self.assertEqual(400, self.app.get("/__export__?limit=lots").status_code)
+
+    def test_export_compressed_values_as_stored(self):
+        keyvalue_handlers.compression = 'gzip'
+        self.app.post("/compressed", data=json.dumps(dict(value="x" * 2048)), content_type="application/json")
+        line = self.export()[0]
+        self.assertEqual("gzip", line['metadata']['content-encoding'])
+        self.app.delete("/compressed")
+        self.app.post("/__import__", data=json.dumps(line) + "\n")
+        self.assertEqual(dict(value="x" * 2048), json.loads(self.app.get("/compressed").data))
+        self.assertEqual("gzip", keyvalue_handlers.storage.read_metadata("compressed")[1]['content-encoding'])
+
+    def test_import_stores_in_batches(self):
+        batches = []
+        store_many = keyvalue_handlers.storage.store_many
+        keyvalue_handlers.storage.store_many = lambda items: batches.append(len(items)) or store_many(items)
+        keyvalue_handlers.import_batch_size = 2
+        try:
+            body = "".join(json.dumps(dict(key="batched/%s" % (number), content_type="text/plain", body=str(number))) + "\n"
+                for number in range(5))
+            response = self.app.post("/__import__", data=body)
+        finally:
+            keyvalue_handlers.import_batch_size = 100
+        self.assertEqual(5, json.loads(response.data)['imported'])
+        self.assertEqual([2, 2, 1], batches)
+        self.assertEqual(b"4", self.app.get("/batched/4").data)
+
+    def test_import_reports_what_it_could_not_import(self):
+        body = "\n".join([
+            json.dumps(dict(key="good", content_type="text/plain", body="good")),
+            "not json",
+            json.dumps(dict(key="no body")),
+            json.dumps(dict(key="expired", body="gone", metadata=dict(expires=int(time.time()) - 10))),
+            json.dumps(dict(key="not/base64", body="plain", metadata={"content-encoding": "gzip"})),
+            json.dumps(dict(key="unsupported", body="cGxhaW4=", encoding="base64", metadata={"content-encoding": "zstd"})),
+            "",
+        ])
+        response = self.app.post("/__import__", data=body)
+        self.assertEqual(400, response.status_code)
+        result = json.loads(response.data)
+        self.assertEqual((1, 4, 1), (result['imported'], result['invalid'], result['skipped']))
+        self.assertEqual(set(["line 2", "line 3", "line 5", "line 6"]), set(result['failures']))
+        self.assertEqual(b"good", self.app.get("/good").data)
+        self.assertEqual(404, self.app.get("/not/base64").status_code)
+        self.assertEqual(404, self.app.get("/unsupported").status_code)
+
+    def test_import_rejects_lines_that_are_too_long(self):
+        keyvalue_handlers.import_max_line_bytes = 100
+        try:
+            body = json.dumps(dict(key="short", body="short")) + "\n" + json.dumps(dict(key="long", body="x" * 200)) + "\n"
+            response = self.app.post("/__import__", data=body)
+        finally:
+            keyvalue_handlers.import_max_line_bytes = 64 * 1024 * 1024
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(1, json.loads(response.data)['imported'])
+        self.assertEqual(404, self.app.get("/long").status_code)
+
+@unittest.skipUnless(serialization.orjson, "orjson isn't installed")
+class TestKeyValueWithOrjson(TestKeyValue):
+    serializer = 'orjson'
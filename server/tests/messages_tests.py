@@ -0,0 +1,101 @@
+import io
+import threading
+import unittest
+from server import messages
+from server.messages import Publisher, BLOCK, DROP_OLDEST, DROP_NEW
+
+class BlockedStream(io.StringIO):
+    """ a stream that can't be written to until it's released """
+
+    def __init__(self):
+        super(BlockedStream, self).__init__()
+        self.released = threading.Event()
+        self.writing = threading.Event()
+
+    def write(self, data):
+        self.writing.set()
+        self.released.wait(5)
+        return super(BlockedStream, self).write(data)
+
+class TestMessages(unittest.TestCase):
+    def test_batches(self):
+        stream = BlockedStream()
+        publisher = Publisher(stream=stream, batch_size=3)
+        publisher.publish("one")
+        stream.writing.wait(5)
+        for message in ["two", "three", "four", "five"]:
+            publisher.publish(message)
+        stream.released.set()
+        self.assertTrue(publisher.flush(5))
+        self.assertEqual("one\ntwo\nthree\nfour\nfive\n", stream.getvalue())
+        self.assertEqual(dict(queued=0, published=5, dropped=0, batches=3, errors=0), publisher.stats())
+
+    def publish_while_blocked(self, overflow):
+        stream = BlockedStream()
+        publisher = Publisher(stream=stream, max_queued=2, overflow=overflow)
+        publisher.publish("one")
+        # one is being written, so two and three fill the queue
+        stream.writing.wait(5)
+        publisher.publish("two")
+        publisher.publish("three")
+        return stream, publisher
+
+    def test_drop_new(self):
+        stream, publisher = self.publish_while_blocked(DROP_NEW)
+        self.assertFalse(publisher.publish("four"))
+        stream.released.set()
+        publisher.close(5)
+        self.assertEqual("one\ntwo\nthree\n", stream.getvalue())
+        self.assertEqual(1, publisher.stats()['dropped'])
+
+    def test_drop_oldest(self):
+        stream, publisher = self.publish_while_blocked(DROP_OLDEST)
+        self.assertTrue(publisher.publish("four"))
+        stream.released.set()
+        publisher.close(5)
+        self.assertEqual("one\nthree\nfour\n", stream.getvalue())
+        self.assertEqual(1, publisher.stats()['dropped'])
+
+    def test_block(self):
+        stream, publisher = self.publish_while_blocked(BLOCK)
+        published = threading.Event()
+        thread = threading.Thread(target=lambda: publisher.publish("four") and published.set())
+        thread.start()
+        self.assertFalse(published.wait(0.1))
+        stream.released.set()
+        thread.join(5)
+        self.assertTrue(published.is_set())
+        publisher.close(5)
+        self.assertEqual("one\ntwo\nthree\nfour\n", stream.getvalue())
+
+    def test_close_writes_everything_queued(self):
+        stream = io.StringIO()
+        publisher = Publisher(stream=stream, batch_size=2)
+        for number in range(11):
+            publisher.publish(number)
+        publisher.close(5)
+        self.assertEqual("".join("%s\n" % (number) for number in range(11)), stream.getvalue())
+        with self.assertRaises(Exception):
+            publisher.publish("too late")
+
+    def test_close_gives_up_on_a_stream_that_is_not_read(self):
+        stream = BlockedStream()
+        publisher = Publisher(stream=stream)
+        publisher.publish("one")
+        stream.writing.wait(5)
+        publisher.publish("two")
+        self.assertFalse(publisher.close(0.1))
+        stream.released.set()
+        self.assertTrue(publisher.close(5))
+        self.assertEqual("one\ntwo\n", stream.getvalue())
+
+    def test_send(self):
+        stream = io.StringIO()
+        publisher = messages.publisher
+        messages.publisher = Publisher(stream=stream)
+        try:
+            messages.send("pants", messages.LOCAL_PUBLISH)
+            messages.publisher.flush(5)
+        finally:
+            messages.publisher = publisher
+        self.assertEqual("pants\n", stream.getvalue())
@@ -0,0 +1,88 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+from server.core import app
+from server.metrics import Metrics, COUNTER, GAUGE, HISTOGRAM
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics_dir = tempfile.mkdtemp()
+        self.metrics = Metrics(self.metrics_dir, flush_seconds=0)
+        self.metrics.define('requests_total', COUNTER, "Requests")
+        self.metrics.define('in_flight', GAUGE, "In flight")
+        self.metrics.define('duration_seconds', HISTOGRAM, "Duration", (0.1, 1.0))
+
+    def tearDown(self):
+        shutil.rmtree(self.metrics_dir)
+
+    def test_render(self):
+        self.metrics.inc('requests_total', route='/one')
+        self.metrics.inc('requests_total', 2, route='/one')
+        self.metrics.add('in_flight', 1)
+        self.metrics.observe('duration_seconds', 0.05, route='/one')
+        self.metrics.observe('duration_seconds', 0.5, route='/one')
+        self.metrics.observe('duration_seconds', 5, route='/one')
+        rendered = self.metrics.render().splitlines()
+        self.assertTrue('# TYPE duration_seconds histogram' in rendered)
+        self.assertTrue('requests_total{route="/one"} 3' in rendered)
+        self.assertTrue('in_flight 1' in rendered)
+        self.assertTrue('duration_seconds_bucket{route="/one",le="0.1"} 1' in rendered)
+        self.assertTrue('duration_seconds_bucket{route="/one",le="1"} 2' in rendered)
+        self.assertTrue('duration_seconds_bucket{route="/one",le="+Inf"} 3' in rendered)
+        self.assertTrue('duration_seconds_sum{route="/one"} 5.55' in rendered)
+        self.assertTrue('duration_seconds_count{route="/one"} 3' in rendered)
+
+    def test_aggregates_across_processes(self):
+        self.metrics.inc('requests_total', route='/one')
+        self.metrics.add('in_flight', 1)
+        self.metrics.observe('duration_seconds', 0.05)
+        # a worker that has since gone away, its gauges no longer count
+        with open(os.path.join(self.metrics_dir, '%s.json' % (2 ** 22 + 1)), 'w') as snapshot:
+            json.dump([
+                ['requests_total', [['route', '/one']], 2],
+                ['in_flight', [], 5],
+                ['duration_seconds', [], [0, 1, 0.5, 1]],
+            ], snapshot)
+        collected = self.metrics.collect()
+        self.assertEqual(3, collected[('requests_total', (('route', '/one'),))])
+        self.assertEqual(1, collected[('in_flight', ())])
+        buckets_and_count = collected[('duration_seconds', ())]
+        self.assertEqual([1, 1, 2], buckets_and_count[:2] + buckets_and_count[3:])
+        self.assertAlmostEqual(0.55, buckets_and_count[2])
+
+    def test_processes_that_have_gone_away_are_folded_together(self):
+        self.metrics.inc('requests_total', route='/one')
+        for pid in (2 ** 22 + 1, 2 ** 22 + 2):
+            with open(os.path.join(self.metrics_dir, '%s.json' % (pid)), 'w') as snapshot:
+                json.dump([['requests_total', [['route', '/one']], 2], ['in_flight', [], 5]], snapshot)
+        self.assertEqual(5, self.metrics.collect()[('requests_total', (('route', '/one'),))])
+        self.assertEqual(['%s.json' % (os.getpid()), 'retired.json'],
+            sorted(name for name in os.listdir(self.metrics_dir) if not name.startswith('.')))
+        with open(os.path.join(self.metrics_dir, '%s.json' % (2 ** 22 + 3)), 'w') as snapshot:
+            json.dump([['requests_total', [['route', '/one']], 4]], snapshot)
+        collected = self.metrics.collect()
+        self.assertEqual(9, collected[('requests_total', (('route', '/one'),))])
+        self.assertFalse(('in_flight', ()) in collected)
+        self.assertEqual(9, self.metrics.collect()[('requests_total', (('route', '/one'),))])
+
+    def test_shared_directory_is_opt_in(self):
+        env = dict((name, value) for name, value in os.environ.items() if name != 'KVSTORE_METRICS_DIR')
+        output = subprocess.check_output([sys.executable, '-c', 'from server import metrics; print(metrics.metrics.directory)'],
+            cwd=REPOSITORY_ROOT, env=env)
+        self.assertEqual(b'None', output.strip())
+
+    def test_metrics_view(self):
+        client = app.test_client()
+        client.get("/diagnostic")
+        response = client.get("/metrics")
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.content_type.startswith("text/plain"))
+        body = response.data.decode('utf-8')
+        self.assertTrue('kvstore_http_request_duration_seconds_count{method="GET",route="/diagnostic",status="200"}' in body)
+        self.assertTrue('# TYPE kvstore_http_requests_in_flight gauge' in body)
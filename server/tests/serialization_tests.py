@@ -0,0 +1,41 @@
+import json
+import unittest
+from server import serialization
+
+class TestSerialization(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(serialization.use, serialization.serializer)
+
+    def test_stdlib(self):
+        serialization.use('json')
+        self.assertEqual('{"one": 1}', serialization.dumps(dict(one=1)))
+        self.assertEqual(dict(one=1), serialization.loads(b'{"one": 1}'))
+
+    def test_splice_object(self):
+        serialization.use('json')
+        spliced = serialization.splice_object([("one", '{"two": [1, 2]}'), ("thr\"ee", '"four"')])
+        self.assertEqual(json.dumps({"one": {"two": [1, 2]}, "thr\"ee": "four"}), spliced)
+
+    @unittest.skipUnless(serialization.orjson, "orjson isn't installed")
+    def test_orjson(self):
+        serialization.use('orjson')
+        self.assertEqual('{"one":1}', serialization.dumps(dict(one=1)))
+        # orjson only takes string keys, so this goes to the stdlib
+        self.assertEqual('{"1": 1}', serialization.dumps({1: 1}))
+        self.assertEqual(dict(one=1), json.loads(serialization.splice_object([("one", "1")])))
+
+    @unittest.skipUnless(serialization.orjson, "orjson isn't installed")
+    def test_orjson_writes_and_reads_what_the_stdlib_does(self):
+        serialization.use('orjson')
+        value = dict(nan=float('nan'), inf=[float('-inf')], none=None, text="null")
+        self.assertEqual(json.dumps(value), serialization.dumps(value))
+        self.assertEqual('{"none":null,"text":"null"}', serialization.dumps(dict(none=None, text="null")))
+        for text in ('{"nan": NaN, "inf": [-Infinity]}', b'[18446744073709551616, 1]', '"\\ud800"'):
+            loaded = serialization.loads(text)
+            self.assertEqual(json.dumps(json.loads(text)), json.dumps(loaded))
+        with self.assertRaises(ValueError):
+            serialization.loads('not json')
+
+    def test_auto(self):
+        serialization.use('auto')
+        self.assertEqual('orjson' if serialization.orjson else 'json', serialization.serializer)